@@ -37,39 +37,600 @@ flexstation.py
 """
 import logging
 
-from itertools import izip_longest, imap
+from contextlib import contextmanager
+from itertools import izip, izip_longest, imap
 from struct import unpack
 
+from celery.task import task
+from django.conf import settings
+from django.db import DatabaseError, connections, DEFAULT_DB_ALIAS
+from django.db.models.signals import post_save, post_delete
+
+try:
+    from django.db.transaction import atomic
+except ImportError: # Django < 1.6
+    from django.db.transaction import commit_on_success as atomic
+
+try:
+    from django.db.transaction import on_commit
+except ImportError: # Django < 1.9, the caches of the filter are then only emptied when its own transactions roll back
+    on_commit = None
+
+try:
+    from django.core.cache import caches
+    get_cache = caches.__getitem__
+except ImportError: # Django < 1.7
+    from django.core.cache import get_cache
+
 from tardis.tardis_portal.models import Schema, DatafileParameterSet
-from tardis.tardis_portal.models import ParameterName, DatafileParameter
+from tardis.tardis_portal.models import ParameterName, DatafileParameter, Dataset_File, Replica
 
-from os import path
+from os import path, makedirs, rename, listdir, remove
+from StringIO import StringIO
+from tempfile import gettempdir
 
 from struct import *
 
 import binascii
+import cProfile
+import hashlib
+import json
+import mmap
+import multiprocessing
+import multiprocessing.pool
+import os
 import pdb
+import pstats
+import re
+import resource
+import threading
 import time
 import string
 from datetime import date
 
+try:
+    import numpy
+except ImportError: # numpy is only required to extract the plate data
+    numpy = None
+
+try:
+    import tracemalloc
+except ImportError: # Python < 3.4 without the pytracemalloc backport, the profiles then only report the peak memory
+    tracemalloc = None
+
+TRACEMALLOC_LOCK = threading.Lock() # tracemalloc traces the whole process, a single profile starts and stops it
+
 logger = logging.getLogger(__name__)
 
+# Layouts of the fixed-size parts of the PDA structures (big-endian, 'x' are bytes skipped)
+WELL_POSITION = Struct(">HH6x") # row number, column number
+PLATE_DATA_HEADER = Struct(">6xHHII") # first column read, number of columns, number of reads, number of wavelengths
+EM_WAVELENGTH = Struct(">I1x") # emission wavelength, repeated for each wavelength
+READ_TIMING = Struct(">4xdd170x") # read duration, read interval
+EX_WAVELENGTH = Struct(">I4x") # excitation wavelength, repeated for each wavelength
+TRANS = Struct(">IIdI16x") # R, @, V, H, repeated for each wavelength
+PLATE_TEMPERATURE = Struct(">4xf") # temperature, repeated for each plate
+FLEX_SITE_HEADER = Struct(">IIII") # number of data chunks, number of reads, id, length of a data chunk
+# 'Well' structure: name, well name, row number, column number, 6 bytes, plate name, 4 bytes
+WELL_PATTERN = re.compile(r"\x06CSWell([^\x00]*)\x00(..)(..).{6}([^\x00]*)\x00.{4}", re.DOTALL)
+WELLS_PATTERN = re.compile(r"(?:\x06CSWell[^\x00]*\x00.{10}[^\x00]*\x00.{4})*", re.DOTALL)
+WELL_FIXED_SIZE = 23 # size of a 'Well' structure without its well and plate names
+
+
+class PdaStructure(object):
+    """Base of the results of the section readers: the fields of a structure, stored in slots as native numbers.
+    FIELDS lists the fields in the order the section readers used to return them as a tuple, so that a structure
+    can still be unpacked or indexed like one.
+    """
+
+    __slots__ = ()
+    FIELDS = ()
+
+    def __init__(self, *values):
+        for name, value in izip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self.FIELDS)
+
+    def __getitem__(self, index):
+        return getattr(self, self.FIELDS[index])
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def __eq__(self, other):
+        return type(self) == type(other) and tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '{0}({1})'.format(type(self).__name__, ', '.join(
+            '{0}={1!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+
+class Experiment(PdaStructure):
+    """'ExperimentSection' structure"""
+
+    __slots__ = ('name',)
+    FIELDS = __slots__
+
+
+class PlateData(PdaStructure):
+    """'PlateData' structure: the reads of the plate. The wavelengths and trans values are kept as numbers, and
+    only formatted when emValues, exValues or trans are accessed
+    """
+
+    __slots__ = ('firstReadColumn', 'numberOfColumns', 'readNumber', 'wavelengthsNumber', 'emWavelengths',
+                 'readDuration', 'readInterval', 'exWavelengths', 'transValues')
+    FIELDS = ('firstReadColumn', 'numberOfColumns', 'readNumber', 'wavelengthsNumber', 'emValues',
+              'readDuration', 'readInterval', 'exValues', 'trans')
+
+    @property
+    def emValues(self):
+        """The emission wavelengths, separated by spaces (None if there are none)"""
+        return " ".join(str(wavelength) for wavelength in self.emWavelengths) or None
+
+    @property
+    def exValues(self):
+        """The excitation wavelengths, separated by spaces (None if there are none)"""
+        return " ".join(str(wavelength) for wavelength in self.exWavelengths) or None
+
+    @property
+    def trans(self):
+        """The trans values of each wavelength, formatted as 'Trans1: H={0}\xb5, R={1}, V={2}\xb5, @{3}. Trans2: ...'
+        (None if there are none)
+        """
+        return ". ".join(str.format("Trans{0}: H={1}\xb5, R={2}, V={3}\xb5, \x40{4}", (i + 1), transH, transR,
+                                    transV, transAt)
+                         for i, (transR, transAt, transV, transH) in enumerate(self.transValues)) or None
+
+
+class PlateDescriptor(PdaStructure):
+    """'PlateDescriptor' structure"""
+
+    __slots__ = ('numberOfPlates', 'temperatures')
+    FIELDS = __slots__
+
+
+class FlexSite(PdaStructure):
+    """'FlexSite' structure: the header of the readings of a well (the data chunks themselves aren't read)"""
+
+    __slots__ = ('id', 'dataChunkNumber', 'readNumber', 'dataChunkLength')
+    FIELDS = __slots__
+
+
+class CalcPlateBody(PdaStructure):
+    """'CalcPlateBody' structure"""
+
+    __slots__ = ('wavelength', 'wavelengthCombination', 'formula', 'unknown', 'instrumentInfos')
+    FIELDS = __slots__
+
+
+class FlexstationMetrics(object):
+
+    FILE_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        """Counters of the time and bytes spent on each section of the PDA files parsed, exported in the text format
+        of Prometheus (to be served by an endpoint, or written to a file read by the textfile collector)
+        """
+        self.lock = threading.Lock()
+        self.sectionSeconds = {}
+        self.sectionBytes = {}
+        self.sectionReads = {}
+        self.sectionFailures = {}
+        self.files = {}
+        self.fileBytes = 0
+        self.fileSecondsBuckets = [0] * len(self.FILE_SECONDS_BUCKETS)
+        self.fileSecondsSum = 0.0
+        self.fileSecondsCount = 0
+
+    def observeSection(self, section, seconds, size):
+        """Counts a read of a section
+        :param section: the name of the section (e.g. 'CSPlateData', 'header', 'database')
+        :type section: str
+        :param seconds: the time spent reading the section
+        :type seconds: float
+        :param size: the number of bytes consumed
+        :type size: int
+        """
+        with self.lock:
+            self.sectionSeconds[section] = self.sectionSeconds.get(section, 0.0) + seconds
+            self.sectionBytes[section] = self.sectionBytes.get(section, 0) + size
+            self.sectionReads[section] = self.sectionReads.get(section, 0) + 1
+
+    def countFailure(self, section):
+        """Counts a section which couldn't be read
+        :param section: the name of the section
+        :type section: str
+        """
+        with self.lock:
+            self.sectionFailures[section] = self.sectionFailures.get(section, 0) + 1
+
+    def observeFile(self, seconds, size, status):
+        """Counts a file processed
+        :param seconds: the time spent processing the file, database included
+        :type seconds: float
+        :param size: the size of the file
+        :type size: int
+        :param status: 'ok' or 'failed'
+        :type status: str
+        """
+        with self.lock:
+            self.files[status] = self.files.get(status, 0) + 1
+            self.fileBytes += size
+            for i, bound in enumerate(self.FILE_SECONDS_BUCKETS):
+                if seconds <= bound:
+                    self.fileSecondsBuckets[i] += 1
+            self.fileSecondsSum += seconds
+            self.fileSecondsCount += 1
+
+    def render(self):
+        """Returns the counters in the text format of Prometheus
+        :returns text: the exposition of the counters
+        :type text: str
+        """
+        lines = []
+        def counter(name, description, values, label):
+            lines.append('# HELP {0} {1}'.format(name, description))
+            lines.append('# TYPE {0} counter'.format(name))
+            for key in sorted(values):
+                lines.append('{0}{{{1}="{2}"}} {3!r}'.format(name, label, key, values[key]))
+
+        with self.lock:
+            counter('flexstation_section_seconds_total', 'Time spent reading each section of the PDA files.',
+                    self.sectionSeconds, 'section')
+            counter('flexstation_section_bytes_total', 'Bytes consumed by each section of the PDA files.',
+                    self.sectionBytes, 'section')
+            counter('flexstation_section_reads_total', 'Number of reads of each section of the PDA files.',
+                    self.sectionReads, 'section')
+            counter('flexstation_section_failures_total', 'Number of sections of the PDA files which failed.',
+                    self.sectionFailures, 'section')
+            counter('flexstation_files_total', 'Number of PDA files processed.', self.files, 'status')
+            lines.append('# HELP flexstation_file_bytes_total Bytes of the PDA files processed.')
+            lines.append('# TYPE flexstation_file_bytes_total counter')
+            lines.append('flexstation_file_bytes_total {0}'.format(self.fileBytes))
+            lines.append('# HELP flexstation_file_seconds Time spent processing each PDA file, database included.')
+            lines.append('# TYPE flexstation_file_seconds histogram')
+            for bound, count in zip(self.FILE_SECONDS_BUCKETS, self.fileSecondsBuckets):
+                lines.append('flexstation_file_seconds_bucket{{le="{0}"}} {1}'.format(bound, count))
+            lines.append('flexstation_file_seconds_bucket{{le="+Inf"}} {0}'.format(self.fileSecondsCount))
+            lines.append('flexstation_file_seconds_sum {0!r}'.format(self.fileSecondsSum))
+            lines.append('flexstation_file_seconds_count {0}'.format(self.fileSecondsCount))
+
+        return '\n'.join(lines) + '\n'
+
+    def writeTextfile(self, target):
+        """Writes the counters to a file, for the textfile collector of the Prometheus node exporter
+        :param target: the path of the file ('{pid}' is replaced by the id of the process, for one file per worker)
+        :type target: str
+        """
+        target = target.format(pid=os.getpid())
+        with open(target + '.tmp', 'w') as f:
+            f.write(self.render())
+        rename(target + '.tmp', target)
+
+
+# counters of all the filters of the process
+METRICS = FlexstationMetrics()
+
+
+class PdaBuffer(object):
+
+    UNSIGNED_FORMATS = {1: Struct('>B'), 2: Struct('>H'), 4: Struct('>I'), 8: Struct('>Q')}
+
+    def __init__(self, data):
+        """Read-only, file-like view over the whole content of a PDA file, walked with an integer cursor
+        :param data: the content of the PDA file (str, mmap or any object supporting slicing and the buffer interface)
+        :type data: str
+        """
+        self.data = data
+        self.size = len(data)
+        self.pos = 0
+        self.mapped = False # True if the buffer maps a file itself, and has to release it
+
+    @staticmethod
+    def isContent(target):
+        """Tells whether a PDA file is given by its content rather than by its path or a stream (a str holding
+        a NUL byte can't be a path, and the PDA files start with one)
+        :param target: the path, the content or a stream of the PDA file
+        :type target: str
+        :returns isContent: True if target is the content of the file
+        :type isContent: bool
+        """
+        if isinstance(target, (bytearray, buffer, memoryview, mmap.mmap)):
+            return True
+        return isinstance(target, str) and "\x00" in target
+
+    @classmethod
+    def open(cls, target):
+        """Opens a PDA file given by its path, its content or a readable stream.
+        A path or a stream of a real file is mapped in memory (falls back to a single read if the file can't be
+        mapped), the content is used without being copied (if it is a str or a mmap), and other streams are read
+        at once from their beginning. Only the mappings made here are released when the buffer is closed.
+        :param target: the path, the content (str, bytearray, buffer, memoryview, mmap or another PdaBuffer, whose
+        content is shared) or a stream of the file
+        :type target: str
+        :returns buffer: the buffer over the content of the file
+        :type buffer: PdaBuffer
+        """
+        if isinstance(target, cls):
+            return cls(target.data)
+        if isinstance(target, memoryview):
+            return cls(target.tobytes())
+        if isinstance(target, (bytearray, buffer)):
+            return cls(str(target))
+        if cls.isContent(target):
+            return cls(target)
+        if hasattr(target, 'read'):
+            return cls.openStream(target)
+        with open(target, 'rb') as f:
+            return cls.openStream(f)
+
+    @classmethod
+    def openStream(cls, stream):
+        """Maps a stream over a real file in memory, or reads any other stream at once from its beginning
+        :param stream: the stream of the PDA file
+        :type stream: file
+        :returns buffer: the buffer over the content of the file
+        :type buffer: PdaBuffer
+        """
+        try:
+            data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, IOError, ValueError, mmap.error): # in-memory streams and empty files can't be mapped
+            if hasattr(stream, 'seek'):
+                stream.seek(0)
+            return cls(stream.read())
+        buffer = cls(data)
+        buffer.mapped = True
+        return buffer
+
+    @classmethod
+    def peek(cls, target, size):
+        """Reads the first bytes of a PDA file given by its path, its content or a readable stream (whose position
+        is left unchanged)
+        :param target: the path, the content or a stream of the PDA file
+        :type target: str
+        :param size: the number of bytes to read
+        :type size: int
+        :returns data: the first bytes of the file
+        :type data: str
+        """
+        if isinstance(target, cls):
+            return target.data[:size]
+        if cls.isContent(target):
+            return str(target[:size]) if not isinstance(target, memoryview) else target[:size].tobytes()
+        if hasattr(target, 'read'):
+            position = target.tell()
+            target.seek(0)
+            data = target.read(size)
+            target.seek(position)
+            return data
+        with open(target, 'rb') as f:
+            return f.read(size)
+
+    def close(self):
+        """Releases the mapping of the file, if the buffer made it
+        """
+        if self.mapped:
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, size=-1):
+        """Reads at most size bytes from the cursor, like file.read
+        :param size: the number of bytes to read (reads until the end of the buffer if negative)
+        :type size: int
+        :returns data: the bytes read
+        :type data: str
+        """
+        start = self.pos
+        if start >= self.size:
+            return ''
+        if size < 0 or start + size > self.size:
+            end = self.size
+        else:
+            end = start + size
+        self.pos = end
+        return self.data[start:end]
+
+    def seek(self, offset, whence=0):
+        """Moves the cursor, like file.seek
+        :param offset: the offset to move the cursor to
+        :type offset: int
+        :param whence: 0 for an absolute offset, 1 relative to the cursor, 2 relative to the end of the buffer
+        :type whence: int
+        """
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise IOError("Invalid offset {0}".format(offset))
+        self.pos = offset
+
+    def tell(self):
+        """Returns the position of the cursor, like file.tell
+        """
+        return self.pos
+
+    def readUInt(self, size):
+        """Reads a big-endian unsigned number encoded on 1, 2, 4 or 8 bytes
+        :param size: the number of bytes on which the number is encoded
+        :type size: int
+        :returns number: the number read
+        :type number: int
+        """
+        unsignedFormat = self.UNSIGNED_FORMATS.get(size)
+        if unsignedFormat != None and self.pos + size <= self.size:
+            number = unsignedFormat.unpack_from(self.data, self.pos)[0]
+            self.pos += size
+            return number
+        # truncated number at the end of the buffer: same behaviour as int(hexlify(f.read(size)), 16)
+        return int(binascii.hexlify(self.read(size)), 16)
+
+    def readRecord(self, layout):
+        """Reads a fixed-size record at once
+        :param layout: the layout of the record
+        :type layout: Struct
+        :returns fields: the fields of the record
+        :type fields: tuple
+        """
+        fields = layout.unpack_from(self.data, self.pos)
+        self.pos += layout.size
+        return fields
+
+    def readRecords(self, layout, count):
+        """Reads consecutive fixed-size records, with the compiled layout of a single record (the number of records comes
+        from the file, no layout is compiled or kept for it)
+        :param layout: the layout of a record
+        :type layout: Struct
+        :param count: the number of records
+        :type count: int
+        :returns records: the fields of each record
+        :type records: list of tuple
+        """
+        if count <= 0:
+            return []
+        if self.pos + layout.size * count > self.size:
+            raise error("{0} records of {1} bytes don't fit in the buffer".format(count, layout.size))
+
+        records = [layout.unpack_from(self.data, offset)
+                   for offset in range(self.pos, self.pos + layout.size * count, layout.size)]
+        self.pos += layout.size * count
+        return records
+
+    def readUntil(self, delimiter):
+        """Reads a string until a delimiter is reached, and moves the cursor after the delimiter
+        :param delimiter: the delimiter which stops the reading if encountered
+        :type delimiter: str
+        :returns result: the string that was read, without the end delimiter. None if the delimiter was never found
+        :type result: str
+        """
+        index = self.data.find(delimiter, self.pos)
+        if index == -1: # the end of the buffer has been reached without finding the delimiter
+            self.pos = max(self.pos, self.size)
+            return None
+        result = self.data[self.pos:index]
+        self.pos = index + len(delimiter)
+        return result
+
 
 class FlexstationFilter(object):
 
     NUMBER_OF_ROWS = 8
     HEADER_END_DELIMITER = "\x48\x00\x00\x00\x48\x00\x00\x00"
-
-    def __init__(self, name, schema):
+    ANALYSIS_END_DELIMITER = "\xFF" * 32
+    BLOCK_SIZE = 4096
+    PEEK_SIZE = 8192 # the header and the first experiment section fit in the first few KB of the files
+    SNIFF_SIZE = 64
+    PDA_SIGNATURE = re.compile(r"\x00. [0-9.]+\x00\x00##BLOCKS=", re.DOTALL) # e.g. "\x00\x04 5.42.1.0\x00\x00##BLOCKS= 1"
+    SIDECAR_EXTENSION = ".npz"
+    PARSE_CACHE_VERSION = 1 # to increment whenever the extracted metadata changes for a same file
+    STRUCTURE_NAME_PATTERN = re.compile("CS[A-Z]")
+    SECTION_READERS = {
+        "CSExperimentSection": "readExperimentSection",
+        "CSTmplGroup": "readTmplGroup",
+        "CSTmplSample": "readTmplSample",
+        "CSAnalysisSection": "readAnalysisSection",
+        "CSWell": "readWell",
+        "CSPlateSection": "readPlateSection",
+        "CSPlateData": "readPlateData",
+        "CSPlateDescriptor": "readPlateDescriptor",
+        "CSFlexSite": "readFlexSite",
+        "CSCalcPlateBody": "readCalcPlateBody",
+        "CSMorphPlateTable": "readMorphPlateTable",
+    }
+    # sections each parameter is read from (the parameters of the header are always read)
+    PARAMETER_SECTIONS = {
+        'experiment_name': ("CSExperimentSection",),
+        'analysis_notes': ("CSAnalysisSection",),
+        'number_of_wells_or_cuvette': ("CSWell",),
+        'strips': ("CSPlateData",),
+        'number_of_wavelengths': ("CSPlateData",),
+        'kinetic_points': ("CSPlateData",),
+        'kinetic_flex_read_time': ("CSPlateData",),
+        'kinetic_flex_interval': ("CSPlateData",),
+        'read_wavelength': ("CSPlateData",),
+        'excitation_wavelengths': ("CSPlateData",),
+        'trans': ("CSPlateData",),
+        'wavelength_combination': ("CSCalcPlateBody",),
+        'instrument_info': ("CSCalcPlateBody",),
+    }
+    HEADER_PARAMETERS = ('softmax_version',)
+
+    INDEX_EXTENSION = ".idx"
+    INDEX_MAGIC = "PDAI"
+    INDEX_VERSION = 1
+    INDEX_HEADER_FORMAT = Struct(">4sBI") # magic, version, number of datasets
+    INDEX_COUNT_FORMAT = Struct(">I")
+    INDEX_ENTRY_FORMAT = Struct(">BII") # structure name (in the names table), offset, length
+
+    def __init__(self, name, schema, asynchronous=False, sidecar=False, perDataset=False, profileThreshold=None):
         """This filter extract meta-data from file under the PDA format (proprietary format generated by SoftMax Pro)
         :param name: the short name of the schema.
         :type name: str
         :param schema: the name of the schema to load the PDA meta-data into.
         :type schema: str
+        :param asynchronous: if True, the extraction is done by a Celery task instead of the post-save signal.
+        :type asynchronous: bool
+        :param sidecar: if True, the readings of the wells are also exported to a NumPy file next to the datafile.
+        :type sidecar: bool
+        :param perDataset: if True, the metadata of each dataset (experiment) of a file is saved as its own parameter
+        set, instead of the metadata of all the datasets being merged into a single one.
+        :type perDataset: bool
+        :param profileThreshold: if set, the files whose extraction or saving takes longer than this many seconds are
+        extracted again under the profiler (defaults to the FLEXSTATION_PROFILE_THRESHOLD setting).
+        :type profileThreshold: float
         """
         self.name = name
         self.schema = schema
+        self.asynchronous = asynchronous
+        self.sidecar = sidecar
+        self.perDataset = perDataset
+
+        # schema and parameter names, resolved once and emptied when any of them changes in the database, or when
+        # the transaction they were looked up in is rolled back (see fillCache)
+        self.schemaCache = None
+        self.parameterNamesCache = None
+        self.uncommittedCache = [] # connections and commit callbacks of the transactions the caches were filled in
+
+        # metadata already extracted, keyed by checksum of the files (FLEXSTATION_CACHE is the cache alias to use)
+        cacheAlias = getattr(settings, 'FLEXSTATION_CACHE', 'default')
+        self.parseCache = get_cache(cacheAlias) if cacheAlias else None
+        self.cacheHits = 0
+        self.cacheMisses = 0
+
+        # section indexes of the files already parsed, keyed by checksum (FLEXSTATION_INDEX_PATH is their folder)
+        self.indexPath = getattr(settings, 'FLEXSTATION_INDEX_PATH', None)
+
+        # time and bytes spent on each section, in total (exported as a textfile for Prometheus if
+        # FLEXSTATION_METRICS_TEXTFILE is set) and for the file processed by each thread (see fileMetrics)
+        self.metrics = METRICS
+        self.metricsTextfile = getattr(settings, 'FLEXSTATION_METRICS_TEXTFILE', None)
+        self.local = threading.local()
+        self.fileMetricsLock = threading.Lock() # the datasets of a file may be parsed by several threads
+
+        # threads parsing the datasets of a file in parallel (FLEXSTATION_DATASET_THREADS, 1 parses them in turn),
+        # from a pool shared by all the filters of the process (see get_dataset_pool)
+        self.datasetThreads = getattr(settings, 'FLEXSTATION_DATASET_THREADS', 1)
+
+        # profiles of the slowest files, kept in FLEXSTATION_PROFILE_PATH (at most FLEXSTATION_PROFILE_KEEP of them)
+        if profileThreshold == None:
+            profileThreshold = getattr(settings, 'FLEXSTATION_PROFILE_THRESHOLD', None)
+        self.profileThreshold = profileThreshold
+        self.profilePath = getattr(settings, 'FLEXSTATION_PROFILE_PATH', None)
+        self.profileKeep = getattr(settings, 'FLEXSTATION_PROFILE_KEEP', 20)
+
+        for signal in (post_save, post_delete):
+            signal.connect(self.clearCache, sender=Schema)
+            signal.connect(self.clearCache, sender=ParameterName)
 
         self.paramnames = (
             {'name': 'softmax_version', 'full_name': 'SoftMax software version', 'data_type': ParameterName.STRING}, # Version of the SoftMax software
@@ -108,245 +669,830 @@ class FlexstationFilter(object):
         :param instance: The actual instance being saved.
         :param created: A boolean; True if a new record was created.
         :type created: bool
+        :param data: the content of the file, or the uploaded file, if the sender still has it (optional).
         """
 
         try:
             print("Running Flexstation filter...")
 
             instance = kwargs.get('instance') # get the file in the database
-            filepath = instance.get_absolute_filepath()  # get the real location of the file
-            mimetype = instance.get_mimetype() # get the file type
-            logger.info(filepath)
-            logger.info(mimetype)
 
-            # exit if we're not looking at a PDA file
-            if mimetype != 'application/octet-stream' and filepath.endswith((".pda", ".PDA")):
+            if self.asynchronous:
+                # only queue the extraction, a Celery worker will do the rest
+                extract_flexstation_metadata.delay(instance.id, self.name, self.schema, self.sidecar, self.perDataset,
+                                                   self.profileThreshold)
                 return None
 
+            self.processDatafile(instance, kwargs.get('data'))
+
+        except Exception as e:
+            # if anything goes wrong, log it in tardis.log and exit
+            print(e)
+            logger.info(e)
+            return None
+
+    def processDatafile(self, instance, data=None):
+        """Extracts the metadata of a datafile and saves it to the database
+        :param instance: the datafile to extract metadata from
+        :type instance: Dataset_File
+        :param data: the content of the file, or the uploaded file, to parse instead of reading the file again
+        :type data: str
+        :returns ps: the parameter set of the datafile, None if nothing was saved
+        :type ps: DatafileParameterSet
+        """
+        filepath = instance.get_absolute_filepath()  # get the real location of the file
+        logger.info(filepath)
+
+        # exit if we're not looking at a PDA file, before touching the database
+        if (filepath or instance.filename).endswith(self.SIDECAR_EXTENSION):
+            return None
+        source = self.getSource(instance, filepath, data)
+        if source == None:
+            return None
+        try:
+            return self.processSource(instance, filepath, source)
+        finally:
+            # the buffers over uploaded files are mapped by getSource, they are released once the file is processed
+            if isinstance(source, PdaBuffer):
+                source.close()
+
+    def processSource(self, instance, filepath, source):
+        """Extracts the metadata of a datafile from its content and saves it to the database (see processDatafile)
+        :param instance: the datafile to extract metadata from
+        :type instance: Dataset_File
+        :param filepath: the path of the file of the datafile, if any
+        :type filepath: str
+        :param source: the path of the file of the datafile, or a buffer over its content (see getSource)
+        :type source: str
+        :returns ps: the parameter set of the datafile, None if nothing was saved
+        :type ps: DatafileParameterSet
+        """
+        if not self.isPdaFile(source):
+            return None
+
+        self.fileMetrics = fileMetrics = {}
+        size = source.size if isinstance(source, PdaBuffer) else path.getsize(source)
+        start = time.time()
+        try:
+            ps = self.extractAndSave(instance, source)
+        except Exception:
+            self.reportFile(instance, filepath, size, time.time() - start, 'failed')
+            raise
+        seconds = time.time() - start
+        saveSeconds = fileMetrics.get("database", {}).get('seconds', 0.0)
+        self.reportFile(instance, filepath, size, seconds, 'ok')
+
+        if self.profileThreshold != None and max(seconds - saveSeconds, saveSeconds) > self.profileThreshold:
+            # the file is profiled by a Celery worker, so that the request saving the datafile isn't slowed down further
+            profile_flexstation_file.delay(instance.id, self.name, self.schema,
+                                           {'extract': seconds - saveSeconds, 'save': saveSeconds},
+                                           self.profilePath, self.profileKeep)
+
+        return ps
+
+    def getSource(self, instance, filepath, data=None):
+        """Returns where to read the content of a datafile from, reading it at most once:
+        - the content or the uploaded file given by the caller, if any (the temporary file of large uploads is
+          mapped in memory, smaller uploads are already in memory)
+        - the file of the datafile, if it is stored locally (mapped in memory when parsed)
+        - otherwise, the content of its preferred replica fetched from its location, the rest of the file being
+          fetched in a single read only if its first bytes are the ones of a PDA file
+        :param instance: the datafile
+        :type instance: Dataset_File
+        :param filepath: the path of the file of the datafile, if any
+        :type filepath: str
+        :param data: the content of the file, or the uploaded file
+        :type data: str
+        :returns source: the path of the file, or a buffer over its content. None if it can't be read, or if it is a
+        remote file which isn't a PDA file
+        :type source: str
+        """
+        if data != None:
+            if hasattr(data, 'temporary_file_path'): # Django's TemporaryUploadedFile
+                return data.temporary_file_path()
+            return PdaBuffer.open(data)
+
+        if filepath and path.exists(filepath):
+            return filepath
+
+        replica = instance.get_preferred_replica()
+        if replica == None:
+            return None
+        f = replica.get_file()
+        if f == None:
+            return None
+        try:
+            head = ''
+            while len(head) < self.SNIFF_SIZE:
+                chunk = f.read(self.SNIFF_SIZE - len(head))
+                if not chunk:
+                    break
+                head += chunk
+            if self.PDA_SIGNATURE.match(head) == None:
+                return None
+            return PdaBuffer(head + f.read())
+        finally:
+            f.close()
+
+    def extractAndSave(self, instance, source):
+        """Extracts the metadata of a PDA file and saves it to the database
+        :param instance: the datafile to extract metadata from
+        :type instance: Dataset_File
+        :param source: the path of the file of the datafile, or a buffer over its content (see getSource)
+        :type source: str
+        :returns ps: the parameter set of the datafile, None if nothing was saved
+        :type ps: DatafileParameterSet
+        """
+        with self.measureSection("database"):
             # get or create the schema to hold these parameters
             schema = self.getSchema()
 
             # get or create the parameter definitions if they don't exist
             pn = self.getOrCreateParameterNames(schema, self.paramnames)
 
-            # set the metadata (a dictionary of dictionaries)
-            metadata = self.extractMetadata(filepath)
+        # set the metadata (a dictionary of dictionaries)
+        if self.sidecar:
+            metadata = {}
+            plates = self.extractPlateData(source, metadata, instance.sha512sum)
+            self.setCachedMetadata(instance.sha512sum, metadata)
+        elif not self.perDataset:
+            # identical files are only parsed once
+            metadata = self.getCachedMetadata(instance.sha512sum)
+            if metadata == None:
+                metadata = self.extractMetadata(source, instance.sha512sum)
+                self.setCachedMetadata(instance.sha512sum, metadata)
+
+        if self.perDataset:
+            datasets = list(self.iterDatasets(source, instance.sha512sum))
+            with self.measureSection("database"):
+                parameterSets = self.saveDatasetsMetadata(instance, schema, datasets)
+            ps = parameterSets[0] if parameterSets else None
+        else:
+            with self.measureSection("database"):
+                ps = self.saveFlexstationMetadata(instance, schema, metadata) # save this metadata to a file
+
+        if self.sidecar and plates:
+            self.saveSidecar(instance, metadata, plates)
 
-            self.saveFlexstationMetadata(instance, schema, metadata) # save this metadata to a file
+        return ps
 
+    @property
+    def fileMetrics(self):
+        """The time and bytes spent on each section of the file processed by the current thread, None if it isn't
+        processing a file (a filter is shared by all the threads of a process)
+        """
+        return getattr(self.local, 'fileMetrics', None)
+
+    @fileMetrics.setter
+    def fileMetrics(self, fileMetrics):
+        self.local.fileMetrics = fileMetrics
+
+    @property
+    def sectionMetrics(self):
+        """The counters the current thread records the sections into: the counters of the process, unless the
+        thread is profiling a file (see profileFile)
+        """
+        return getattr(self.local, 'sectionMetrics', None) or self.metrics
+
+    @sectionMetrics.setter
+    def sectionMetrics(self, sectionMetrics):
+        self.local.sectionMetrics = sectionMetrics
+
+    @contextmanager
+    def measureSection(self, section, f=None):
+        """Measures the time spent in a block, and the bytes of the PDA buffer consumed by it (see recordSection)
+        :param section: the name of the section (e.g. 'CSPlateData', 'header', 'database')
+        :type section: str
+        :param f: the PDA buffer read by the block
+        :type f: PdaBuffer
+        """
+        start = time.time()
+        position = f.tell() if f != None else 0
+        try:
+            yield
+        finally:
+            self.recordSection(section, time.time() - start, (f.tell() - position) if f != None else 0)
+
+    def recordSection(self, section, seconds, size):
+        """Records the time and bytes spent on a section, for the file being processed and in the counters
+        :param section: the name of the section
+        :type section: str
+        :param seconds: the time spent on the section
+        :type seconds: float
+        :param size: the number of bytes consumed
+        :type size: int
+        """
+        self.sectionMetrics.observeSection(section, seconds, size)
+        with self.fileMetricsLock:
+            if self.fileMetrics != None:
+                sectionMetrics = self.fileMetrics.setdefault(section, {'seconds': 0.0, 'bytes': 0, 'reads': 0})
+                sectionMetrics['seconds'] += seconds
+                sectionMetrics['bytes'] += size
+                sectionMetrics['reads'] += 1
+
+    def recordFailure(self, section):
+        """Records a section which couldn't be read
+        :param section: the name of the section
+        :type section: str
+        """
+        self.sectionMetrics.countFailure(section)
+        with self.fileMetricsLock:
+            if self.fileMetrics != None:
+                sectionMetrics = self.fileMetrics.setdefault(section, {'seconds': 0.0, 'bytes': 0, 'reads': 0})
+                sectionMetrics['failures'] = sectionMetrics.get('failures', 0) + 1
+
+    def profileFile(self, target, sha512sum, stages=None, spool=None, keep=None):
+        """Extracts the metadata of a file again under the profiler, and keeps the profile (sha512sum.prof, to be
+        loaded with pstats) and a report of the slowest functions and the memory used (sha512sum.txt) in the spool
+        folder. Only the last FLEXSTATION_PROFILE_KEEP files are kept, and a file is only profiled once.
+        :param target: the path, the content or a stream of the PDA file (see PdaBuffer.open)
+        :type target: str
+        :param sha512sum: the checksum of the file, naming the profile
+        :type sha512sum: str
+        :param stages: the time spent extracting and saving the metadata when the file was processed
+        :type stages: dict
+        :param spool: the folder of the profiles (default: FLEXSTATION_PROFILE_PATH)
+        :type spool: str
+        :param keep: the number of profiles kept (default: FLEXSTATION_PROFILE_KEEP)
+        :type keep: int
+        :returns profileFile: the path of the profile, None if the file was already profiled or profiling failed
+        :type profileFile: str
+        """
+        name = target if isinstance(target, basestring) and not PdaBuffer.isContent(target) else sha512sum
+        spool = spool or self.profilePath or path.join(gettempdir(), 'flexstation-profiles')
+        profileFile = path.join(spool, sha512sum + '.prof')
+        if path.exists(profileFile):
+            return None
+
+        # counters and cached metadata are left untouched, and the file is scanned again as on its first extraction
+        # (only for this thread, the other threads keep recording into the counters of the process)
+        fileMetrics = self.fileMetrics
+        self.sectionMetrics, self.fileMetrics = FlexstationMetrics(), None
+        profiler = cProfile.Profile()
+        traced = False
+        try:
+            if not path.exists(spool):
+                makedirs(spool)
+            # the allocations are only traced if no other thread is tracing them already, which would stop the
+            # tracing of this profile when done (and the other way around)
+            if tracemalloc != None:
+                with TRACEMALLOC_LOCK:
+                    if not tracemalloc.is_tracing():
+                        tracemalloc.start(25)
+                        traced = True
+            maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start = time.time()
+            profiler.runcall(self.extractMetadata, target)
+            seconds = time.time() - start
+            allocations = None
+            if traced:
+                allocations = tracemalloc.take_snapshot().statistics('lineno')[:25]
+
+            report = StringIO()
+            report.write('file: {0}\nsha512sum: {1}\n'.format(name, sha512sum))
+            for stage, stageSeconds in sorted((stages or {}).items()):
+                report.write('{0}: {1:.3f}s\n'.format(stage, stageSeconds))
+            report.write('profiled extraction: {0:.3f}s\n'.format(seconds))
+            report.write('peak memory: {0} KB (before: {1} KB)\n\n'.format(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, maxRss))
+            if allocations != None:
+                report.write('Top allocations:\n')
+                for statistic in allocations:
+                    report.write('{0}\n'.format(statistic))
+                report.write('\n')
+            elif tracemalloc != None:
+                report.write('Top allocations: not traced, the allocations were already traced by another thread\n\n')
+            pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(40)
+
+            profiler.dump_stats(profileFile + '.tmp')
+            with open(path.join(spool, sha512sum + '.txt'), 'w') as f:
+                f.write(report.getvalue())
+            rename(profileFile + '.tmp', profileFile)
         except Exception as e:
-            # if anything goes wrong, log it in tardis.log and exit
-            print(e)
-            logger.info(e)
+            logger.error('Failed to profile the extraction of {0}: {1}'.format(name, e))
             return None
+        finally:
+            if traced:
+                with TRACEMALLOC_LOCK:
+                    tracemalloc.stop()
+            self.sectionMetrics, self.fileMetrics = None, fileMetrics
+
+        logger.info('Flexstation profile of {0} saved to {1}'.format(name, profileFile))
+        self.pruneProfiles(spool, keep)
+        return profileFile
+
+    def pruneProfiles(self, spool, keep=None):
+        """Removes the oldest profiles of the spool folder, so that only FLEXSTATION_PROFILE_KEEP of them are kept
+        :param spool: the folder of the profiles
+        :type spool: str
+        :param keep: the number of profiles kept (default: FLEXSTATION_PROFILE_KEEP)
+        :type keep: int
+        """
+        keep = self.profileKeep if keep == None else keep
+        profiles = sorted((path.getmtime(path.join(spool, name)), name[:-len('.prof')])
+                          for name in listdir(spool) if name.endswith('.prof'))
+        for mtime, sha512sum in profiles[:max(len(profiles) - keep, 0)]:
+            for extension in ('.prof', '.txt'):
+                if path.exists(path.join(spool, sha512sum + extension)):
+                    remove(path.join(spool, sha512sum + extension))
+
+    def reportFile(self, instance, filepath, size, seconds, status):
+        """Logs the time and bytes spent on each section of a file as a structured record, and updates the counters
+        :param instance: the datafile processed
+        :type instance: Dataset_File
+        :param filepath: the path of the file of the datafile
+        :type filepath: str
+        :param size: the size of the file
+        :type size: int
+        :param seconds: the time spent processing the file
+        :type seconds: float
+        :param status: 'ok' or 'failed'
+        :type status: str
+        """
+        record = {'file': filepath or instance.filename, 'sha512sum': instance.sha512sum, 'size': size, 'status': status,
+                  'seconds': seconds, 'sections': self.fileMetrics or {}}
+        self.fileMetrics = None
+        logger.info('Flexstation file processed: {0}'.format(json.dumps(record, sort_keys=True)),
+                    extra={'flexstation': record})
+
+        self.metrics.observeFile(seconds, size, status)
+        if self.metricsTextfile:
+            try:
+                self.metrics.writeTextfile(self.metricsTextfile)
+            except (IOError, OSError) as e:
+                logger.error('Failed to write the Flexstation metrics to {0}: {1}'.format(self.metricsTextfile, e))
+
+    def isPdaFile(self, target):
+        """Tells whether a file is a PDA file, from the signature of the SoftMax Pro header in its first bytes
+        :param target: the path, the content or a stream of the file (see PdaBuffer.open)
+        :type target: str
+        :returns isPda: True if the file starts like a PDA file (whatever its version)
+        :type isPda: bool
+        """
+        return self.PDA_SIGNATURE.match(PdaBuffer.peek(target, self.SNIFF_SIZE)) != None
 
-    def extractMetadata(self, target):
+    def extractMetadata(self, target, sha512sum=None, parameters=None):
         """Extracts the metadata from a PDA file (binary produced by SoftMax Pro)
-        :param target: the path of the PDA file to extract metadata from
+        :param target: the path, the content or a stream of the PDA file to extract metadata from (see PdaBuffer.open)
         :type target: str
+        :param sha512sum: the checksum of the file, to reuse its persisted section index (see getSectionIndex)
+        :type sha512sum: str
+        :param parameters: the names of the parameters wanted. If given, only the sections they are read from are
+        decoded, and only these parameters are returned (all of them by default)
+        :type parameters: set
         :returns metadata: the dictionary of the extracted metadata
         :type metadata: dict
         """
         metadata = {}
+        wanted = self.getWantedSections(parameters)
 
-        with open(target, 'rb') as f:
+        with PdaBuffer.open(target) as f:
 
-            # Checks the version number, abort if different from the expected one
-            self.readStringUntilDelimiter(f)
-            f.read(1)
-            pdaVersion = self.readStringUntilDelimiter(f).strip()
-            if not pdaVersion.startswith("5."):
-                print("Unsupported PDA file version '{0}' (minimum v5). Metadata can't be extracted.".format(pdaVersion))
+            numberOfDatasets = self.readHeader(f, metadata)
+            if numberOfDatasets == None:
                 return {}
-            metadata['softmax_version'] = pdaVersion
 
-            f.seek(f.tell() + 1)
-            numberOfDatasets = self.readStringUntilDelimiter(f)
-            numberOfDatasets = int(string.strip(string.split(numberOfDatasets, "=")[1], "\r "))
-            # Read until the last occurence of the header's end delimiter
-            fileIndexSave = f.tell()
-            while self.readStringUntilStringDelimiter(f, self.HEADER_END_DELIMITER) != None:
-                fileIndexSave = f.tell()
-            f.seek(fileIndexSave)
+            for datasetMetadata in self.readDatasets(f, self.getSectionIndex(f, sha512sum)[:numberOfDatasets], wanted):
+                self.mergeDataset(metadata, datasetMetadata)
 
-            i = 0
-            while (i < numberOfDatasets):
-                self.readDataset(f, metadata)
-                i += 1
+        return self.filterParameters(metadata, parameters)
+
+    def iterDatasets(self, target, sha512sum=None, parameters=None):
+        """Extracts the metadata of each dataset (experiment) of a PDA file separately, yielding each of them as soon
+        as it is parsed. The file is closed when the iteration stops, even if the caller stops early
+        :param target: the path, the content or a stream of the PDA file to extract metadata from (see PdaBuffer.open)
+        :type target: str
+        :param sha512sum: the checksum of the file, to reuse its persisted section index (see getSectionIndex)
+        :type sha512sum: str
+        :param parameters: the names of the parameters wanted (all of them by default, see extractMetadata)
+        :type parameters: set
+        :returns metadata: for each dataset, the dictionary of its metadata (including the metadata of the header,
+        such as 'softmax_version'). Nothing if the version of the file isn't supported
+        :type metadata: generator of dict
+        """
+        wanted = self.getWantedSections(parameters)
+
+        with PdaBuffer.open(target) as f:
+
+            header = {}
+            numberOfDatasets = self.readHeader(f, header)
+            if numberOfDatasets == None:
+                return
+
+            for datasetMetadata in self.readDatasets(f, self.getSectionIndex(f, sha512sum)[:numberOfDatasets], wanted):
+                metadata = dict(header)
+                metadata.update(datasetMetadata)
+                yield self.filterParameters(metadata, parameters)
+
+    def readDatasets(self, f, datasets, wanted=None):
+        """Reads the metadata of several datasets, each one on its own cursor over the content of the file. With
+        FLEXSTATION_DATASET_THREADS above 1, the datasets are read in parallel by the pool of threads of the process,
+        sharing the (read-only) content of the file
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
+        :param datasets: the offsets of the structures of each dataset (see indexSections)
+        :type datasets: list
+        :param wanted: the names of the structures to decode (see readDataset)
+        :type wanted: set
+        :returns metadata: the metadata of each dataset, in the order of the datasets
+        :type metadata: iterator of dict
+        """
+        def readDataset(sections):
+            return self.readDataset(PdaBuffer(f.data), {}, sections=sections, wanted=wanted)
+
+        if self.datasetThreads <= 1 or len(datasets) <= 1:
+            for sections in datasets:
+                yield readDataset(sections)
+            return
+
+        fileMetrics, sectionMetrics = self.fileMetrics, self.sectionMetrics
+        def readPooledDataset(sections):
+            # the threads of the pool record the sections they read into the metrics of the file of this thread
+            self.fileMetrics, self.sectionMetrics = fileMetrics, sectionMetrics
+            try:
+                return readDataset(sections)
+            finally:
+                self.fileMetrics, self.sectionMetrics = None, None
+
+        results = get_dataset_pool(self.datasetThreads).imap(readPooledDataset, datasets)
+        try:
+            for metadata in results:
+                yield metadata
+        finally:
+            # the threads must be done with the content of the file before it is unmapped, even if the caller stops
+            for metadata in results:
+                pass
+
+    def mergeDataset(self, metadata, datasetMetadata):
+        """Merges the metadata of a dataset into the metadata of the file: the values of the last dataset win,
+        except for the analysis notes, which are appended
+        :param metadata: the metadata of the file
+        :type metadata: dict
+        :param datasetMetadata: the metadata of the dataset
+        :type datasetMetadata: dict
+        """
+        if 'analysis_notes' in metadata and 'analysis_notes' in datasetMetadata:
+            datasetMetadata = dict(datasetMetadata, analysis_notes=str.format(
+                "{0}. {1}", metadata['analysis_notes'], datasetMetadata['analysis_notes']))
+        metadata.update(datasetMetadata)
+
+    def getExtractedParameters(self):
+        """Returns the names of the parameters of the filter which the parser actually extracts (some parameters of
+        the schema aren't found in the PDA files yet, see paramnames)
+        :returns parameters: the names of the parameters, in the order of paramnames
+        :type parameters: list
+        """
+        extracted = set(self.HEADER_PARAMETERS) | set(self.PARAMETER_SECTIONS)
+        return [paramname['name'] for paramname in self.paramnames if paramname['name'] in extracted]
+
+    def getWantedSections(self, parameters):
+        """Returns the sections to decode to extract some parameters (see PARAMETER_SECTIONS)
+        :param parameters: the names of the parameters wanted, None for all of them
+        :type parameters: set
+        :returns wanted: the names of the structures to decode, None to decode all of them
+        :type wanted: set
+        """
+        if parameters == None:
+            return None
+        wanted = set()
+        for parameter in parameters:
+            wanted.update(self.PARAMETER_SECTIONS.get(parameter, ()))
+        return wanted
+
+    def isWanted(self, wanted, structureName):
+        """Tells whether a structure has to be decoded
+        :param wanted: the names of the structures to decode, None for all of them (see getWantedSections)
+        :type wanted: set
+        :param structureName: the name of the structure
+        :type structureName: str
+        :returns isWanted: True if the structure has to be decoded
+        :type isWanted: bool
+        """
+        return wanted == None or structureName in wanted
+
+    def filterParameters(self, metadata, parameters):
+        """Keeps only the wanted parameters of the metadata
+        :param metadata: the dictionary of the extracted metadata
+        :type metadata: dict
+        :param parameters: the names of the parameters wanted, None for all of them
+        :type parameters: set
+        :returns metadata: the dictionary of the wanted metadata
+        :type metadata: dict
+        """
+        if parameters == None:
+            return metadata
+        return dict((name, value) for name, value in metadata.items() if name in parameters)
+
+    def extractPlateData(self, target, metadata=None, sha512sum=None):
+        """Extracts the readings of the wells (kinetic time-series stored in the flex sites) from a PDA file
+        :param target: the path, the content or a stream of the PDA file to extract the readings from (see PdaBuffer.open)
+        :type target: str
+        :param metadata: if given, the metadata of the file is added to this dictionary on the way
+        :type metadata: dict
+        :param sha512sum: the checksum of the file, to reuse its persisted section index (see getSectionIndex)
+        :type sha512sum: str
+        :returns plates: for each plate read, a dictionary with the ids of the wells read ('well_ids', an array of
+        n wells), their readings ('values', an array of n wells x wavelengths x kinetic points), the time of each
+        reading in seconds ('read_times', same shape) and the nominal time of each kinetic point ('timestamps',
+        derived from the kinetic/flex interval)
+        :type plates: list
+        """
+        if numpy == None:
+            raise ImportError("numpy is required to extract plate data from PDA files")
+
+        if metadata == None:
+            metadata = {}
+        plates = []
+
+        with PdaBuffer.open(target) as f:
+
+            numberOfDatasets = self.readHeader(f, metadata)
+            if numberOfDatasets == None:
+                return []
+
+            for sections in self.getSectionIndex(f, sha512sum)[:numberOfDatasets]:
+                flexSites = []
+                self.readDataset(f, metadata, flexSites, sections)
+                for offset, numberOfFlexSites in flexSites:
+                    try:
+                        plates.append(self.decodeFlexSites(f, offset, numberOfFlexSites,
+                                                           metadata.get('number_of_wavelengths'),
+                                                           metadata.get('kinetic_flex_interval')))
+                    except Exception as e:
+                        print('Failed to decode flex sites from PDA file: {0}'.format(e))
+                        logger.error('Failed to decode flex sites from PDA file: {0}'.format(e))
+
+        return plates
+
+    def peekHeader(self, target, size=None):
+        """Reads the version, the number of datasets and the name of the first experiment of a PDA file, from its
+        first few KB only, to sort files out without parsing them
+        :param target: the path, the content or a stream of the PDA file to read (see PdaBuffer.open)
+        :type target: str
+        :param size: the number of bytes to read (PEEK_SIZE by default)
+        :type size: int
+        :returns metadata: 'softmax_version', 'number_of_datasets' and 'experiment_name' (if the first experiment
+        section is within the bytes read). None if the file isn't a PDA file of a supported version
+        :type metadata: dict
+        """
+        data = PdaBuffer.peek(target, size or self.PEEK_SIZE)
+        f = PdaBuffer(data)
+        metadata = {}
+        try:
+            numberOfDatasets = self.readVersionAndBlocks(f, metadata)
+        except (ValueError, IndexError):
+            return None
+        if numberOfDatasets == None:
+            return None
+        metadata['number_of_datasets'] = numberOfDatasets
+
+        offset = data.find("\x13CSExperimentSection", f.tell())
+        if offset != -1:
+            f.seek(offset)
+            experiment = self.readExperimentSection(f)
+            if experiment != None and experiment.name != None:
+                metadata['experiment_name'] = experiment.name
 
         return metadata
 
-    def readDataset(self, f, metadata):
+    def extractPlateLayout(self, target, dataset=0, sha512sum=None):
+        """Extracts the layout of the plate of a dataset: the name, row, column and plate of each of its wells
+        :param target: the path, the content or a stream of the PDA file to read (see PdaBuffer.open)
+        :type target: str
+        :param dataset: the index of the dataset
+        :type dataset: int
+        :param sha512sum: the checksum of the file, to reuse its persisted section index (see getSectionIndex)
+        :type sha512sum: str
+        :returns wells: the wells of the plate (see readWellTable). None if the dataset has no wells
+        :type wells: numpy.ndarray
+        """
+        if numpy == None:
+            raise ImportError("numpy is required to extract the layout of plates from PDA files")
+
+        with PdaBuffer.open(target) as f:
+
+            if self.readHeader(f, {}) == None:
+                return None
+
+            datasets = self.getSectionIndex(f, sha512sum)
+            if dataset >= len(datasets) or "CSWell" not in datasets[dataset]:
+                return None
+
+            f.seek(datasets[dataset]["CSWell"][0] - 4) # the wells are preceded by their number
+            return self.readWellTable(f)
+
+    def extractSection(self, target, structureName, dataset=0, occurence=0):
+        """Reads a single structure of a PDA file, jumping straight to it instead of parsing everything before it
+        :param target: the path, the content or a stream of the PDA file to read (see PdaBuffer.open)
+        :type target: str
+        :param structureName: the name of the structure to read (e.g. 'CSCalcPlateBody')
+        :type structureName: str
+        :param dataset: the index of the dataset the structure belongs to
+        :type dataset: int
+        :param occurence: the index of the structure to read, when it appears several times in the dataset
+        :type occurence: int
+        :returns result: what the section reader returns (see readSection). None if the structure isn't in the file
+        """
+        with PdaBuffer.open(target) as f:
+
+            if self.readHeader(f, {}) == None:
+                return None
+
+            datasets = self.indexSections(f, f.tell())
+            if dataset >= len(datasets):
+                return None
+
+            return self.readSection(f, datasets[dataset], structureName, occurence)
+
+    def readHeader(self, f, metadata):
+        """Reads the header of a PDA file, and moves to the first dataset
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
+        :param metadata: the dictionary to add metadata into
+        :type metadata: dict
+        :returns numberOfDatasets: the number of datasets in the file. None if the version of the file isn't supported
+        :type numberOfDatasets: int
+        """
+        with self.measureSection("header", f):
+            numberOfDatasets = self.readVersionAndBlocks(f, metadata)
+            if numberOfDatasets == None:
+                return None
+
+            # Read until the last occurence of the header's end delimiter
+            self.skipToLastStringDelimiter(f, self.HEADER_END_DELIMITER)
+
+        return numberOfDatasets
+
+    def readVersionAndBlocks(self, f, metadata):
+        """Reads the version of SoftMax Pro and the number of datasets at the beginning of a PDA file
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
+        :param metadata: the dictionary to add metadata into
+        :type metadata: dict
+        :returns numberOfDatasets: the number of datasets in the file. None if the version of the file isn't supported
+        :type numberOfDatasets: int
+        """
+        # Checks the version number, abort if different from the expected one
+        self.readStringUntilDelimiter(f)
+        f.read(1)
+        pdaVersion = (self.readStringUntilDelimiter(f) or '').strip()
+        if not pdaVersion.startswith("5."):
+            print("Unsupported PDA file version '{0}' (minimum v5). Metadata can't be extracted.".format(pdaVersion))
+            return None
+        metadata['softmax_version'] = pdaVersion
+
+        f.seek(f.tell() + 1)
+        numberOfDatasets = self.readStringUntilDelimiter(f)
+        if numberOfDatasets == None or "=" not in numberOfDatasets: # the header is truncated
+            return None
+        numberOfDatasets = int(string.strip(string.split(numberOfDatasets, "=")[1], "\r "))
+
+        return numberOfDatasets
+
+    def readDataset(self, f, metadata, flexSites=None, sections=None, wanted=None):
         """Extracts the metadata from a PDA file (binary produced by SoftMax Pro)
-        :param f: the opened PDA file to read
-        :type f: file
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
         :param metadata: the dictionary to add metadata into
         :type metadata: dict
+        :param flexSites: if given, the offset and number of the flex sites read are appended to this list
+        :type flexSites: list
+        :param sections: the offsets of the structures of the dataset (see indexSections). If not given, the dataset
+        starting at the current position is indexed first
+        :type sections: dict
+        :param wanted: the names of the structures to decode, the others are skipped (see getWantedSections). All of
+        them are decoded if not given, including the ones holding no metadata, to check the file is consistent
+        :type wanted: set
         :returns metadata: the dictionary of the extracted metadata
         :type metadataa: dict
         """
+        if sections == None:
+            datasets = self.indexSections(f, f.tell())
+            sections = datasets[0] if datasets else {}
 
         # Experiment Name
-        try:
-            experimentName = self.readExperimentSection(f)
-            if experimentName != None:
-                metadata['experiment_name'] = experimentName
-            else:
-                raise error
-        except:
-            print('Failed to extract experiment name from PDA file.')
-            logger.error('Failed to extract experiment name from PDA file.')
-
-        fileIndexSave = f.tell()
-        while (1 == 1):
-            f.seek(f.tell() + 4) # skip a 4-bytes number
-            tmplGroupTitle = self.readTmplGroup(f)
-            if (tmplGroupTitle != None):
-                fileIndexSave = f.tell()
-            else:
-                f.seek(fileIndexSave)
-                f.seek(f.tell() + 4) # skip a 4-bytes number
-                tmplSampleTitle = self.readTmplSample(f)
-                if (tmplSampleTitle != None):
-                    fileIndexSave = f.tell()
+        if self.isWanted(wanted, "CSExperimentSection"):
+            try:
+                experiment = self.readSection(f, sections, "CSExperimentSection")
+                if experiment != None and experiment.name != None:
+                    metadata['experiment_name'] = experiment.name
                 else:
-                    f.seek(fileIndexSave)
-                    numberHex = binascii.hexlify(f.read(4))
-                    number = int(numberHex, 16)
-                    if (number != 0):
-                        f.seek(fileIndexSave)
-                    if ('analysis_notes' not in metadata):
-                        f.seek(f.tell() + 4) # skips 4 bytes on the 1st occurence of an analysis section
-                    analysisName, analysisContent = self.readAnalysisSection(f)
-                    if (analysisName == None or analysisContent == None):
-                        f.seek(fileIndexSave)
-                        break
-                    elif analysisContent:
-                        fileIndexSave = f.tell()
-                        if ('analysis_notes' in metadata):
-                            metadata['analysis_notes'] = str.format("{0}. {1}: {2}", metadata['analysis_notes'], \
-                                                                    analysisName, analysisContent)
-                        else:
-                            metadata['analysis_notes'] = str.format("{0}: {1}", analysisName, analysisContent)
+                    raise error
+            except:
+                self.recordFailure("CSExperimentSection")
+                print('Failed to extract experiment name from PDA file.')
+                logger.error('Failed to extract experiment name from PDA file.')
+
+        # Analysis Sections (the template groups and samples around them hold no metadata)
+        if self.isWanted(wanted, "CSAnalysisSection"):
+            i = 0
+            while (i < len(sections.get("CSAnalysisSection", []))):
+                analysisName, analysisContent = self.readSection(f, sections, "CSAnalysisSection", i)
+                if analysisContent:
+                    if ('analysis_notes' in metadata):
+                        metadata['analysis_notes'] = str.format("{0}. {1}: {2}", metadata['analysis_notes'], \
+                                                                analysisName, analysisContent)
+                    else:
+                        metadata['analysis_notes'] = str.format("{0}: {1}", analysisName, analysisContent)
+                i += 1
 
         # Number of Wells
-        try:
-            fileIndexSave = f.tell()
-            numberOfWells = self.readWells(f)
-            if (numberOfWells):
-                metadata['number_of_wells_or_cuvette'] = numberOfWells
-        except:
-            f.seek(fileIndexSave)
-            print('Failed to extract number of wells or cuvettes from PDA file.')
-            logger.error('Failed to extract number of wells or cuvettes from PDA file.')
-
-        fileIndexSave = f.tell()
-        while (1 == 1):
-            self.skipIfNumber(f, [0, 1, 2])
-            tmplGroupTitle = self.readTmplGroup(f)
-            if (tmplGroupTitle != None):
-                fileIndexSave = f.tell()
-            else:
-                f.seek(fileIndexSave)
-                self.skipIfNumber(f, [0, 1, 2])
-                tmplSampleTitle = self.readTmplSample(f)
-                if (tmplSampleTitle != None):
-                    fileIndexSave = f.tell()
-                else:
-                    f.seek(fileIndexSave)
-                    self.skipIfNumber(f, [0, 2])
-                    #if ('analysis_notes' not in metadata):
-                        #f.seek(f.tell() + 4) # skips 8 bytes on the 1st occurence of an analysis section
-                    analysisName, analysisContent = self.readAnalysisSection(f)
-                    if (analysisName == None or analysisContent == None):
-                        f.seek(fileIndexSave)
-                        break
-                    fileIndexSave = f.tell()
-                    if analysisContent:
-                        if ('analysis_notes' in metadata):
-                            metadata['analysis_notes'] = str.format("{0}. {1}: {2}", metadata['analysis_notes'], \
-                                                                    analysisName, analysisContent)
-                        else:
-                            metadata['analysis_notes'] = str.format("{0}: {1}", analysisName, analysisContent)
+        if self.isWanted(wanted, "CSWell"):
+            try:
+                f.seek(sections["CSWell"][0] - 4) # the wells are preceded by their number
+                with self.measureSection("CSWell", f):
+                    numberOfWells = self.readWells(f)
+                if (numberOfWells):
+                    metadata['number_of_wells_or_cuvette'] = numberOfWells
+            except:
+                self.recordFailure("CSWell")
+                print('Failed to extract number of wells or cuvettes from PDA file.')
+                logger.error('Failed to extract number of wells or cuvettes from PDA file.')
 
         # Plate Section
-        try:
-            self.skipIfNumber(f, [0])
-            self.skipIfNumber(f, [6])
-            fileIndexSave = f.tell()
-            plateName = self.readPlateSection(f)
-            if (plateName == None):
-                raise error
-        except:
-            f.seek(fileIndexSave)
-            print('Failed to read plate section from PDA file.')
-            logger.error('Failed to read plate section from PDA file.')
+        if wanted == None: # holds no metadata, only read to check the file
+            try:
+                plateName = self.readSection(f, sections, "CSPlateSection")
+                if (plateName == None):
+                    raise error
+            except:
+                self.recordFailure("CSPlateSection")
+                print('Failed to read plate section from PDA file.')
+                logger.error('Failed to read plate section from PDA file.')
 
         # Plate Data
         numberOfColumns = 0
-        try:
-            fileIndexSave = f.tell()
-            firstReadColumn, numberOfColumns, readNumber, wavelengthsNumber, emValues, readDuration, readInterval, exValues, trans = self.readPlateData(f)
-            if numberOfColumns > 1:
-                metadata['strips'] = str.format("{0}-{1}", firstReadColumn, firstReadColumn + numberOfColumns - 1)
-            else:
-                metadata['strips'] = str.format("{0}", firstReadColumn)
-            if (wavelengthsNumber):
-                metadata['number_of_wavelengths'] = wavelengthsNumber
-            if (readNumber):
-                metadata['kinetic_points'] = readNumber
-            if (readDuration):
-                metadata['kinetic_flex_read_time'] = readDuration
-            if (readInterval):
-                metadata['kinetic_flex_interval'] = readInterval
-            # TODO: alternate these in function of the read type
-            #metadata['well_scan_read_pattern'] = ''
-            #metadata['well_scan_density'] = ''
-            if (emValues):
-                metadata['read_wavelength'] = emValues
-            if (exValues):
-                metadata['excitation_wavelengths'] = exValues
-            if (trans):
-                metadata['trans'] = trans
-        except:
-            f.seek(fileIndexSave)
-            print('Failed to extract plate data from PDA file.')
-            logger.error('Failed to extract plate data from PDA file.')
+        if self.isWanted(wanted, "CSPlateData") or flexSites != None: # the flex sites depend on it
+            try:
+                plateData = self.readSection(f, sections, "CSPlateData")
+                numberOfColumns = plateData.numberOfColumns
+                if numberOfColumns > 1:
+                    metadata['strips'] = str.format("{0}-{1}", plateData.firstReadColumn,
+                                                    plateData.firstReadColumn + numberOfColumns - 1)
+                else:
+                    metadata['strips'] = str.format("{0}", plateData.firstReadColumn)
+                if (plateData.wavelengthsNumber):
+                    metadata['number_of_wavelengths'] = plateData.wavelengthsNumber
+                if (plateData.readNumber):
+                    metadata['kinetic_points'] = plateData.readNumber
+                if (plateData.readDuration):
+                    metadata['kinetic_flex_read_time'] = plateData.readDuration
+                if (plateData.readInterval):
+                    metadata['kinetic_flex_interval'] = plateData.readInterval
+                # TODO: alternate these in function of the read type
+                #metadata['well_scan_read_pattern'] = ''
+                #metadata['well_scan_density'] = ''
+                if (plateData.emWavelengths):
+                    metadata['read_wavelength'] = plateData.emValues
+                if (plateData.exWavelengths):
+                    metadata['excitation_wavelengths'] = plateData.exValues
+                if (plateData.transValues):
+                    metadata['trans'] = plateData.trans
+            except:
+                numberOfColumns = 0
+                self.recordFailure("CSPlateData")
+                print('Failed to extract plate data from PDA file.')
+                logger.error('Failed to extract plate data from PDA file.')
 
         # Plate Descriptor
-        try:
-            fileIndexSave = f.tell()
-            numberOfPlates = self.readPlateDescriptor(f)
-            if (numberOfPlates == None):
-                raise error
-        except:
-            f.seek(fileIndexSave)
-            print('Failed to read plate descriptor from PDA file.')
-            logger.error('Failed to read plate descriptor from PDA file.')
+        if wanted == None: # holds no metadata, only read to check the file
+            try:
+                plateDescriptor = self.readSection(f, sections, "CSPlateDescriptor")
+                if (plateDescriptor == None):
+                    raise error
+            except:
+                self.recordFailure("CSPlateDescriptor")
+                print('Failed to read plate descriptor from PDA file.')
+                logger.error('Failed to read plate descriptor from PDA file.')
 
         # Flex Sites (Actual Data)
-        try:
-            fileIndexSave = f.tell()
-            numberOfFlexSites = self.readFlexSites(f, numberOfColumns)
-            if (numberOfFlexSites == None or numberOfFlexSites == 0):
-                raise error
-        except:
-            f.seek(fileIndexSave)
-            print('Failed to read flex sites from PDA file.')
-            logger.error('Failed to read flex sites from PDA file.')
+        if wanted == None or flexSites != None: # hold no metadata, only read to check the file or locate the readings
+            try:
+                fileIndexSave = sections["CSFlexSite"][0]
+                f.seek(fileIndexSave)
+                with self.measureSection("CSFlexSite", f):
+                    numberOfFlexSites = self.readFlexSites(f, numberOfColumns)
+                if (numberOfFlexSites == None or numberOfFlexSites == 0):
+                    raise error
+                if flexSites != None:
+                    flexSites.append((fileIndexSave, numberOfFlexSites))
+            except:
+                self.recordFailure("CSFlexSite")
+                print('Failed to read flex sites from PDA file.')
+                logger.error('Failed to read flex sites from PDA file.')
 
         # Plate Body
-        try:
-            fileIndexSave = f.tell()
-            wavelength, wavelengthCombination, formula, unknown, instrumentInfos = self.readCalcPlateBody(f)
-            if (wavelengthCombination):
-               metadata['wavelength_combination'] = wavelengthCombination
-               if (instrumentInfos):
-                   metadata['instrument_info'] = instrumentInfos
-        except:
-            f.seek(fileIndexSave)
-            print('Failed to read plate body from PDA file.')
-            logger.error('Failed to read plate body from PDA file.')
+        if self.isWanted(wanted, "CSCalcPlateBody"):
+            try:
+                calcPlateBody = self.readSection(f, sections, "CSCalcPlateBody")
+                if (calcPlateBody.wavelengthCombination):
+                   metadata['wavelength_combination'] = calcPlateBody.wavelengthCombination
+                   if (calcPlateBody.instrumentInfos):
+                       metadata['instrument_info'] = calcPlateBody.instrumentInfos
+            except:
+                self.recordFailure("CSCalcPlateBody")
+                print('Failed to read plate body from PDA file.')
+                logger.error('Failed to read plate body from PDA file.')
 
 
         # TODO: find and extract these metadata
@@ -360,12 +1506,211 @@ class FlexstationFilter(object):
 
         return metadata
 
+    def indexSections(self, f, start=0):
+        """Finds all the structures of a PDA file in a single pass, by searching for their length-prefixed names
+        :param f: the opened PDA file or PDA buffer to index
+        :type f: file
+        :param start: the offset to start indexing from (typically the end of the header)
+        :type start: int
+        :returns datasets: for each dataset (starting at its 'ExperimentSection'), a dictionary of the offsets of
+        each structure, keyed by structure name (e.g. {'CSPlateData': [6434], 'CSFlexSite': [8056, 10179, ...]})
+        :type datasets: list
+        """
+        if isinstance(f, PdaBuffer):
+            data, offset = f.data, 0
+        else:
+            fileIndexSave = f.tell()
+            f.seek(start)
+            data, offset = f.read(), start
+            f.seek(fileIndexSave)
+
+        datasets = []
+        sections = None
+        match = self.STRUCTURE_NAME_PATTERN.search(data, start - offset)
+        while match:
+            index = match.start()
+            nameLength = ord(data[index - 1]) if index > start - offset else 0
+            structureName = data[index:index + nameLength]
+            if nameLength < 3 or len(structureName) != nameLength or not structureName.isalpha():
+                match = self.STRUCTURE_NAME_PATTERN.search(data, index + 1)
+                continue
+
+            if structureName == "CSExperimentSection":
+                sections = {}
+                datasets.append(sections)
+            if sections != None:
+                sections.setdefault(structureName, []).append(offset + index - 1)
+
+            index += nameLength
+            if structureName == "CSFlexSite" and index + 16 <= len(data):
+                # skips the data chunks, so that their content can't be mistaken for a structure name
+                dataChunkNumber, readNumber, id, dataChunkLength = FLEX_SITE_HEADER.unpack_from(data, index)
+                if index + 16 + dataChunkNumber * dataChunkLength <= len(data):
+                    index += 16 + dataChunkNumber * dataChunkLength
+            match = self.STRUCTURE_NAME_PATTERN.search(data, index)
+
+        return datasets
+
+    def getSectionIndex(self, f, sha512sum=None):
+        """Returns the section index of the datasets starting at the current position, reading it from the index
+        persisted for a file with the same checksum when there is one, and persisting it otherwise
+        :param f: the PDA buffer to index, positioned at the end of the header
+        :type f: PdaBuffer
+        :param sha512sum: the checksum of the file (the index isn't persisted if not given)
+        :type sha512sum: str
+        :returns datasets: the offsets of the structures of each dataset (see indexSections)
+        :type datasets: list
+        """
+        start = time.time()
+        datasets = self.loadSectionIndex(sha512sum)
+        if datasets == None:
+            datasets = self.indexSections(f, f.tell())
+            self.saveSectionIndex(sha512sum, datasets, f.size)
+        self.recordSection("index", time.time() - start, f.size - f.tell())
+        return datasets
+
+    def getSectionIndexPath(self, sha512sum):
+        """Returns the path of the section index persisted for a file, None if the indexes aren't persisted
+        :param sha512sum: the checksum of the file
+        :type sha512sum: str
+        :returns indexPath: the path of the index file (in a sub-folder named after the first 2 digits of the checksum)
+        :type indexPath: str
+        """
+        if not self.indexPath or not sha512sum:
+            return None
+        return path.join(self.indexPath, sha512sum[:2], sha512sum + self.INDEX_EXTENSION)
+
+    def loadSectionIndex(self, sha512sum):
+        """Loads the section index persisted for a file
+        :param sha512sum: the checksum of the file
+        :type sha512sum: str
+        :returns datasets: the offsets of the structures of each dataset (see indexSections). None if there is no
+        index for this file, or if it can't be read
+        :type datasets: list
+        """
+        indexFile = self.getSectionIndexPath(sha512sum)
+        if indexFile == None or not path.exists(indexFile):
+            return None
+        try:
+            with open(indexFile, 'rb') as f:
+                return self.decodeSectionIndex(f.read())
+        except (IOError, ValueError, IndexError, error) as e:
+            logger.error('Failed to load the section index {0}: {1}'.format(indexFile, e))
+            return None
+
+    def saveSectionIndex(self, sha512sum, datasets, size):
+        """Persists the section index of a file, keyed by its checksum
+        :param sha512sum: the checksum of the file
+        :type sha512sum: str
+        :param datasets: the offsets of the structures of each dataset (see indexSections)
+        :type datasets: list
+        :param size: the size of the file, which ends the last structure
+        :type size: int
+        """
+        indexFile = self.getSectionIndexPath(sha512sum)
+        if indexFile == None:
+            return
+        try:
+            if not path.isdir(path.dirname(indexFile)):
+                makedirs(path.dirname(indexFile))
+            # written aside then renamed, so that concurrent readers never see a partial index
+            with open(indexFile + '.tmp', 'wb') as f:
+                f.write(self.encodeSectionIndex(datasets, size))
+            rename(indexFile + '.tmp', indexFile)
+        except (IOError, OSError) as e:
+            logger.error('Failed to save the section index {0}: {1}'.format(indexFile, e))
+
+    def encodeSectionIndex(self, datasets, size):
+        """Encodes a section index in a compact binary format: a header, the table of the structure names, then for
+        each dataset the number of its structures followed by their name, offset and length, by increasing offset
+        :param datasets: the offsets of the structures of each dataset (see indexSections)
+        :type datasets: list
+        :param size: the size of the file, which ends the last structure
+        :type size: int
+        :returns data: the encoded index
+        :type data: str
+        """
+        names = sorted(set(structureName for sections in datasets for structureName in sections))
+        nameIds = dict((structureName, i) for i, structureName in enumerate(names))
+
+        data = [self.INDEX_HEADER_FORMAT.pack(self.INDEX_MAGIC, self.INDEX_VERSION, len(datasets)),
+                pack(">B", len(names))]
+        data.extend(pack(">B", len(structureName)) + structureName for structureName in names)
+
+        structures = sorted((offset, structureName) for sections in datasets
+                            for structureName, offsets in sections.items() for offset in offsets)
+        ends = dict(izip_longest((offset for offset, structureName in structures),
+                                 (offset for offset, structureName in structures[1:]), fillvalue=size))
+        for sections in datasets:
+            entries = sorted((offset, structureName) for structureName, offsets in sections.items()
+                             for offset in offsets)
+            data.append(self.INDEX_COUNT_FORMAT.pack(len(entries)))
+            data.extend(self.INDEX_ENTRY_FORMAT.pack(nameIds[structureName], offset, ends[offset] - offset)
+                        for offset, structureName in entries)
+
+        return ''.join(data)
+
+    def decodeSectionIndex(self, data):
+        """Decodes a section index encoded by encodeSectionIndex
+        :param data: the encoded index
+        :type data: str
+        :returns datasets: the offsets of the structures of each dataset (see indexSections)
+        :type datasets: list
+        """
+        magic, version, numberOfDatasets = self.INDEX_HEADER_FORMAT.unpack_from(data)
+        if magic != self.INDEX_MAGIC or version != self.INDEX_VERSION:
+            raise ValueError("Unsupported section index (version {0})".format(version))
+        pos = self.INDEX_HEADER_FORMAT.size
+
+        names = []
+        numberOfNames = ord(data[pos])
+        pos += 1
+        while len(names) < numberOfNames:
+            nameLength = ord(data[pos])
+            names.append(data[pos + 1:pos + 1 + nameLength])
+            pos += 1 + nameLength
+
+        datasets = []
+        while len(datasets) < numberOfDatasets:
+            numberOfEntries = self.INDEX_COUNT_FORMAT.unpack_from(data, pos)[0]
+            pos += self.INDEX_COUNT_FORMAT.size
+            sections = {}
+            i = 0
+            while i < numberOfEntries:
+                nameId, offset, length = self.INDEX_ENTRY_FORMAT.unpack_from(data, pos)
+                sections.setdefault(names[nameId], []).append(offset)
+                pos += self.INDEX_ENTRY_FORMAT.size
+                i += 1
+            datasets.append(sections)
+
+        return datasets
+
+    def readSection(self, f, sections, structureName, occurence=0):
+        """Reads a structure directly from its offset in the index of a dataset, with its section reader
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
+        :param sections: the offsets of the structures of the dataset (see indexSections)
+        :type sections: dict
+        :param structureName: the name of the structure to read (e.g. 'CSCalcPlateBody')
+        :type structureName: str
+        :param occurence: the index of the structure to read, when it appears several times in the dataset
+        :type occurence: int
+        :returns result: what the section reader returns. None if the structure isn't in the dataset
+        """
+        offsets = sections.get(structureName, [])
+        if occurence >= len(offsets) or structureName not in self.SECTION_READERS:
+            return None
+
+        f.seek(offsets[occurence])
+        with self.measureSection(structureName, f):
+            return getattr(self, self.SECTION_READERS[structureName])(f)
+
     def readExperimentSection(self, f):
         """Reads an 'ExperimentSection' structure
-        :param f: the opened PDA file to read
-        :type f: file
-        :returns experimentName: the name of the experiment section
-        :type experimentName: str
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
+        :returns experiment: the experiment section
+        :type experiment: Experiment
         """
         structureName = self.readStructureName(f)
         if structureName != "CSExperimentSection":
@@ -377,12 +1722,12 @@ class FlexstationFilter(object):
         #structure = binascii.hexlify(f.read(1))
         #experimentName, serialnum, school, gradelevel = unpack('<10sHHb', record)
 
-        return (experimentName)
+        return Experiment(experimentName)
 
     def readTmplGroup(self, f):
         """Reads a 'TmplGroup' structure
-        :param f: the opened PDA file to read
-        :type f: file
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
         :returns tmplGroupTitle: the template group title
         :type tmplGroupTitle: str
         """
@@ -402,8 +1747,8 @@ class FlexstationFilter(object):
 
     def readTmplSample(self, f):
         """Reads a 'TmplSample' structure
-        :param f: the opened PDA file to read
-        :type f: file
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
         :returns tmplSampleTitle: the template sample title
         :type tmplSampleTitle: str
         """
@@ -419,8 +1764,8 @@ class FlexstationFilter(object):
 
     def readAnalysisSection(self, f):
         """Reads a 'AnalysisSection' structure
-        :param f: the opened PDA file to read
-        :type f: file
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
         :returns analysisName: the name of the analysis section
         :type analysisName: str
         :returns analysisContent: the content of the analysis section
@@ -437,39 +1782,77 @@ class FlexstationFilter(object):
         analysisContent = self.readStringWithLengthPrefix(f, 4)
 
         #f.seek(f.tell() + 58)
-        delimiter = ""
-        i = 0
-        while (i < 32):
-            delimiter = delimiter + "\xFF"
-            i += 1
-        self.readStringUntilStringDelimiter(f, delimiter)
+        self.readStringUntilStringDelimiter(f, self.ANALYSIS_END_DELIMITER)
 
         return (analysisName, analysisContent)
 
     def readWells(self, f):
         """Reads several 'Well' structures, based on the number of wells
-        :param f: the opened PDA file to read
-        :type f: file
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
         :returns numberOfWells: the number of wells read
         :type numberOfWells: int
         """
 
-        numberOfWellsHex = binascii.hexlify(f.read(4))
-        numberOfWells = int(numberOfWellsHex, 16)
+        numberOfWells = f.readUInt(4)
         if (numberOfWells == None):
             return (None)
 
-        i = 0;
-        while i < numberOfWells:
-            wellName, rowNumber, columnNumber, plateNumber = self.readWell(f)
-            i += 1
+        self.scanWells(f, numberOfWells)
 
         return (numberOfWells)
 
+    def scanWells(self, f, numberOfWells):
+        """Reads consecutive 'Well' structures at once, with a single regular expression pass over the buffer
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
+        :param numberOfWells: the number of wells to read
+        :type numberOfWells: int
+        :returns wellNames: the names of the wells
+        :type wellNames: list
+        :returns rowNumbers: the number of the row where each well is located
+        :type rowNumbers: tuple
+        :returns columnNumbers: the number of the column where each well is located
+        :type columnNumbers: tuple
+        :returns plateNames: the name of the plate where each well is located
+        :type plateNames: list
+        """
+        end = WELLS_PATTERN.match(f.data, f.tell()).end()
+        wells = WELL_PATTERN.findall(f.data, f.tell(), end)[:numberOfWells]
+        if len(wells) < numberOfWells:
+            raise error("Only {0} wells out of {1} could be read".format(len(wells), numberOfWells))
+
+        wellNames, rowNumbers, columnNumbers, plateNames = zip(*wells) if wells else ((), (), (), ())
+        f.seek(f.tell() + WELL_FIXED_SIZE * numberOfWells + sum(imap(len, wellNames)) + sum(imap(len, plateNames)))
+
+        rowNumbers = unpack(">{0}H".format(numberOfWells), "".join(rowNumbers))
+        columnNumbers = unpack(">{0}H".format(numberOfWells), "".join(columnNumbers))
+        return (list(wellNames), rowNumbers, columnNumbers, list(plateNames))
+
+    def readWellTable(self, f):
+        """Reads the table of the wells (their number followed by their 'Well' structures) as a NumPy array
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
+        :returns wells: the name, row and column numbers, and plate name of each well
+        :type wells: numpy.ndarray with fields 'name', 'row', 'column' and 'plate'
+        """
+        numberOfWells = f.readUInt(4)
+        wellNames, rowNumbers, columnNumbers, plateNames = self.scanWells(f, numberOfWells)
+
+        wellNames = numpy.array(wellNames, dtype=str)
+        plateNames = numpy.array(plateNames, dtype=str)
+        wells = numpy.zeros(numberOfWells, dtype=[('name', wellNames.dtype), ('row', 'u2'), ('column', 'u2'),
+                                                  ('plate', plateNames.dtype)])
+        wells['name'] = wellNames
+        wells['row'] = rowNumbers
+        wells['column'] = columnNumbers
+        wells['plate'] = plateNames
+        return wells
+
     def readWell(self, f):
         """Reads a 'Well' structure
-        :param f: the opened PDA file to read
-        :type f: file
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
         :returns wellName: the name of the well
         :type wellName: str
         :returns rowNumber: the number of the row where this well is located
@@ -484,11 +1867,7 @@ class FlexstationFilter(object):
             return
 
         wellName = self.readStringUntilDelimiter(f)
-        hex = binascii.hexlify(f.read(2))
-        rowNumber = int(hex, 16)
-        hex = binascii.hexlify(f.read(2))
-        columnNumber = int(hex, 16)
-        f.seek(f.tell() + 6) # skip 2 + 2 + 2
+        rowNumber, columnNumber = f.readRecord(WELL_POSITION)
         plateNumber = self.readStringUntilDelimiter(f)
         f.seek(f.tell() + 4) # skip 4
 
@@ -496,8 +1875,8 @@ class FlexstationFilter(object):
 
     def readPlateSection(self, f):
         """Reads a 'PlateSection' structure
-        :param f: the opened PDA file to read
-        :type f: file
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
         :returns plateName: the name of the plate section
         :type plateName: string
         """
@@ -512,140 +1891,61 @@ class FlexstationFilter(object):
 
     def readPlateData(self, f):
         """Reads a 'PlateData' structure
-        :param f: the opened PDA file to read
-        :type f: file
-        :returns firstReadColumn: the first column of wells read
-        :type firstReadColumn: int
-        :returns numberOfColumns: the number of columns read (counting from the first column read)
-        :type numberOfColumns: int
-        :returns readNumber: the number of reads
-        :type readNumber: int
-        :returns wavelengthsNumber: the number of wavelengths
-        :type wavelengthsNumber: int
-        :returns emValues: the values of the different wavelengths, separated by spaces
-        :type emValues: str
-        :returns readDuration: the duration of the read
-        :type readDuration: int
-        :returns readInterval: the interval between each read
-        :type readInterval: int
-        :returns exValues: the values of the excitation wavelengths, separated by spaces
-        :type exValues: str
-        :returns trans: the values of trans, formatted as 'H={0}µ, R={1}, V={2}µ, @{3}'
-        :type trans: str
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
+        :returns plateData: the first column read, the number of columns read (counting from the first column read),
+        the number of reads, the number of wavelengths, the emission wavelengths, the duration of the read, the
+        interval between each read, the excitation wavelengths and the trans values (R, @, V, H) of each wavelength
+        :type plateData: PlateData
         """
         structureName = self.readStructureName(f)
         if structureName != "CSPlateData":
             return
 
-        f.seek(f.tell() + 6)
-
-        firstReadColumnHex = binascii.hexlify(f.read(2))
-        firstReadColumn = int(firstReadColumnHex, 16)
-        numberOfColumnsHex = binascii.hexlify(f.read(2))
-        numberOfColumns = int(numberOfColumnsHex, 16)
-
-        readNumberHex = binascii.hexlify(f.read(4))
-        readNumber = int(readNumberHex, 16)
-
-        wavelengthsNumberHex = binascii.hexlify(f.read(4))
-        wavelengthsNumber = int(wavelengthsNumberHex, 16)
-
-        i = 0
-        emValues = None
-        while (i < wavelengthsNumber):
-            emWaveValueHex = binascii.hexlify(f.read(4))
-            emWaveValue = int(emWaveValueHex, 16)
-            f.seek(f.tell() + 1)
-            if (emValues != None):
-                emValues = str.format("{0} {1}", emValues, emWaveValue)
-            else:
-                emValues = str.format("{0}", emWaveValue)
-            i += 1
-
-        f.seek(f.tell() + 4)
-
-        readDurationHex = binascii.hexlify(f.read(8))
-        readDuration = unpack('!d', readDurationHex.decode('hex'))[0]
-
-        readIntervalHex = binascii.hexlify(f.read(8))
-        readInterval = unpack('!d', readIntervalHex.decode('hex'))[0]
-
-        f.seek(f.tell() + 170)
-
-        i = 0
-        exValues = None
-        while (i < wavelengthsNumber):
-            exWaveValueHex = binascii.hexlify(f.read(4))
-            exWaveValue = int(exWaveValueHex, 16)
-            f.seek(f.tell() + 4)
-            if (exValues != None):
-                exValues = str.format("{0} {1}", exValues, exWaveValue)
-            else:
-                exValues = str.format("{0}", exWaveValue)
-            i += 1
+        firstReadColumn, numberOfColumns, readNumber, wavelengthsNumber = f.readRecord(PLATE_DATA_HEADER)
+        emWavelengths = tuple(emWaveValue for emWaveValue, in f.readRecords(EM_WAVELENGTH, wavelengthsNumber))
+        readDuration, readInterval = f.readRecord(READ_TIMING)
+        exWavelengths = tuple(exWaveValue for exWaveValue, in f.readRecords(EX_WAVELENGTH, wavelengthsNumber))
 
         f.seek(f.tell() + 659)
 
-        i = 0
-        trans = None
-        while (i < wavelengthsNumber):
-            transRHex = binascii.hexlify(f.read(4))
-            transR = int(transRHex, 16)
-            transAtHex = binascii.hexlify(f.read(4))
-            transAt = int(transAtHex, 16)
-            transVHex = binascii.hexlify(f.read(8))
-            transV = unpack('!d', transVHex.decode('hex'))[0]
-            transHHex = binascii.hexlify(f.read(4))
-            transH = int(transHHex, 16)
-            f.seek(f.tell() + 16)
-            formattedTrans = str.format("Trans{0}: H={1}\xb5, R={2}, V={3}\xb5, \x40{4}", (i + 1), transH, transR, transV, transAt)
-            if (trans != None):
-                trans = str.format("{0}. {1}", trans, formattedTrans)
-            else:
-                trans = str.format("{0}", formattedTrans)
-            i += 1
+        transValues = tuple(f.readRecords(TRANS, wavelengthsNumber))
 
         f.seek(f.tell() + 75)
 
-        return (firstReadColumn, numberOfColumns, readNumber, wavelengthsNumber, emValues, readDuration, readInterval, exValues, trans)
+        return PlateData(firstReadColumn, numberOfColumns, readNumber, wavelengthsNumber, emWavelengths,
+                         readDuration, readInterval, exWavelengths, transValues)
 
     def readPlateDescriptor(self, f):
         """Reads a 'PlateDescriptor' structure
-        :param f: the opened PDA file to read
-        :type f: file
-        :returns numberOfPlates: the number of plates
-        :type numberOfPlates: int
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
+        :returns plateDescriptor: the number of plates and the temperature of each plate
+        :type plateDescriptor: PlateDescriptor
         """
         structureName = self.readStructureName(f)
         if structureName != "CSPlateDescriptor":
             return (None)
 
         f.seek(f.tell() + 1)
-        numberOfPlatesHex = binascii.hexlify(f.read(4))
-        numberOfPlates = int(numberOfPlatesHex, 16)
-
-        i = 0;
-        while i < numberOfPlates:
-            f.seek(f.tell() + 4)
-            temperatureHex = binascii.hexlify(f.read(4))
-            temperature = unpack('!f', temperatureHex.decode('hex'))[0]
-            i += 1
+        numberOfPlates = f.readUInt(4)
+        temperatures = tuple(temperature for temperature, in f.readRecords(PLATE_TEMPERATURE, numberOfPlates))
 
         f.seek(f.tell() + 27)
 
-        return (numberOfPlates)
+        return PlateDescriptor(numberOfPlates, temperatures)
 
     def readFlexSites(self, f, numberOfColumns):
         """Reads several 'FlexSite' structures, based on the number of rows and columns
-        :param f: the opened PDA file to read
-        :type f: file
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
         :param numberOfColumns: the number of columns read
         :type numberOfColumns: int
         """
         i = 0;
         while i < (numberOfColumns * self.NUMBER_OF_ROWS):
-            id = self.readFlexSite(f)
-            if (id == None):
+            flexSite = self.readFlexSite(f)
+            if (flexSite == None):
                 return (None)
             i += 1
         f.seek(f.tell() + 1)
@@ -653,50 +1953,84 @@ class FlexstationFilter(object):
 
     def readFlexSite(self, f):
         """Reads a 'FlexSite' structure
-        :param f: the opened PDA file to read
-        :type f: file
-        :returns id: the id of the flex site
-        :type id: int
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
+        :returns flexSite: the id of the flex site, its number of data chunks, number of reads and length of a chunk
+        :type flexSite: FlexSite
         """
         structureName = self.readStructureName(f)
         if structureName != "CSFlexSite":
             return
 
-        dataChunkNumberHex = binascii.hexlify(f.read(4))
-        dataChunkNumber = int(dataChunkNumberHex, 16)
-
-        readNumberHex = binascii.hexlify(f.read(4))
-        readNumber = int(readNumberHex, 16)
-
-        idHex = binascii.hexlify(f.read(4))
-        id = int(idHex, 16)
+        dataChunkNumber, readNumber, id, dataChunkLength = f.readRecord(FLEX_SITE_HEADER)
+        f.seek(f.tell() + dataChunkNumber * dataChunkLength)
 
-        dataChunkLengthHex = binascii.hexlify(f.read(4))
-        dataChunkLength = int(dataChunkLengthHex, 16)
-        if (dataChunkNumber == None or dataChunkLength == None):
-            return (None)
-
-        i = 0
-        while (i < dataChunkNumber):
-            f.seek(f.tell() + dataChunkLength)
-            i += 1
+        return FlexSite(id, dataChunkNumber, readNumber, dataChunkLength)
 
-        return (id)
+    def decodeFlexSites(self, f, offset, numberOfFlexSites, wavelengthsNumber=None, readInterval=None):
+        """Decodes the data chunks of consecutive 'FlexSite' structures at once, over the PDA buffer
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
+        :param offset: the offset of the first flex site
+        :type offset: int
+        :param numberOfFlexSites: the number of flex sites to decode
+        :type numberOfFlexSites: int
+        :param wavelengthsNumber: the number of wavelengths read (deduced from the chunk length if not given)
+        :type wavelengthsNumber: int
+        :param readInterval: the interval between each read, in seconds
+        :type readInterval: float
+        :returns plate: the ids of the wells, their readings, read times and nominal timestamps (see extractPlateData)
+        :type plate: dict
+        """
+        f.seek(offset)
+        if self.readStructureName(f) != "CSFlexSite":
+            raise ValueError("No flex site at offset {0}".format(offset))
+        dataChunkNumber, readNumber, id, dataChunkLength = f.readRecord(FLEX_SITE_HEADER)
+
+        valuesNumber = dataChunkLength // 8
+        if not wavelengthsNumber:
+            wavelengthsNumber = (valuesNumber - 1) // readNumber if readNumber else 0 # chunks end with an empty value
+        if readNumber == 0 or wavelengthsNumber * readNumber > valuesNumber:
+            raise ValueError("Unexpected flex site data chunk of {0} bytes for {1} reads".format(dataChunkLength,
+                                                                                             readNumber))
+
+        # all the flex sites of a plate have the same size: decode them as an array of records
+        dataChunk = [('values', '>f8', (valuesNumber,))]
+        if dataChunkLength % 8:
+            dataChunk.append(('padding', 'V{0}'.format(dataChunkLength % 8)))
+        flexSite = numpy.dtype([('nameLength', 'u1'), ('name', 'S10'), ('dataChunkNumber', '>u4'),
+                                ('readNumber', '>u4'), ('id', '>u4'), ('dataChunkLength', '>u4'),
+                                ('chunks', dataChunk, (dataChunkNumber,))])
+        records = numpy.frombuffer(f.data, flexSite, numberOfFlexSites, offset)
+        if not ((records['name'] == "CSFlexSite").all() and (records['dataChunkNumber'] == dataChunkNumber).all()
+                and (records['readNumber'] == readNumber).all()
+                and (records['dataChunkLength'] == dataChunkLength).all()):
+            raise ValueError("Flex sites of different sizes can't be decoded at once")
+
+        shape = (numberOfFlexSites, dataChunkNumber, valuesNumber)
+        chunks = records['chunks']['values'].reshape(shape)[:, :, :wavelengthsNumber * readNumber]
+        chunks = chunks.reshape((numberOfFlexSites, dataChunkNumber, wavelengthsNumber, readNumber))
+
+        plate = {}
+        plate['well_ids'] = records['id'].astype(int)
+        plate['values'] = chunks[:, 0].astype(float)
+        if dataChunkNumber > 1:
+            plate['read_times'] = chunks[:, 1].astype(float)
+        else:
+            plate['read_times'] = None
+        if readInterval:
+            plate['timestamps'] = numpy.arange(readNumber) * readInterval
+        else:
+            plate['timestamps'] = None
+        return plate
 
     def readCalcPlateBody(self, f):
         """Reads a 'CalcPlateBody' structure
-        :param f: the opened PDA file to read
-        :type f: file
-        :returns wavelength: the wavelength of the plate body
-        :type wavelength: str
-        :returns wavelengthCombination: the wavelength combination
-        :type wavelengthCombination: str
-        :returns formula: the formula used for combining wavelengths
-        :type formula: str
-        :returns unknown: --
-        :type unknown: str
-        :returns instrumentInfos: the information about the plate reader instrument
-        :type instrumentInfos: str
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
+        :returns calcPlateBody: the wavelength of the plate body, the wavelength combination, the formula used for
+        combining wavelengths, an unknown string and the information about the plate reader instrument
+        :type calcPlateBody: CalcPlateBody
         """
         structureName = self.readStructureName(f)
         if structureName != "CSCalcPlateBody":
@@ -713,12 +2047,12 @@ class FlexstationFilter(object):
         unknown = self.readStringUntilDelimiter(f)
         instrumentInfos = self.readStringUntilDelimiter(f)
 
-        return (wavelength, wavelengthCombination, formula, unknown, instrumentInfos)
+        return CalcPlateBody(wavelength, wavelengthCombination, formula, unknown, instrumentInfos)
 
     def readMorphPlateTable(self, f):
         """Reads a 'MorphPlateTable' structure
-        :param f: the opened PDA file to read
-        :type f: file
+        :param f: the PDA buffer to read
+        :type f: PdaBuffer
         """
         structureName = self.readStructureName(f)
         if structureName != "CSMorphPlateTable":
@@ -738,6 +2072,9 @@ class FlexstationFilter(object):
         if (f == None):
             return None
 
+        if len(delimiter) == 1:
+            return self.scanUntilDelimiter(f, delimiter)
+
         result = ''
         data = f.read(1)
         while data != delimiter:
@@ -760,16 +2097,75 @@ class FlexstationFilter(object):
         if (f == None):
             return None
 
-        result = ''
-        data = f.read(1)
-        while data:
-            result += str(unpack("c", data)[0])
-            if result.endswith(delimiter):
-                return (result.replace(delimiter, ""))
-            data = f.read(1)
+        return self.scanUntilDelimiter(f, delimiter)
+
+    def scanUntilDelimiter(self, f, delimiter):
+        """Reads a string until a delimiter is reached, searching blocks of the file rather than single bytes
+        :param f: the opened PDA file or PDA buffer to read
+        :type f: file
+        :param delimiter: the delimiter which stops the reading if encountered
+        :type delimiter: str
+        :returns result: the string that was read, without the end delimiter. None if the delimiter was never found.
+        :type result: str
+        """
+        if isinstance(f, PdaBuffer):
+            return f.readUntil(delimiter)
+
+        chunks = []
+        overlap = len(delimiter) - 1 # a delimiter can start at the end of a block and finish in the next one
+        tail = ''
+        block = f.read(self.BLOCK_SIZE)
+        while block:
+            window = tail + block
+            index = window.find(delimiter)
+            if index != -1:
+                chunks.append(window[:index])
+                f.seek(f.tell() - (len(window) - index - len(delimiter))) # moves back right after the delimiter
+                return ''.join(chunks)
+            split = max(0, len(window) - overlap)
+            chunks.append(window[:split])
+            tail = window[split:]
+            block = f.read(self.BLOCK_SIZE)
 
         return (None) # reached the end of the file without finding the delimiter
 
+    def skipToLastStringDelimiter(self, f, delimiter):
+        """Moves the cursor right after the last occurence of a delimiter, as reading successive strings with
+        readStringUntilStringDelimiter would do, but using a single reverse search
+        :param f: the opened PDA file or PDA buffer to read
+        :type f: file
+        :param delimiter: the delimiter to look for
+        :type delimiter: str
+        :returns found: True if the delimiter was found (the cursor doesn't move otherwise)
+        :type found: bool
+        """
+        start = f.tell()
+        if isinstance(f, PdaBuffer):
+            data, offset = f.data, 0
+        else:
+            data, offset = f.read(), start
+            f.seek(start)
+
+        index = data.rfind(delimiter, start - offset)
+        if index == -1:
+            return False
+
+        # Overlapping occurences are consumed in pairs when reading forward: walk back to the first of them,
+        # then search forward again to find the occurence that ends the last read string
+        first = index
+        previous = data.rfind(delimiter, max(start - offset, first - len(delimiter) + 1), first + len(delimiter) - 1)
+        while previous != -1:
+            first = previous
+            previous = data.rfind(delimiter, max(start - offset, first - len(delimiter) + 1), first + len(delimiter) - 1)
+        end = first + len(delimiter)
+        index = data.find(delimiter, end)
+        while index != -1:
+            end = index + len(delimiter)
+            index = data.find(delimiter, end)
+
+        f.seek(offset + end)
+        return True
+
     def readStructureName(self, f):
         """Reads a structure name in the PDA format
         :param f: the opened PDA file to read
@@ -793,8 +2189,11 @@ class FlexstationFilter(object):
             return None
 
         # reads the length of the string, on n-bytes
-        stringLengthHex = binascii.hexlify(f.read(numberOfByteForPrefix))
-        stringLength = int(stringLengthHex, 16)
+        if isinstance(f, PdaBuffer):
+            stringLength = f.readUInt(numberOfByteForPrefix)
+        else:
+            stringLengthHex = binascii.hexlify(f.read(numberOfByteForPrefix))
+            stringLength = int(stringLengthHex, 16)
 
         # reads the string itself
         stringContent = f.read(stringLength)
@@ -813,29 +2212,229 @@ class FlexstationFilter(object):
 
         fileIndexSave = f.tell()
 
-        numberHex = binascii.hexlify(f.read(4))
-        number = int(numberHex, 16)
+        if isinstance(f, PdaBuffer):
+            number = f.readUInt(4)
+        else:
+            number = int(binascii.hexlify(f.read(4)), 16)
         if (number not in numbers):
             f.seek(fileIndexSave)
 
+    def saveSidecar(self, instance, metadata, plates):
+        """Exports the readings of the wells and the metadata of a datafile to a NumPy file stored next to it, and
+        registers this file as a datafile of the same dataset
+        :param instance: the datafile the readings were extracted from
+        :type instance: Dataset_File
+        :param metadata: the metadata extracted from the datafile
+        :type metadata: dict
+        :param plates: the readings extracted from the datafile (see extractPlateData)
+        :type plates: list
+        :returns sidecar: the datafile of the NumPy file, None if it already exists or if the datafile isn't stored
+        locally
+        :type sidecar: Dataset_File
+        """
+        filepath = instance.get_absolute_filepath()
+        if not filepath or not path.exists(filepath):
+            # the file was fetched from a remote location, there is no folder to write the sidecar into
+            logger.info('No sidecar for datafile {0}, its file is not stored locally'.format(instance.id))
+            return None
+
+        filename = instance.filename + self.SIDECAR_EXTENSION
+        if Dataset_File.objects.filter(dataset=instance.dataset, filename=filename).exists():
+            return None
+
+        replica = instance.get_preferred_replica()
+        target = filepath + self.SIDECAR_EXTENSION
+
+        arrays = {}
+        arrays['metadata'] = numpy.array(json.dumps(dict(
+            (key, value.decode('cp1252') if isinstance(value, str) else value) for key, value in metadata.items())))
+        for i, plate in enumerate(plates):
+            for key, value in plate.items():
+                if value is not None:
+                    arrays['plate{0}_{1}'.format(i, key)] = value
+        with open(target, 'wb') as f:
+            numpy.savez(f, **arrays) # not compressed, so that the arrays are loaded without decoding
+
+        checksum = hashlib.sha512()
+        with open(target, 'rb') as f:
+            checksum.update(f.read())
+
+        sidecar = Dataset_File(dataset=instance.dataset,
+                               filename=filename,
+                               size=str(path.getsize(target)),
+                               sha512sum=checksum.hexdigest())
+        sidecar.save()
+        sidecarReplica = Replica(datafile=sidecar,
+                                 url=replica.url + self.SIDECAR_EXTENSION,
+                                 protocol=replica.protocol,
+                                 location=replica.location)
+        sidecarReplica.verify()
+        sidecarReplica.save()
+        return sidecar
+
     def saveFlexstationMetadata(self, instance, schema, metadata):
         """Saves or overwrites the datafile's metadata to a Dataset_Files parameter set in the database.
         """
+        parameterSets, created = self.createParameterSets(schema, [(instance, metadata)])
+        return parameterSets[0]
+
+    def saveFlexstationMetadataBatch(self, schema, items):
+        """Saves the metadata of several datafiles in a single transaction, with a constant number of queries.
+        Datafiles which already have a parameter set for this schema are left untouched.
+        :param schema: the schema under which the meta-data will be saved
+        :type schema: Schema
+        :param items: the datafiles and the dictionary of meta-data to save for each of them
+        :type items: list of (Dataset_File, dict) tuples
+        :returns created: the number of parameter sets created (the datafiles left untouched aren't counted)
+        :type created: int
+        """
+        parameterSets, created = self.createParameterSets(schema, items)
+        return created
+
+    def createParameterSets(self, schema, items):
+        """Creates the parameter sets of the datafiles which don't have one for this schema yet, and their
+        parameters, in a single transaction (see saveFlexstationMetadataBatch)
+        :param schema: the schema under which the meta-data will be saved
+        :type schema: Schema
+        :param items: the datafiles and the dictionary of meta-data to save for each of them
+        :type items: list of (Dataset_File, dict) tuples
+        :returns parameterSets: the parameter set of each datafile (None if there was no parameter to save)
+        :type parameterSets: list
+        :returns created: the number of parameter sets created
+        :type created: int
+        """
         logger.info('Saving Metadata')
 
-        parameters = self.getParameters(schema, metadata)
+        merged = {}
+        for instance, metadata in items:
+            merged.update(metadata)
+        parameters = self.getParameters(schema, merged)
         if not parameters:
-            return None
-
-        try:
-            ps = DatafileParameterSet.objects.get(schema=schema,
-                                                  dataset_file=instance)
-            return ps  # if already exists then just return it
-        except DatafileParameterSet.DoesNotExist:
-            ps = DatafileParameterSet(schema=schema,
-                                      dataset_file=instance)
-            ps.save()
+            return ([None] * len(items), 0)
+
+        with self.transaction():
+            instances = dict((instance.id, instance) for instance, metadata in items
+                             if [p for p in parameters if p.name in metadata])
+            self.lockDatafiles(instances.keys())
+
+            # if already exists then just return it
+            parameterSets = dict((ps.dataset_file_id, ps) for ps in
+                                 DatafileParameterSet.objects.filter(schema=schema, dataset_file__in=instances.keys()))
+            created = [instance_id for instance_id in instances if instance_id not in parameterSets]
+
+            if created:
+                DatafileParameterSet.objects.bulk_create([DatafileParameterSet(schema=schema,
+                                                                               dataset_file=instances[instance_id])
+                                                          for instance_id in created])
+                # bulk_create doesn't set the primary keys, fetch the new parameter sets back
+                newParameterSets = dict((ps.dataset_file_id, ps) for ps in
+                                        DatafileParameterSet.objects.filter(schema=schema, dataset_file__in=created))
+
+                dfps = []
+                for instance, metadata in items:
+                    ps = newParameterSets.pop(instance.id, None)
+                    if ps == None:
+                        continue
+                    parameterSets[instance.id] = ps
+                    dfps.extend(self.createDatafileParameters(ps, parameters, metadata))
+                DatafileParameter.objects.bulk_create(dfps)
+
+        return ([parameterSets.get(instance.id) for instance, metadata in items], len(created))
+
+    def saveDatasetsMetadata(self, instance, schema, datasets):
+        """Saves the metadata of each dataset of a datafile as its own parameter set, in a single transaction.
+        Datafiles which already have parameter sets for this schema are left untouched.
+        :param instance: the datafile the metadata was extracted from
+        :type instance: Dataset_File
+        :param schema: the schema under which the meta-data will be saved
+        :type schema: Schema
+        :param datasets: the dictionary of meta-data of each dataset, in the order of the file (see iterDatasets)
+        :type datasets: iterable
+        :returns parameterSets: the parameter set of each dataset with parameters to save
+        :type parameterSets: list
+        """
+        logger.info('Saving Metadata')
 
+        with self.transaction():
+            self.lockDatafiles([instance.id])
+
+            # if already exists then just return them
+            parameterSets = list(DatafileParameterSet.objects.filter(schema=schema, dataset_file=instance)
+                                                             .order_by('id'))
+            if parameterSets:
+                return parameterSets
+
+            dfps = []
+            for metadata in datasets:
+                parameters = self.getParameters(schema, metadata)
+                if not parameters:
+                    continue
+                ps = DatafileParameterSet(schema=schema, dataset_file=instance)
+                ps.save()
+                parameterSets.append(ps)
+                dfps.extend(self.createDatafileParameters(ps, parameters, metadata))
+            DatafileParameter.objects.bulk_create(dfps)
+
+        return parameterSets
+
+    def lockDatafiles(self, ids):
+        """Locks the rows of datafiles until the end of the current transaction, so that checking whether they have a
+        parameter set and creating it is atomic: a concurrent save of the same datafiles (e.g. a task retried while the
+        datafile is saved again) waits here, then finds the parameter set created meanwhile
+        :param ids: the ids of the datafiles
+        :type ids: list
+        """
+        if ids:
+            locked = Dataset_File.objects.select_for_update().filter(id__in=ids).order_by('id')
+            list(locked.values_list('id', flat=True)) # the rows are locked when the query runs
+
+    def saveMissingParametersBatch(self, schema, items, parameterNames=None):
+        """Adds to existing parameter sets the parameters they are missing (typically parameters added to the filter
+        after they were saved), in a single transaction and with a constant number of queries
+        :param schema: the schema of the parameter sets
+        :type schema: Schema
+        :param items: the parameter sets and the dictionary of meta-data extracted again for each of them (the metadata
+        of its own dataset, for the parameter sets saved per dataset)
+        :type items: list of (DatafileParameterSet, dict) tuples
+        :param parameterNames: if given, only the parameters with these names are added
+        :type parameterNames: list
+        :returns added: the number of parameters added
+        :type added: int
+        """
+        # the metadata of each parameter set is kept apart, only the names of the parameters are gathered
+        names = set()
+        for ps, metadata in items:
+            names.update(metadata)
+        parameters = self.getParameters(schema, names)
+        if parameterNames != None:
+            parameters = [p for p in parameters if p.name in parameterNames]
+        if not parameters:
+            return 0
+
+        with self.transaction():
+            present = set(DatafileParameter.objects.filter(parameterset__in=[ps.id for ps, metadata in items],
+                                                           name__in=[p.id for p in parameters])
+                                                   .values_list('parameterset', 'name'))
+            dfps = []
+            for ps, metadata in items:
+                dfps.extend(self.createDatafileParameters(ps, [p for p in parameters if (ps.id, p.id) not in present],
+                                                          metadata))
+            DatafileParameter.objects.bulk_create(dfps)
+
+        return len(dfps)
+
+    def createDatafileParameters(self, ps, parameters, metadata):
+        """Builds the parameters of a parameter set, to be saved in bulk
+        :param ps: the parameter set the parameters belong to
+        :type ps: DatafileParameterSet
+        :param parameters: the parameters to build, if they are in the meta-data
+        :type parameters: list
+        :param metadata: the dictionary of meta-data
+        :type metadata: dict
+        :returns dfps: the parameters, not saved yet
+        :type dfps: list
+        """
+        dfps = []
         for p in parameters:
             if p.name in metadata:
                 dfp = DatafileParameter(parameterset=ps,
@@ -843,12 +2442,11 @@ class FlexstationFilter(object):
                 if p.isNumeric():
                     if metadata[p.name] != '':
                         dfp.numerical_value = metadata[p.name]
-                        dfp.save()
+                        dfps.append(dfp)
                 else:
                     dfp.string_value = metadata[p.name].decode('cp1252')
-                    dfp.save()
-
-        return ps
+                    dfps.append(dfp)
+        return dfps
 
     def getParameters(self, schema, metadata):
         """Get a list of parameters for this schema
@@ -856,84 +2454,367 @@ class FlexstationFilter(object):
         :type schema: Schema
         :param numbers: the dictionary of meta-data to be saved
         :type numbers: dict
-        :returns parameters: a list of the parameters that will be saved.
+        :returns parameters: a list of the parameters that will be saved (their type is the one declared in
+        paramnames, the section readers returning numbers as native numbers)
         :type parameters: dict
         """
-        param_objects = ParameterName.objects.filter(schema=schema)
-        parameters = []
-        for p in metadata:
-
-            parameter = filter(lambda x: x.name == p, param_objects)
-
-            if parameter:
-                parameters.append(parameter[0])
-                continue
-
-            # detect type of parameter
-            datatype = ParameterName.STRING
-
-            # Int test
-            try:
-                int(metadata[p])
-            except ValueError:
-                pass
-            except TypeError:
-                pass
-            else:
-                datatype = ParameterName.NUMERIC
-
-            # Float test
-            try:
-                float(metadata[p])
-            except ValueError:
-                pass
-            except TypeError:
-                pass
-            else:
-                datatype = ParameterName.NUMERIC
-
-        return parameters
+        param_objects = self.getParameterNames(schema)
+        return [param_objects[p] for p in metadata if p in param_objects]
 
     def getSchema(self):
         """Returns the schema object that the parameter set will use.
         """
-        try:
-            return Schema.objects.get(namespace__exact=self.schema)
-        except Schema.DoesNotExist:
-            schema = Schema(namespace=self.schema, name=self.name, type=Schema.DATAFILE)
-            schema.save()
-            return schema
+        self.checkCache()
+        schema = self.schemaCache
+        if schema == None:
+            try:
+                schema = Schema.objects.get(namespace__exact=self.schema)
+            except Schema.DoesNotExist:
+                schema = Schema(namespace=self.schema, name=self.name, type=Schema.DATAFILE)
+                schema.save()
+            self.fillCache('schemaCache', schema)
+        return schema
+
+    def getParameterNames(self, schema):
+        """Returns the parameter names of a schema, indexed by name
+        :param schema: the schema of the parameter names
+        :type schema: Schema
+        :returns parameterNames: the parameter names of the schema
+        :type parameterNames: dict
+        """
+        self.checkCache()
+        parameterNamesCache = self.parameterNamesCache
+        if parameterNamesCache == None or parameterNamesCache[0] != schema.id:
+            parameterNames = {}
+            for pn in ParameterName.objects.filter(schema=schema):
+                parameterNames.setdefault(pn.name, pn)
+            parameterNamesCache = (schema.id, parameterNames)
+            self.fillCache('parameterNamesCache', parameterNamesCache)
+        return parameterNamesCache[1]
 
     def getOrCreateParameterNames(self, schema, paramnames):
         """ Takes a list of paramnames (defined in the __init__ method) to get or create new parameter names objects
         """
-        pn_objects = []
-        for paramname in paramnames:
-            param_objects = ParameterName.objects.filter(schema=schema, name=paramname['name'])
+        pn_objects = self.getParameterNames(schema)
+
+        missing = [paramname for paramname in paramnames if paramname['name'] not in pn_objects]
+        if missing:
+            ParameterName.objects.bulk_create([ParameterName(schema=schema, name=paramname['name'],
+                                                             full_name=paramname['full_name'],
+                                                             data_type=paramname['data_type'])
+                                               for paramname in missing])
+            # bulk_create doesn't set the primary keys, fetch the parameter names back
+            self.parameterNamesCache = None
+            pn_objects = self.getParameterNames(schema)
+
+        return [pn_objects[paramname['name']] for paramname in paramnames]
+
+    def getCachedMetadata(self, sha512sum):
+        """Returns the metadata previously extracted from a file with the same checksum
+        :param sha512sum: the checksum of the file
+        :type sha512sum: str
+        :returns metadata: the metadata of the file, None if it isn't in the cache
+        :type metadata: dict
+        """
+        if self.parseCache == None or not sha512sum:
+            return None
+        metadata = self.parseCache.get('flexstation-metadata-' + sha512sum, version=self.PARSE_CACHE_VERSION)
+        if metadata == None:
+            self.cacheMisses += 1
+        else:
+            self.cacheHits += 1
+        return metadata
 
-            if len(param_objects) == 0:
-                pn = ParameterName(schema=schema, name=paramname['name'], full_name=paramname['full_name'],
-                                   data_type=paramname['data_type'])
-                pn.save()
-            else:
-                pn = param_objects[0]
+    def setCachedMetadata(self, sha512sum, metadata):
+        """Stores the metadata extracted from a file in the cache, keyed by the checksum of the file
+        :param sha512sum: the checksum of the file
+        :type sha512sum: str
+        :param metadata: the metadata of the file
+        :type metadata: dict
+        """
+        if self.parseCache == None or not sha512sum:
+            return
+        self.parseCache.set('flexstation-metadata-' + sha512sum, metadata, version=self.PARSE_CACHE_VERSION)
+
+    def fillCache(self, attribute, value):
+        """Caches the schema or the parameter names. When they are looked up inside a transaction, which may have
+        created them, the cache is emptied if this transaction is rolled back instead of being committed (see
+        checkCache), so that no row rolled back is ever used as a foreign key
+        :param attribute: the name of the cache ('schemaCache' or 'parameterNamesCache')
+        :type attribute: str
+        :param value: the value to cache
+        """
+        setattr(self, attribute, value)
+        if on_commit == None or not connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return
 
-            pn_objects.append(pn)
+        connection = connections[DEFAULT_DB_ALIAS]
+        def committed():
+            if (connection, committed) in self.uncommittedCache:
+                self.uncommittedCache.remove((connection, committed))
+        self.uncommittedCache.append((connection, committed))
+        on_commit(committed)
 
-        return pn_objects
+    def checkCache(self):
+        """Empties the cache of schema and parameter names if a transaction they were looked up in was rolled back
+        (its commit callbacks are then dropped without having been called, see fillCache)
+        """
+        if not self.uncommittedCache:
+            return
+        connection = connections[DEFAULT_DB_ALIAS] # the transactions of other threads are on their own connection
+        pending = [entry[1] for entry in connection.run_on_commit] # (savepoint ids, callback, ...)
+        for callbackConnection, callback in list(self.uncommittedCache):
+            if callbackConnection is connection and callback not in pending:
+                self.clearCache(None)
+                return
+
+    @contextmanager
+    def transaction(self):
+        """Runs a block in a transaction. If a database error rolls it back, the cache of schema and parameter names
+        is emptied, as rows it holds may have been created by a transaction rolled back since they were cached
+        """
+        try:
+            with atomic():
+                yield
+        except DatabaseError:
+            self.clearCache(None)
+            raise
+
+    def clearCache(self, sender, **kwargs):
+        """Signal handler emptying the cache of schema and parameter names when any of them is saved or deleted
+        :param sender: The model class.
+        """
+        self.schemaCache = None
+        self.parameterNamesCache = None
+        self.uncommittedCache = []
 
 
-def make_filter(name='', schema=''):
+def make_filter(name='', schema='', asynchronous=False, sidecar=False, perDataset=False, profileThreshold=None):
     ''' Instantiate and return the FlexstationFilter class
     :param name: the name of the filter
     :param schema: the short name of the schema to use for this filter
+    :param asynchronous: if True, the metadata is extracted by a Celery task instead of the post-save signal
+    :param sidecar: if True, the readings of the wells are exported to a NumPy file next to each datafile
+    :param perDataset: if True, the metadata of each dataset of a file is saved as its own parameter set
+    :param profileThreshold: if set, the files taking longer than this many seconds to extract or save are profiled
     :return: a new instance of the FlexstationFilter class
     '''
     if not name:
         raise ValueError("FlexstationFilter requires a name to be specified")
     if not schema:
         raise ValueError("FlexstationFilter requires a schema to be specified")
-    return FlexstationFilter(name, schema)
-
-
-make_filter.__doc__ = FlexstationFilter.__doc__
\ No newline at end of file
+    if sidecar and numpy == None:
+        raise ImportError("FlexstationFilter requires numpy to export the readings of the wells")
+    return FlexstationFilter(name, schema, asynchronous, sidecar, perDataset, profileThreshold)
+
+
+make_filter.__doc__ = FlexstationFilter.__doc__
+
+
+FILTERS = {} # filters of the Celery tasks and of the worker processes, keyed by their arguments (see get_filter)
+FILTERS_LOCK = threading.Lock()
+
+
+def get_filter(name, schema, sidecar=False, perDataset=False, profileThreshold=None):
+    """Returns the filter of a process for some arguments, created on first use, so that the schema and parameter
+    names it caches are looked up once per process instead of once per task or file
+    :param name: the short name of the schema
+    :type name: str
+    :param schema: the name of the schema to load the PDA meta-data into
+    :type schema: str
+    :param sidecar: if True, the readings of the wells are also exported to a NumPy file next to the datafile
+    :type sidecar: bool
+    :param perDataset: if True, the metadata of each dataset of a file is saved as its own parameter set
+    :type perDataset: bool
+    :param profileThreshold: if set, the files taking longer than this many seconds to extract or save are profiled
+    :type profileThreshold: float
+    :returns filter: the filter
+    :type filter: FlexstationFilter
+    """
+    key = (name, schema, sidecar, perDataset, profileThreshold)
+    with FILTERS_LOCK:
+        if key not in FILTERS:
+            FILTERS[key] = FlexstationFilter(name, schema, sidecar=sidecar, perDataset=perDataset,
+                                             profileThreshold=profileThreshold)
+        return FILTERS[key]
+
+
+DATASET_POOLS = {} # threads reading the datasets of files in parallel, by number of threads (see get_dataset_pool)
+DATASET_POOLS_PID = None # the process the pools were created in
+DATASET_POOLS_LOCK = threading.Lock()
+
+
+def get_dataset_pool(threads):
+    """Returns the pool of threads of the process reading the datasets of files in parallel, created on first use
+    and then shared by all the filters asking for the same number of threads, so that no threads are started per
+    filter or per file. A process forked after the pools were created (e.g. the worker processes of the commands)
+    creates its own pools, the threads of the pools of its parent not running in it
+    :param threads: the number of threads of the pool
+    :type threads: int
+    :returns pool: the pool of threads
+    :type pool: multiprocessing.pool.ThreadPool
+    """
+    global DATASET_POOLS_PID
+    with DATASET_POOLS_LOCK:
+        if DATASET_POOLS_PID != os.getpid():
+            DATASET_POOLS.clear()
+            DATASET_POOLS_PID = os.getpid()
+        if threads not in DATASET_POOLS:
+            DATASET_POOLS[threads] = multiprocessing.pool.ThreadPool(threads)
+        return DATASET_POOLS[threads]
+
+
+def load_plate_data(target):
+    """Loads the readings of the wells and the metadata exported by the filter to a NumPy file
+    :param target: the path of the NumPy file
+    :type target: str
+    :returns metadata: the metadata of the datafile
+    :type metadata: dict
+    :returns plates: the readings of each plate (see FlexstationFilter.extractPlateData)
+    :type plates: list
+    """
+    arrays = numpy.load(target)
+    metadata = json.loads(arrays['metadata'].item())
+    plates = []
+    for key in sorted(arrays.files):
+        if key.startswith('plate'):
+            i, field = key[len('plate'):].split('_', 1)
+            while len(plates) <= int(i):
+                plates.append({'read_times': None, 'timestamps': None})
+            plates[int(i)][field] = arrays[key]
+    arrays.close()
+    return (metadata, plates)
+
+
+@task(name="tardis_portal.filters.flexstation.extract_metadata", ignore_result=True,
+      max_retries=5, default_retry_delay=60)
+def extract_flexstation_metadata(datafile_id, name, schema, sidecar=False, perDataset=False, profileThreshold=None):
+    """Extracts and saves the metadata of a datafile in a Celery worker.
+    Datafiles which already have a parameter set for this schema are skipped, so running the task twice is harmless.
+    :param datafile_id: the id of the datafile
+    :type datafile_id: int
+    :param name: the short name of the schema
+    :type name: str
+    :param schema: the name of the schema to load the PDA meta-data into
+    :type schema: str
+    :param sidecar: if True, the readings of the wells are also exported to a NumPy file next to the datafile
+    :type sidecar: bool
+    :param perDataset: if True, the metadata of each dataset of the file is saved as its own parameter set
+    :type perDataset: bool
+    :param profileThreshold: if set, the file is profiled when extracting or saving it takes longer than this
+    :type profileThreshold: float
+    """
+    filter = get_filter(name, schema, sidecar, perDataset, profileThreshold)
+    try:
+        # the datafile may not be committed yet when the task starts, or its file may not be stored yet
+        instance = Dataset_File.objects.get(id=datafile_id)
+        # skips the parsing of datafiles already saved (the check is made again, atomically, when saving)
+        if DatafileParameterSet.objects.filter(schema__namespace=schema, dataset_file=instance).exists():
+            return None
+        filter.processDatafile(instance)
+    except (Dataset_File.DoesNotExist, IOError, DatabaseError) as e:
+        logger.info('Retrying metadata extraction of datafile {0}: {1}'.format(datafile_id, e))
+        extract_flexstation_metadata.retry(args=[datafile_id, name, schema, sidecar, perDataset, profileThreshold],
+                                           exc=e)
+    except Exception as e:
+        logger.error('Failed to extract metadata from datafile {0}: {1}'.format(datafile_id, e))
+
+
+@task(name="tardis_portal.filters.flexstation.profile_file", ignore_result=True)
+def profile_flexstation_file(datafile_id, name, schema, stages=None, profilePath=None, profileKeep=None):
+    """Profiles the extraction of the file of a datafile which was slow to process (see FlexstationFilter.profileFile)
+    in a Celery worker, instead of the request or the task which processed it
+    :param datafile_id: the id of the datafile
+    :type datafile_id: int
+    :param name: the short name of the schema
+    :type name: str
+    :param schema: the name of the schema to load the PDA meta-data into
+    :type schema: str
+    :param stages: the time spent extracting and saving the metadata when the file was processed
+    :type stages: dict
+    :param profilePath: the folder of the profiles of the filter which processed the file
+    :type profilePath: str
+    :param profileKeep: the number of profiles kept by the filter which processed the file
+    :type profileKeep: int
+    """
+    filter = get_filter(name, schema)
+    try:
+        instance = Dataset_File.objects.get(id=datafile_id)
+        source = filter.getSource(instance, instance.get_absolute_filepath())
+        if source == None:
+            logger.info('Not profiling datafile {0}, its file can\'t be read'.format(datafile_id))
+            return None
+        try:
+            return filter.profileFile(source, instance.sha512sum, stages, profilePath, profileKeep)
+        finally:
+            if isinstance(source, PdaBuffer):
+                source.close()
+    except Exception as e:
+        logger.error('Failed to profile datafile {0}: {1}'.format(datafile_id, e))
+
+
+def extract_file_metadata(args):
+    """Extracts the metadata of a single PDA file, computing its checksum on the way (runs in a worker process)
+    :param args: the path of the PDA file, the name and the schema of the filter, the names of the parameters
+    wanted (None for all of them, see extractMetadata), the checksum of the file if it is known already (None to
+    compute it) and whether to extract the metadata of each dataset separately (see iterDatasets)
+    :type args: tuple
+    :returns result: the path of the file, its sha512 checksum, the extracted metadata (a list of dictionaries, one
+    per dataset, if extracted separately. None on failure) and the error message (None on success)
+    :type result: tuple
+    """
+    target, name, schema, parameters, sha512sum, perDataset = args
+    try:
+        # the file is mapped once, to compute its checksum and parse it
+        with PdaBuffer.open(target) as f:
+            if not sha512sum:
+                sha512sum = hashlib.sha512(f.data).hexdigest()
+            if perDataset:
+                metadata = list(get_filter(name, schema).iterDatasets(f, sha512sum, parameters))
+            else:
+                metadata = get_filter(name, schema).extractMetadata(f, sha512sum, parameters)
+        return (target, sha512sum, metadata, None)
+    except Exception as e:
+        logger.error('Failed to extract metadata from {0}: {1}'.format(target, e))
+        return (target, None, None, str(e))
+
+
+def iter_extract_metadata(targets, name='', schema='', workers=None, parameters=None, checksums=None, pool=None,
+                          perDataset=None):
+    """Extracts the metadata of several PDA files in parallel, in a pool of worker processes
+    :param targets: the paths of the PDA files to extract metadata from
+    :type targets: list
+    :param name: the name of the filter
+    :type name: str
+    :param schema: the schema of the filter
+    :type schema: str
+    :param workers: the number of worker processes (default: the number of CPUs)
+    :type workers: int
+    :param parameters: the names of the parameters to extract (default: all of them)
+    :type parameters: set
+    :param checksums: the checksums of the files already known (e.g. from their datafiles), by path. The checksums
+    of the other files are computed by the workers
+    :type checksums: dict
+    :param pool: the pool of worker processes to use, left running for the next calls (default: a pool of `workers`
+    processes, created for this call only)
+    :type pool: multiprocessing.Pool
+    :param perDataset: the paths of the files whose metadata is extracted dataset by dataset (see iterDatasets)
+    :type perDataset: set
+    :returns results: an iterator over the results of extract_file_metadata, in completion order
+    :type results: iterator
+    """
+    ownPool = pool == None
+    if ownPool:
+        pool = multiprocessing.Pool(workers or multiprocessing.cpu_count())
+    try:
+        checksums, perDataset = checksums or {}, perDataset or set()
+        for result in pool.imap_unordered(extract_file_metadata, [(target, name, schema, parameters,
+                                                                   checksums.get(target), target in perDataset)
+                                                                  for target in targets]):
+            yield result
+        if ownPool:
+            pool.close()
+    finally:
+        if ownPool:
+            pool.terminate()
+            pool.join()
\ No newline at end of file
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010-2011, RMIT e-Research
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+flexstation_ingest.py
+
+Batch extraction of the metadata of PDA files, for backfilling datafiles that
+were stored before the Flexstation filter was enabled.
+
+.. moduleauthor:: Guillaume Prevost <guillaume.prevost@rmit.edu.au>
+
+"""
+import time
+
+from optparse import make_option
+from os import path, walk
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tardis.tardis_portal.filters.flexstation import FlexstationFilter, iter_extract_metadata
+from tardis.tardis_portal.models import Dataset_File
+
+
+class Command(BaseCommand):
+    args = '<directory or PDA file> ...'
+    help = 'Extracts the metadata of PDA files in parallel, and saves it to the datafiles with the same checksum'
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', dest='workers', type='int', default=None,
+                    help='Number of worker processes parsing the files (default: number of CPUs)'),
+        make_option('--name', dest='name', default='FLEXSTATION',
+                    help='Short name of the schema (default: FLEXSTATION)'),
+        make_option('--schema', dest='schema', default='http://rmit.edu.au/flexstation',
+                    help='Namespace of the schema (default: http://rmit.edu.au/flexstation)'),
+        make_option('--batch-size', dest='batch_size', type='int', default=100,
+                    help='Number of files whose metadata is saved in a single transaction (default: 100)'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only parse the files, without saving anything in the database'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('At least one directory or PDA file is required')
+
+        targets = []
+        for arg in args:
+            if path.isdir(arg):
+                for root, dirs, files in walk(arg):
+                    targets.extend(path.join(root, name) for name in sorted(files)
+                                   if name.endswith((".pda", ".PDA")))
+            elif path.isfile(arg):
+                targets.append(arg)
+            else:
+                raise CommandError('No such file or directory: {0}'.format(arg))
+
+        filter = FlexstationFilter(options['name'], options['schema'])
+        if not options['dry_run']:
+            schema = filter.getSchema()
+            filter.getOrCreateParameterNames(schema, filter.paramnames)
+
+        parsed, failed, saved, totalSize = 0, 0, 0, 0
+        pending = []
+        start = time.time()
+        # parsing runs in the worker processes, only the database writes are done here, in batches
+        for target, sha512sum, metadata, error in iter_extract_metadata(targets, options['name'],
+                                                                        options['schema'], options['workers']):
+            if error != None:
+                failed += 1
+                self.stderr.write('{0}: {1}\n'.format(target, error))
+                continue
+            parsed += 1
+            totalSize += path.getsize(target)
+            if not options['dry_run'] and metadata:
+                pending.append((sha512sum, metadata))
+                if len(pending) >= options['batch_size']:
+                    saved += self.saveBatch(filter, schema, pending)
+                    pending = []
+            self.stdout.write('{0}: {1} parameters\n'.format(target, len(metadata)))
+
+        if pending:
+            saved += self.saveBatch(filter, schema, pending)
+
+        elapsed = time.time() - start
+        self.stdout.write('{0} files parsed, {1} failed, {2} datafiles updated in {3:.2f}s '
+                          '({4:.1f} files/s, {5:.1f} MB/s)\n'.format(
+                              parsed, failed, saved, elapsed, (parsed + failed) / max(elapsed, 1e-6),
+                              totalSize / max(elapsed, 1e-6) / (1024 * 1024)))
+
+    def saveBatch(self, filter, schema, pending):
+        """Saves the metadata of a batch of files to the datafiles with the same checksum, looked up in a single query
+        :param filter: the filter saving the metadata
+        :type filter: FlexstationFilter
+        :param schema: the schema under which the metadata is saved
+        :type schema: Schema
+        :param pending: the checksum and the metadata of each file parsed
+        :type pending: list of (str, dict) tuples
+        :returns saved: the number of datafiles updated (the datafiles which already had metadata aren't counted)
+        :type saved: int
+        """
+        datafiles = {}
+        for datafile in Dataset_File.objects.filter(sha512sum__in=set(sha512sum for sha512sum, metadata in pending)):
+            datafiles.setdefault(datafile.sha512sum, []).append(datafile)
+        return filter.saveFlexstationMetadataBatch(schema, [(datafile, metadata) for sha512sum, metadata in pending
+                                                            for datafile in datafiles.get(sha512sum, [])])
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010-2011, RMIT e-Research
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+"""
+flexstation_reextract.py
+
+Incremental re-extraction of the metadata of PDA files, for adding the parameters
+added to the Flexstation filter to the datafiles which were already processed.
+
+.. moduleauthor:: Guillaume Prevost <guillaume.prevost@rmit.edu.au>
+
+"""
+import json
+import multiprocessing
+import time
+
+from optparse import make_option
+from os import path, rename
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from tardis.tardis_portal.filters.flexstation import FlexstationFilter, iter_extract_metadata
+from tardis.tardis_portal.models import Dataset_File, DatafileParameterSet, DatafileParameter
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Parses again the PDA files whose parameter set is missing some parameters, and adds only these parameters'
+    option_list = BaseCommand.option_list + (
+        make_option('--parameters', dest='parameters', default=None,
+                    help='Comma-separated names of the parameters to add (default: all the parameters extracted by the '
+                         'filter)'),
+        make_option('--workers', dest='workers', type='int', default=None,
+                    help='Number of worker processes parsing the files (default: number of CPUs)'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=500,
+                    help='Number of files parsed and saved in a single transaction (default: 500)'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+                    help='File recording the progress, to resume from after an interruption, and the datafiles already '
+                         'parsed, not to parse them again when their missing parameters are not in their files'),
+        make_option('--name', dest='name', default='FLEXSTATION',
+                    help='Short name of the schema (default: FLEXSTATION)'),
+        make_option('--schema', dest='schema', default='http://rmit.edu.au/flexstation',
+                    help='Namespace of the schema (default: http://rmit.edu.au/flexstation)'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only list the datafiles missing parameters, without parsing them'),
+    )
+
+    def handle(self, *args, **options):
+        filter = FlexstationFilter(options['name'], options['schema'])
+        schema = filter.getSchema()
+        filter.getOrCreateParameterNames(schema, filter.paramnames)
+        parameterNames = filter.getParameterNames(schema)
+
+        if options['parameters']:
+            wanted = [name.strip() for name in options['parameters'].split(',') if name.strip()]
+        else:
+            # the parameters of the schema which the parser doesn't extract would leave every parameter set incomplete
+            wanted = filter.getExtractedParameters()
+        unknown = [name for name in wanted if name not in parameterNames]
+        if unknown:
+            raise CommandError('Unknown parameters: {0}'.format(', '.join(unknown)))
+        wantedIds = [parameterNames[name].id for name in wanted]
+
+        # parameter sets are processed by increasing id, the checkpoint is the last one processed. The parameter sets
+        # parsed already for these parameters are left out: the parameters they still miss aren't in their files
+        # (e.g. the analysis notes of a file without analysis section)
+        version = filter.PARSE_CACHE_VERSION
+        lastId, parsedSets = self.loadCheckpoint(options['checkpoint'], version)
+        if lastId:
+            self.stdout.write('Resuming after parameter set {0}\n'.format(lastId))
+        parsedKey = ','.join(sorted(wanted))
+        skipped = set()
+        for key, parameterSetIds in parsedSets.items():
+            if set(key.split(',')) >= set(wanted):
+                skipped.update(parameterSetIds)
+
+        incomplete = self.findIncomplete(schema, wantedIds, lastId, skipped)
+        self.stdout.write('{0} datafiles are missing some of the parameters\n'.format(len(incomplete)))
+        if options['dry_run']:
+            for parameterSetId, datafileId in incomplete:
+                self.stdout.write('datafile {0} (parameter set {1})\n'.format(datafileId, parameterSetId))
+            return
+
+        parsed, failed, added = 0, 0, 0
+        start = time.time()
+        # a single pool of worker processes parses the files of all the chunks
+        pool = multiprocessing.Pool(options['workers'] or multiprocessing.cpu_count())
+        try:
+            for i in range(0, len(incomplete), options['chunk_size']):
+                chunk = incomplete[i:i + options['chunk_size']]
+                chunkParsed, chunkFailed, chunkAdded = self.processChunk(filter, schema, chunk, wanted, pool, options)
+                parsed += len(chunkParsed)
+                failed += chunkFailed
+                added += chunkAdded
+                parsedSets.setdefault(parsedKey, set()).update(chunkParsed)
+
+                self.saveCheckpoint(options['checkpoint'], chunk[-1][0], parsedSets, version)
+                self.stdout.write('{0}/{1} datafiles processed, {2} parameters added\n'.format(
+                    min(i + options['chunk_size'], len(incomplete)), len(incomplete), added))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        # the run is complete, the next one starts from the beginning (skipping the parameter sets parsed already)
+        self.saveCheckpoint(options['checkpoint'], 0, parsedSets, version)
+
+        elapsed = time.time() - start
+        self.stdout.write('{0} files parsed, {1} failed, {2} parameters added in {3:.2f}s ({4:.1f} files/s)\n'.format(
+            parsed, failed, added, elapsed, (parsed + failed) / max(elapsed, 1e-6)))
+
+    def processChunk(self, filter, schema, chunk, wanted, pool, options):
+        """Parses again the files of a chunk of parameter sets, and adds the missing parameters to them. Returns the
+        ids of the parameter sets whose file was parsed, the number of files which failed and of parameters added"""
+        parameterSets = DatafileParameterSet.objects.in_bulk([parameterSetId for parameterSetId, datafileId
+                                                              in chunk])
+        datafiles = Dataset_File.objects.in_bulk([datafileId for parameterSetId, datafileId in chunk])
+        # the datafiles saved with a parameter set per dataset (see FlexstationFilter.saveDatasetsMetadata) have all
+        # their parameter sets, in the order of their datasets
+        datafileSets = {}
+        allSets = DatafileParameterSet.objects.filter(schema=schema, dataset_file__in=datafiles.keys())
+        for parameterSetId, datafileId in allSets.order_by('id').values_list('id', 'dataset_file'):
+            datafileSets.setdefault(datafileId, []).append(parameterSetId)
+
+        targets, checksums, datasetSets = {}, {}, {}
+        for parameterSetId, datafileId in chunk:
+            target = datafiles[datafileId].get_absolute_filepath()
+            targets.setdefault(target, []).append(parameterSetId)
+            # the workers don't hash the files again, their checksum is known
+            checksums[target] = datafiles[datafileId].sha512sum
+            if len(datafileSets.get(datafileId, [])) > 1:
+                datasetSets[target] = datafileSets[datafileId]
+
+        # parsing runs in the worker processes, only the database writes are done here, once per chunk
+        items, parsed, failed = [], [], 0
+        # only the sections holding the wanted parameters are decoded (dataset by dataset for the files saved so)
+        for target, sha512sum, metadata, error in iter_extract_metadata(targets.keys(), options['name'],
+                                                                        options['schema'], parameters=set(wanted),
+                                                                        checksums=checksums, pool=pool,
+                                                                        perDataset=set(datasetSets)):
+            if error != None:
+                failed += 1
+                self.stderr.write('{0}: {1}\n'.format(target, error))
+                continue
+            if target in datasetSets:
+                # each dataset goes to its own parameter set, the datasets being saved in turn
+                if len(metadata) != len(datasetSets[target]):
+                    failed += 1
+                    self.stderr.write('{0}: {1} datasets for {2} parameter sets, skipped\n'.format(
+                        target, len(metadata), len(datasetSets[target])))
+                    continue
+                metadata = dict(zip(datasetSets[target], metadata))
+                items.extend((parameterSets[parameterSetId], metadata[parameterSetId])
+                             for parameterSetId in targets[target])
+            else:
+                items.extend((parameterSets[parameterSetId], metadata) for parameterSetId in targets[target])
+            parsed.extend(targets[target])
+        added = filter.saveMissingParametersBatch(schema, items, wanted)
+        return (parsed, failed, added)
+
+    def findIncomplete(self, schema, wantedIds, lastId=0, skipped=None):
+        """Returns the parameter sets missing some of the wanted parameters, and their datafiles, by increasing id
+        (leaving out the skipped parameter sets)"""
+        # a single aggregate query finds the parameter sets which have all the wanted parameters already
+        complete = set(row['parameterset'] for row in
+                       DatafileParameter.objects.filter(parameterset__schema=schema, parameterset__id__gt=lastId,
+                                                        name__in=wantedIds)
+                                                .values('parameterset')
+                                                .annotate(present=Count('name', distinct=True))
+                                                .filter(present=len(wantedIds)))
+        skipped = skipped or set()
+        return [(parameterSetId, datafileId) for parameterSetId, datafileId in
+                DatafileParameterSet.objects.filter(schema=schema, id__gt=lastId)
+                                            .order_by('id').values_list('id', 'dataset_file')
+                if parameterSetId not in complete and parameterSetId not in skipped]
+
+    def loadCheckpoint(self, checkpoint, version):
+        """Returns the id of the last parameter set processed (0 if there is no checkpoint), and the ids of the
+        parameter sets parsed already, by comma-separated names of the parameters they were parsed for (forgotten if
+        the parser changed since, see FlexstationFilter.PARSE_CACHE_VERSION)"""
+        if not checkpoint or not path.exists(checkpoint):
+            return (0, {})
+        try:
+            with open(checkpoint) as f:
+                state = json.load(f)
+            parsedSets = state.get('parsed', {}) if state.get('version') == version else {}
+            return (int(state['last_parameterset_id']),
+                    dict((str(key), set(parameterSetIds)) for key, parameterSetIds in parsedSets.items()))
+        except (IOError, ValueError, KeyError, TypeError, AttributeError) as e:
+            raise CommandError('Invalid checkpoint {0}: {1}'.format(checkpoint, e))
+
+    def saveCheckpoint(self, checkpoint, lastId, parsedSets, version):
+        """Records the id of the last parameter set processed and the parameter sets parsed already (written aside then
+        renamed, to survive interruptions)"""
+        if not checkpoint:
+            return
+        with open(checkpoint + '.tmp', 'w') as f:
+            json.dump({'last_parameterset_id': lastId, 'version': version,
+                       'parsed': dict((key, sorted(parameterSetIds)) for key, parameterSetIds in parsedSets.items())}, f)
+        rename(checkpoint + '.tmp', checkpoint)
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010-2011, RMIT e-Research
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+flexstation_serve.py
+
+Long-running ingestion service: extracts the metadata of the PDA files whose
+datafile ids or paths are sent to it over a socket, one per line, for bursts
+of files landing at once (e.g. after an overnight instrument sync).
+
+.. moduleauthor:: Guillaume Prevost <guillaume.prevost@rmit.edu.au>
+
+"""
+import itertools
+import multiprocessing
+import signal
+import threading
+import time
+
+from functools import partial
+from optparse import make_option
+from Queue import Queue, Empty
+from SocketServer import ThreadingTCPServer, StreamRequestHandler
+
+from django.core.management.base import BaseCommand
+from django.db import connection, DatabaseError
+
+from tardis.tardis_portal.filters.flexstation import FlexstationFilter, extract_file_metadata
+from tardis.tardis_portal.models import Dataset_File
+
+
+class RequestHandler(StreamRequestHandler):
+    """Queues each line received (a datafile id or the path of a PDA file), and acknowledges it once queued.
+    When the queue is full, the connection stops being read until there is room again, which slows the senders
+    down instead of dropping their requests. Once the service is stopping, the requests are refused.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            item = line.strip()
+            if not item:
+                continue
+            if self.server.stopping:
+                self.wfile.write('STOPPING {0}\n'.format(item))
+                return
+            self.server.requests.put(item)
+            self.wfile.write('QUEUED {0}\n'.format(item))
+
+
+class RequestServer(ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, requests):
+        ThreadingTCPServer.__init__(self, address, RequestHandler)
+        self.requests = requests
+        self.stopping = False
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ('Runs a service extracting the metadata of the PDA files whose datafile ids or paths are sent to it over '
+            'a socket, one per line')
+    option_list = BaseCommand.option_list + (
+        make_option('--host', dest='host', default='127.0.0.1',
+                    help='Address to listen on (default: 127.0.0.1)'),
+        make_option('--port', dest='port', type='int', default=8765,
+                    help='Port to listen on (default: 8765)'),
+        make_option('--workers', dest='workers', type='int', default=None,
+                    help='Number of worker processes parsing the files (default: number of CPUs)'),
+        make_option('--max-parsing', dest='max_parsing', type='int', default=None,
+                    help='Number of files parsed or waiting for a worker at once (default: twice the workers)'),
+        make_option('--parse-timeout', dest='parse_timeout', type='float', default=600.0,
+                    help='Seconds a file handed over to the workers may take to be parsed before being reported as '
+                         'failed, e.g. when its worker died (default: 600)'),
+        make_option('--max-pending', dest='max_pending', type='int', default=1000,
+                    help='Number of requests queued before the senders are slowed down (default: 1000)'),
+        make_option('--batch-size', dest='batch_size', type='int', default=100,
+                    help='Number of datafiles whose metadata is saved in a single transaction (default: 100)'),
+        make_option('--batch-timeout', dest='batch_timeout', type='float', default=2.0,
+                    help='Seconds a parsed file waits for its batch to fill before being saved (default: 2)'),
+        make_option('--name', dest='name', default='FLEXSTATION',
+                    help='Short name of the schema (default: FLEXSTATION)'),
+        make_option('--schema', dest='schema', default='http://rmit.edu.au/flexstation',
+                    help='Namespace of the schema (default: http://rmit.edu.au/flexstation)'),
+    )
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.filter = FlexstationFilter(options['name'], options['schema'])
+        self.schema = self.filter.getSchema()
+        self.filter.getOrCreateParameterNames(self.schema, self.filter.paramnames)
+
+        workers = options['workers'] or multiprocessing.cpu_count()
+        # requests received and not dispatched yet, files being parsed, and files parsed and not saved yet
+        self.requests = Queue(maxsize=options['max_pending'])
+        self.parsing = threading.BoundedSemaphore(options['max_parsing'] or workers * 2)
+        self.inflight, self.inflightLock = {}, threading.Lock() # files handed over, by token, with their deadline
+        self.tokens, self.timedOut = itertools.count(), 0
+        self.results = Queue()
+        self.pending, self.deadline = [], None # datafiles parsed and not saved yet, and when their batch is due
+        self.parsed, self.failed, self.saved, self.unsaved = 0, 0, 0, 0
+        self.stopping = False
+
+        self.pool = multiprocessing.Pool(workers)
+        server = RequestServer((options['host'], options['port']), self.requests)
+        dispatcher = threading.Thread(target=self.runDispatch)
+        for thread in (threading.Thread(target=server.serve_forever), dispatcher):
+            thread.daemon = True
+            thread.start()
+        # supervisors stop services with SIGTERM, which takes the same path as an interruption
+        signal.signal(signal.SIGTERM, self.terminate)
+        self.stdout.write('Listening on {0}:{1} with {2} workers\n'.format(options['host'], options['port'], workers))
+
+        try:
+            self.save()
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping\n')
+        finally:
+            self.stopping = server.stopping = True
+            server.shutdown()
+            server.server_close()
+            # the requests acknowledged but not dispatched yet are listed, to be sent again
+            self.requests.put(None)
+            dispatcher.join()
+            self.dropRequests()
+            # the files being parsed are still saved, the workers of the files which timed out may never return
+            self.pool.close()
+            self.waitParsing()
+            if self.timedOut:
+                self.pool.terminate()
+            self.pool.join()
+            self.save(wait=False)
+
+        self.stdout.write('{0} files parsed, {1} failed, {2} datafiles updated, {3} not saved\n'.format(
+            self.parsed, self.failed, self.saved, self.unsaved))
+
+    def terminate(self, signum, frame):
+        """SIGTERM handler, stopping the service as an interruption does (the files parsed are saved first)
+        """
+        if not self.stopping:
+            raise KeyboardInterrupt()
+
+    def runDispatch(self):
+        """Runs the dispatch thread, closing its database connection once it stops
+        """
+        try:
+            self.dispatch()
+        finally:
+            connection.close()
+
+    def dispatch(self):
+        """Hands the requests over to the worker processes, as long as fewer than --max-parsing files are being
+        parsed (the datafiles of the ids received are looked up here, the files are only read by the workers).
+        A request which can't be handed over is reported as failed, and the next ones are still processed.
+        """
+        while True:
+            item = self.requests.get()
+            if item == None:
+                return
+            if self.stopping:
+                self.dropRequest(item)
+                continue
+
+            try:
+                datafiles, target, sha512sum = self.lookup(item)
+            except Exception as e:
+                if isinstance(e, DatabaseError):
+                    connection.close() # the next request is looked up on a new connection
+                self.results.put((item, None, (item, None, None, str(e))))
+                continue
+
+            self.acquireSlot()
+            token = self.track(item)
+            if self.stopping:
+                self.release(token)
+                self.dropRequest(item)
+                continue
+            try:
+                self.pool.apply_async(extract_file_metadata,
+                                      ((target, self.options['name'], self.options['schema'], None, sha512sum, False),),
+                                      callback=partial(self.collect, token, item, datafiles))
+            except Exception as e:
+                self.release(token)
+                self.results.put((item, None, (item, None, None, str(e))))
+
+    def acquireSlot(self):
+        """Waits until fewer than --max-parsing files are being parsed. The files handed over more than
+        --parse-timeout seconds ago are reported as failed meanwhile, so that a worker which died doesn't keep its slot
+        """
+        while not self.parsing.acquire(False):
+            self.expire()
+            time.sleep(0.1)
+
+    def track(self, item):
+        """Records a file about to be handed over to the workers, holding a slot until it is parsed or times out
+        :param item: the request
+        :type item: str
+        :returns token: the token to release the slot with
+        :type token: int
+        """
+        with self.inflightLock:
+            token = next(self.tokens)
+            self.inflight[token] = (item, time.time() + self.options['parse_timeout'])
+        return token
+
+    def release(self, token):
+        """Releases the slot of a file once it is parsed, failed or timed out, only the first time
+        :param token: the token of the file
+        :type token: int
+        :returns released: False if the slot was already released
+        :type released: bool
+        """
+        with self.inflightLock:
+            if self.inflight.pop(token, None) == None:
+                return False
+        self.parsing.release()
+        return True
+
+    def expire(self):
+        """Reports the files handed over more than --parse-timeout seconds ago as failed, releasing their slots
+        """
+        now = time.time()
+        with self.inflightLock:
+            expired = [(token, item) for token, (item, deadline) in self.inflight.items() if deadline <= now]
+        for token, item in expired:
+            if self.release(token):
+                self.timedOut += 1
+                self.results.put((item, None, (item, None, None, 'not parsed after {0} seconds, its worker may have '
+                                               'died'.format(self.options['parse_timeout']))))
+
+    def waitParsing(self):
+        """Waits for the files handed over to the workers to be parsed or to time out, once the service is stopping
+        """
+        while self.inflight:
+            self.expire()
+            time.sleep(0.1)
+
+    def lookup(self, item):
+        """Returns the datafiles to save the metadata of a file to (None to find them by checksum), the path of the
+        file and its checksum if it is known
+        :param item: the request, a datafile id or the path of a PDA file
+        :type item: str
+        :returns request: the datafiles, the path and the checksum
+        :type request: tuple
+        """
+        if not item.isdigit():
+            return (None, item, None)
+        try:
+            datafile = Dataset_File.objects.get(id=int(item))
+        except Dataset_File.DoesNotExist:
+            raise ValueError('No datafile {0}'.format(item))
+        target = datafile.get_absolute_filepath()
+        if not target:
+            raise ValueError('The file of datafile {0} is not stored locally'.format(item))
+        return ([datafile], target, datafile.sha512sum)
+
+    def dropRequests(self):
+        """Lists the requests left in the queue once the service is stopping
+        """
+        while True:
+            try:
+                item = self.requests.get_nowait()
+            except Empty:
+                return
+            if item != None:
+                self.dropRequest(item)
+
+    def dropRequest(self, item):
+        """Lists a request acknowledged but not processed, to be sent again
+        :param item: the request
+        :type item: str
+        """
+        self.stderr.write('{0}: not processed, the service is stopping\n'.format(item))
+
+    def collect(self, token, item, datafiles, result):
+        """Receives the metadata of a file parsed by a worker process, to be saved by the main thread (unless the
+        file already timed out, and was reported as failed)
+        """
+        if self.release(token):
+            self.results.put((item, datafiles, result))
+
+    def save(self, wait=True):
+        """Saves the metadata of the files parsed, in batches of --batch-size datafiles. A batch is saved when it is
+        full, or --batch-timeout seconds after its first file was parsed.
+        :param wait: if False, only saves the files already parsed, and returns
+        :type wait: bool
+        """
+        while True:
+            timeout = max(self.deadline - time.time(), 0) if self.deadline != None else 1.0
+            try:
+                # never block without a timeout, so that the service can be interrupted
+                item, datafiles, (target, sha512sum, metadata, error) = self.results.get(wait, timeout)
+            except Empty:
+                if self.pending and (not wait or time.time() >= self.deadline):
+                    self.saveBatch()
+                if not wait:
+                    return
+                continue
+
+            if error != None:
+                self.failed += 1
+                self.stderr.write('{0}: {1}\n'.format(item, error))
+                continue
+            self.parsed += 1
+            if not metadata:
+                continue
+            try:
+                if datafiles == None:
+                    datafiles = list(Dataset_File.objects.filter(sha512sum=sha512sum))
+            except DatabaseError as e:
+                self.unsaved += 1
+                self.stderr.write('{0}: failed to find its datafiles: {1}\n'.format(item, e))
+                connection.close()
+                continue
+            self.pending.extend((datafile, metadata) for datafile in datafiles)
+            if self.deadline == None:
+                self.deadline = time.time() + self.options['batch_timeout']
+            if len(self.pending) >= self.options['batch_size']:
+                self.saveBatch()
+
+    def saveBatch(self):
+        """Saves the metadata of the pending datafiles in a single transaction. If it fails, the datafiles of the
+        batch are listed and the service keeps running (the batch is kept if the service is interrupted meanwhile,
+        to be saved on the way out)
+        """
+        try:
+            self.saved += self.filter.saveFlexstationMetadataBatch(self.schema, self.pending)
+        except Exception as e:
+            self.unsaved += len(self.pending)
+            self.stderr.write('Failed to save the metadata of datafiles {0}: {1}\n'.format(
+                ', '.join(str(datafile.id) for datafile, metadata in self.pending), e))
+            if isinstance(e, DatabaseError):
+                connection.close() # the next batch is saved on a new connection
+        self.pending, self.deadline = [], None
+        self.stdout.write('{0} datafiles updated ({1} files parsed, {2} failed, {3} requests pending)\n'.format(
+            self.saved, self.parsed, self.failed, self.requests.qsize()))
@@ -0,0 +1,320 @@
+"""
+Benchmarks of the Flexstation filter.
+
+Times the extraction of the metadata, each section reader and (with --call) the
+whole post-save callback against the test database, on the test files and on
+synthetic enlarged files (many datasets, 384/1536 wells, long kinetic runs).
+
+    python benchmark_flexstation.py --save-baseline baseline.json
+    python benchmark_flexstation.py --baseline baseline.json
+
+The run fails if a case is slower than the baseline by more than --tolerance.
+"""
+import json
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+from os import path
+from struct import pack, unpack
+
+from tardis.tardis_portal.filters.flexstation import FlexstationFilter, PdaBuffer
+
+try:
+    import tracemalloc
+except ImportError: # Python < 3.4 without the pytracemalloc backport, only the peak of the whole process is reported
+    tracemalloc = None
+
+
+FIXTURES_PATH = path.join(path.dirname(__file__), 'fixtures')
+TEST_FILES = ('050511V1 Pmutants rep1.pda',
+              '050511V1 Pmutants rep2.pda',
+              '050511V1 Pmutants rep3.pda',
+              '061412 BIM1 and 2APBlatin square.pda',
+              '230511 V1 Pmuants rep1.pda',
+              'BGD131010 3759 and 3720.pda',
+              'BGD131010 3833 and 3971.pda',
+)
+SYNTHETIC_FILES = (
+    # name, datasets, wells, columns read, kinetic points
+    ('datasets-16', 16, None, None, None),
+    ('wells-384', 1, 384, 24, None),
+    ('wells-1536', 1, 1536, 48, None),
+    ('kinetic-1000', 1, None, None, 1000),
+)
+SECTION_READERS = ('readHeader', 'indexSections', 'readExperimentSection', 'readAnalysisSection', 'readWells',
+                   'readPlateSection', 'readPlateData', 'readPlateDescriptor', 'readFlexSites', 'readCalcPlateBody')
+MINIMUM_SECONDS = 0.001 # timings below this are too noisy to be compared to the baseline
+
+
+def read_syscalls():
+    """Returns the number of read syscalls made by the process so far (None if not available)"""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('syscr:'):
+                    return int(line.split()[1])
+    except IOError:
+        return None
+
+
+def process_peak_memory():
+    """Returns the peak resident memory of the whole process so far, in KB (it includes all the previous cases)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def traced_peak_memory(function, targets):
+    """Returns the peak memory allocated while running a function once on each file, in KB (requires tracemalloc)"""
+    tracemalloc.start()
+    try:
+        for target in targets:
+            function(target)
+        return tracemalloc.get_traced_memory()[1] / 1024.0
+    finally:
+        tracemalloc.stop()
+
+
+def make_synthetic_file(source, target, datasets=1, wells=None, columns=None, kineticPoints=None):
+    """Writes an enlarged copy of a single-dataset PDA file
+    :param source: the path of the PDA file to enlarge
+    :param target: the path of the file to write
+    :param datasets: the number of copies of the dataset
+    :param wells: the number of wells of the plate (unchanged if None)
+    :param columns: the number of columns read, 8 flex sites per column (unchanged if None)
+    :param kineticPoints: the number of kinetic points of each flex site (unchanged if None)
+    """
+    filter = FlexstationFilter("Benchmark", "http://rmit.edu.au/flexstation_benchmark")
+    with open(source, 'rb') as f:
+        data = f.read()
+
+    buffer = PdaBuffer(data)
+    filter.readHeader(buffer, {})
+    datasetStart = buffer.tell()
+
+    # Wells table: count followed by CSWell structures
+    wellsStart = data.find('\x06CSWell', datasetStart) - 4
+    buffer.seek(wellsStart)
+    filter.readWells(buffer)
+    wellsEnd = buffer.tell()
+    if wells:
+        template = data[wellsStart + 4:data.find('\x06CSWell', wellsStart + 5)]
+        templateRest = template[template.find('\x00', 7) + 5:] # skipped bytes, plate name and trailer
+        plateColumns = int(round((wells * 1.5) ** 0.5))
+        table = [pack('>I', wells)]
+        for i in range(wells):
+            row, column = divmod(i, plateColumns)
+            rowName = chr(ord('A') + row % 26) * (row // 26 + 1)
+            table.append('\x06CSWell{0}{1}\x00'.format(rowName, column + 1) + pack('>HH', row + 1, column + 1)
+                         + templateRest)
+        data = data[:wellsStart] + ''.join(table) + data[wellsEnd:]
+
+    # Plate data: number of columns read and number of reads
+    plateData = data.find('\x0bCSPlateData', wellsStart)
+    numberOfColumns, readNumber = unpack('>HI', data[plateData + 20:plateData + 26])
+    wavelengthsNumber = unpack('>I', data[plateData + 26:plateData + 30])[0]
+    flexSitesStart = data.find('\x0aCSFlexSite', plateData)
+    buffer = PdaBuffer(data)
+    buffer.seek(flexSitesStart)
+    for i in range(numberOfColumns * filter.NUMBER_OF_ROWS):
+        filter.readFlexSite(buffer)
+    flexSitesEnd = buffer.tell()
+    if columns or kineticPoints:
+        columns = columns or numberOfColumns
+        kineticPoints = kineticPoints or readNumber
+        values = pack('>{0}d'.format(wavelengthsNumber * kineticPoints + 1),
+                      *([200.0 + i % 50 for i in range(wavelengthsNumber * kineticPoints)] + [0.0]))
+        times = pack('>{0}d'.format(wavelengthsNumber * kineticPoints + 1),
+                     *([i * 3.9 for i in range(wavelengthsNumber * kineticPoints)] + [0.0]))
+        sites = ['\x0aCSFlexSite' + pack('>IIII', 2, kineticPoints, i + 1, len(values)) + values + times
+                 for i in range(columns * filter.NUMBER_OF_ROWS)]
+        data = (data[:plateData + 20] + pack('>HI', columns, kineticPoints) + data[plateData + 26:flexSitesStart]
+                + ''.join(sites) + data[flexSitesEnd:])
+
+    # Datasets: copies of the whole dataset
+    if datasets > 1:
+        buffer = PdaBuffer(data)
+        buffer.seek(datasetStart)
+        filter.readDataset(buffer, {})
+        datasetEnd = buffer.tell()
+        header = re.sub(r'##BLOCKS= *\d+ *', lambda match: '##BLOCKS= {0}'.format(datasets).ljust(len(match.group())),
+                        data[:datasetStart], 1)
+        data = header + data[datasetStart:datasetEnd] * datasets + data[datasetEnd:]
+
+    with open(target, 'wb') as f:
+        f.write(data)
+
+
+def measure(function, targets, repeat):
+    """Runs a function on each file, several times, and returns the performance figures"""
+    size = sum(path.getsize(target) for target in targets)
+    syscalls = read_syscalls()
+    start = time.time()
+    for i in range(repeat):
+        for target in targets:
+            function(target)
+    elapsed = max(time.time() - start, 1e-9)
+    result = {'seconds': elapsed / repeat,
+              'files_per_sec': len(targets) * repeat / elapsed,
+              'bytes_per_sec': size * repeat / elapsed}
+    if syscalls != None:
+        result['syscalls_per_file'] = (read_syscalls() - syscalls) / float(len(targets) * repeat)
+    # memory is measured on a separate run, tracing the allocations slowing the function down
+    if tracemalloc != None:
+        result['peak_memory_kb'] = traced_peak_memory(function, targets)
+    else:
+        result['process_peak_memory_kb'] = process_peak_memory()
+    return result
+
+
+def benchmark_extraction(cases, repeat):
+    """Times extractMetadata alone"""
+    filter = FlexstationFilter("Benchmark", "http://rmit.edu.au/flexstation_benchmark")
+    return dict((name, measure(filter.extractMetadata, targets, repeat)) for name, targets in cases)
+
+
+def benchmark_readers(cases, repeat):
+    """Times each section reader, by wrapping them on a filter instance"""
+    results = {}
+    for name, targets in cases:
+        filter = FlexstationFilter("Benchmark", "http://rmit.edu.au/flexstation_benchmark")
+        timings = dict((reader, 0.0) for reader in SECTION_READERS)
+
+        def timed(reader, method):
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    timings[reader] += time.time() - start
+            return wrapper
+        for reader in SECTION_READERS:
+            setattr(filter, reader, timed(reader, getattr(filter, reader)))
+
+        for i in range(repeat):
+            for target in targets:
+                filter.extractMetadata(target)
+        results[name] = dict((reader, {'seconds': seconds / repeat}) for reader, seconds in timings.items())
+    return results
+
+
+def benchmark_call(cases, repeat):
+    """Times the whole post-save callback against a test database (requires the Django test settings)"""
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    from tardis.tardis_portal.models import Dataset, Dataset_File, Replica, Location
+    from tardis.tardis_portal.tests.test_download import get_size_and_sha512sum
+
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+    connection.use_debug_cursor = True
+    Location.force_initialize()
+
+    dataset = Dataset(description='benchmark')
+    dataset.save()
+    results = {}
+    for name, targets in cases:
+        datafiles = []
+        for target in targets:
+            size, sha512sum = get_size_and_sha512sum(target)
+            datafile = Dataset_File(dataset=dataset, filename=path.basename(target), size=size, sha512sum=sha512sum)
+            datafile.save()
+            location = Location.load_location({
+                'name': 'benchmark-flexstation', 'url': 'file://' + path.abspath(path.dirname(target)),
+                'type': 'external', 'priority': 10, 'transfer_provider': 'local'})
+            replica = Replica(datafile=datafile, url='file://' + path.abspath(target), protocol='file',
+                              location=location)
+            replica.verify()
+            replica.save()
+            datafiles.append(Dataset_File.objects.get(pk=datafile.pk))
+        byTarget = dict(zip(targets, datafiles))
+
+        filter = FlexstationFilter("Benchmark", "http://rmit.edu.au/flexstation_benchmark")
+        filter.parseCache = None
+
+        def call(target):
+            byTarget[target].getParameterSets().delete()
+            filter(None, instance=byTarget[target])
+
+        queries = len(connection.queries)
+        results[name] = measure(call, targets, repeat)
+        results[name]['queries_per_file'] = (len(connection.queries) - queries) / float(len(targets) * repeat)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns the list of the cases slower than in the baseline"""
+    regressions = []
+    for stage, cases in results.items():
+        for name, figures in cases.items():
+            reference = baseline.get(stage, {}).get(name)
+            if not reference:
+                continue
+            if 'seconds' in figures:
+                figures = {'': figures}
+                reference = {'': reference}
+            for key in figures:
+                if key not in reference or max(figures[key]['seconds'], reference[key]['seconds']) < MINIMUM_SECONDS:
+                    continue
+                if figures[key]['seconds'] > reference[key]['seconds'] * (1 + tolerance):
+                    regressions.append('{0}: {1:.6f}s (baseline {2:.6f}s)'.format(
+                        ' '.join(label for label in (stage, name, key) if label), figures[key]['seconds'],
+                        reference[key]['seconds']))
+    return regressions
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--repeat', type='int', default=5, help='number of runs over each case (default: 5)')
+    parser.add_option('--call', action='store_true', default=False,
+                      help='also time the post-save callback against the test database')
+    parser.add_option('--baseline', help='JSON results of a previous run to compare to')
+    parser.add_option('--save-baseline', help='file to save the JSON results to')
+    parser.add_option('--tolerance', type='float', default=0.25,
+                      help='slowdown tolerated before failing, as a fraction of the baseline (default: 0.25)')
+    options, args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        cases = [('fixtures', [path.join(FIXTURES_PATH, name) for name in TEST_FILES])]
+        for name, datasets, wells, columns, kineticPoints in SYNTHETIC_FILES:
+            target = path.join(directory, name + '.pda')
+            make_synthetic_file(path.join(FIXTURES_PATH, TEST_FILES[0]), target, datasets, wells, columns,
+                                kineticPoints)
+            cases.append((name, [target]))
+
+        results = {'extractMetadata': benchmark_extraction(cases, options.repeat),
+                   'readers': benchmark_readers(cases, options.repeat)}
+        if options.call:
+            results['call'] = benchmark_call(cases, options.repeat)
+    finally:
+        shutil.rmtree(directory)
+
+    for stage in sorted(results):
+        for name in sorted(results[stage]):
+            figures = results[stage][name]
+            if 'seconds' in figures:
+                print('{0:16} {1:14} {2}'.format(stage, name, ', '.join(
+                    '{0}={1:.6g}'.format(key, figures[key]) for key in sorted(figures))))
+            else:
+                print('{0:16} {1:14} {2}'.format(stage, name, ', '.join(
+                    '{0}={1:.6f}s'.format(key, figures[key]['seconds']) for key in SECTION_READERS)))
+
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,41 @@
-from os import path
+import itertools
+import struct
+import threading
+
+from os import path, remove
+from shutil import rmtree
+from tempfile import mkdtemp
+from StringIO import StringIO
+from Queue import Queue
 from compare import expect, ensure
 
 from django.conf import settings
+from django.core.cache import get_cache
 from django.core.urlresolvers import reverse
+from django.db import DatabaseError
 from django.test import TestCase
 from django.test.client import Client
 
-from tardis.tardis_portal.filters.flexstation import FlexstationFilter
+try:
+    from django.db.transaction import atomic
+except ImportError: # Django < 1.6
+    from django.db.transaction import commit_on_success as atomic
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from tardis.tardis_portal.filters.flexstation import FlexstationFilter, PdaBuffer, iter_extract_metadata, \
+    extract_flexstation_metadata, load_plate_data, get_filter, get_dataset_pool, FLEX_SITE_HEADER, FlexstationMetrics
+from tardis.tardis_portal.filters import flexstation
 from tardis.tardis_portal.models import User, UserProfile, \
-    ObjectACL, Experiment, Dataset, Dataset_File, Replica, Location
+    ObjectACL, Experiment, Dataset, Dataset_File, Replica, Location, Schema, ParameterName, DatafileParameter, \
+    DatafileParameterSet
 from tardis.tardis_portal.models.parameters import DatasetParameterSet
+from tardis.tardis_portal.management.commands.flexstation_ingest import Command as IngestCommand
+from tardis.tardis_portal.management.commands.flexstation_reextract import Command as ReextractCommand
+from tardis.tardis_portal.management.commands.flexstation_serve import Command as ServeCommand
 from tardis.tardis_portal.ParameterSetManager import ParameterSetManager
 
 from tardis.tardis_portal.tests.test_download import get_size_and_sha512sum
@@ -112,6 +138,31 @@ class FlexstationFilterTestCase(TestCase):
         expect(datafile.getParameterSets().count()).to_equal(1)
 
 
+    def testFlexstationAsynchronous(self):
+        """
+        Tests the extraction is done by the Celery task (run eagerly during tests) in asynchronous mode
+        """
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test", True)
+        filter.__call__(None, instance=self.datafiles[0])
+        datafile = Dataset_File.objects.get(id=self.datafiles[0].id)
+        expect(datafile.getParameterSets().count()).to_equal(1)
+
+        psm = ParameterSetManager(datafile.getParameterSets()[0])
+        expect(psm.get_param('softmax_version', True)).to_equal('5.42.1.0')
+
+        # Check running the task again doesn't create a duplicate parameter set
+        extract_flexstation_metadata(self.datafiles[0].id, "Flexstation Test Schema",
+                                     "http://rmit.edu.au/flexstation_test")
+        datafile = Dataset_File.objects.get(id=self.datafiles[0].id)
+        expect(datafile.getParameterSets().count()).to_equal(1)
+
+        # Check the tasks share a single filter, created on first use
+        filter = get_filter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+        expect(get_filter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test") is filter).to_be_truthy()
+        expect(get_filter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test", perDataset=True)
+               is filter).to_be_falsy()
+
+
     def testFlexstationAllFields(self):
         """
         Simple test running the filter and making sure the Softmax version number was saved
@@ -178,6 +229,896 @@ class FlexstationFilterTestCase(TestCase):
         #expect(psm.get_param('pmt_settings', True)).to_equal('')
 
 
+    def testFlexstationPerDataset(self):
+        """
+        Tests extracting the metadata of each experiment of a file separately, and saving them as parameter sets
+        """
+        file_path = path.join(path.dirname(__file__), 'fixtures', 'BGD131010 3759 and 3720.pda')
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test", perDataset=True)
+
+        datasets = list(filter.iterDatasets(file_path))
+        expect(len(datasets)).to_equal(2)
+        expect(datasets[0]['experiment_name']).to_equal('BasicEndpoint')
+        expect(datasets[1]['experiment_name']).to_equal('Exp01')
+        expect(datasets[1]['softmax_version']).to_equal('5.4.52.1.0')
+        expect('instrument_info' in datasets[0]).to_equal(False)
+
+        # Stop after the first experiment
+        for metadata in filter.iterDatasets(file_path):
+            break
+        expect(metadata['experiment_name']).to_equal('BasicEndpoint')
+
+        filter.__call__(None, instance=self.datafiles[5])
+        datafile = Dataset_File.objects.get(id=self.datafiles[5].id)
+        parameterSets = datafile.getParameterSets().order_by('id')
+        expect(parameterSets.count()).to_equal(2)
+        expect(ParameterSetManager(parameterSets[0]).get_param('experiment_name', True)).to_equal('BasicEndpoint')
+        expect(ParameterSetManager(parameterSets[1]).get_param('experiment_name', True)).to_equal('Exp01')
+        expect(ParameterSetManager(parameterSets[1]).get_param('instrument_info', True)).to_equal(
+            'Flexstation III ROM v3.0.22 16Feb11')
+
+        # Check we won't create duplicate parameter sets
+        filter.__call__(None, instance=self.datafiles[5])
+        expect(Dataset_File.objects.get(id=self.datafiles[5].id).getParameterSets().count()).to_equal(2)
+
+
+    def testFlexstationParallelDatasets(self):
+        """
+        Tests the datasets of a file parsed by several threads are merged in order
+        """
+        file_path = path.join(path.dirname(__file__), 'fixtures', 'BGD131010 3833 and 3971.pda')
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+        filter.datasetThreads = 1
+        metadata = filter.extractMetadata(file_path)
+        datasets = list(filter.iterDatasets(file_path))
+
+        filter.datasetThreads = 2
+        expect(filter.extractMetadata(file_path)).to_equal(metadata)
+        expect(list(filter.iterDatasets(file_path))).to_equal(datasets)
+
+        # Build a file holding the dataset of another test file three times, to check the notes of every dataset
+        # are appended in order whatever the number of threads
+        with open(path.join(path.dirname(__file__), 'fixtures', '050511V1 Pmutants rep1.pda'), 'rb') as f:
+            data = f.read()
+        filter.datasetThreads = 1
+        notes = filter.extractMetadata(data)['analysis_notes']
+        buffer = PdaBuffer(data)
+        filter.readHeader(buffer, {})
+        datasetStart = buffer.tell()
+        data = data[:datasetStart].replace('##BLOCKS= 1', '##BLOCKS= 3', 1) + data[datasetStart:] * 3
+        metadata = filter.extractMetadata(data)
+        datasets = list(filter.iterDatasets(data))
+        expect(metadata['analysis_notes']).to_equal('. '.join([notes] * 3))
+        for threads in (2, 4):
+            filter.datasetThreads = threads
+            expect(filter.extractMetadata(data)).to_equal(metadata)
+            expect(list(filter.iterDatasets(data))).to_equal(datasets)
+
+        # Check the pools are kept by number of threads, and created again in a forked process
+        pool = get_dataset_pool(2)
+        expect(get_dataset_pool(2) is pool).to_be_truthy()
+        expect(get_dataset_pool(4) is pool).to_be_falsy()
+        flexstation.DATASET_POOLS_PID = -1
+        expect(get_dataset_pool(2) is pool).to_be_falsy()
+        pool.terminate()
+
+        # Check the filters share a single pool of threads, instead of starting threads for each of them
+        threads = []
+        for i in range(5):
+            filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+            filter.datasetThreads = 4
+            expect(filter.extractMetadata(file_path)).to_equal(metadata)
+            threads.append(threading.active_count())
+        expect(len(set(threads))).to_equal(1)
+
+
+    def testFlexstationPeekHeader(self):
+        """
+        Tests reading the version, number of datasets and first experiment name from the beginning of the files only
+        """
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+
+        header = filter.peekHeader(path.join(path.dirname(__file__), 'fixtures', 'BGD131010 3759 and 3720.pda'))
+        expect(header).to_equal({'softmax_version': '5.4.52.1.0', 'number_of_datasets': 2,
+                                 'experiment_name': 'BasicEndpoint'})
+        header = filter.peekHeader(path.join(path.dirname(__file__), 'fixtures', '050511V1 Pmutants rep1.pda'))
+        expect(header).to_equal({'softmax_version': '5.42.1.0', 'number_of_datasets': 1,
+                                 'experiment_name': 'Experiment#1'})
+
+        # The experiment name is left out if it isn't in the bytes read, other files are rejected
+        header = filter.peekHeader(path.join(path.dirname(__file__), 'fixtures', '050511V1 Pmutants rep1.pda'), 1024)
+        expect(header).to_equal({'softmax_version': '5.42.1.0', 'number_of_datasets': 1})
+        expect(filter.peekHeader(__file__)).to_be_none()
+
+        # Check truncated headers are rejected too
+        expect(filter.peekHeader("\x00\x04 5.1\x00\x00##BLOCKS= 1")).to_be_none()
+        expect(filter.peekHeader("\x00\x04 5.1\x00")).to_be_none()
+        expect(filter.extractMetadata("\x00\x04 5.1\x00\x00##BLOCKS= 1")).to_equal({})
+
+
+    def testFlexstationSniffing(self):
+        """
+        Tests PDA files are recognised from their first bytes, and other files are skipped before any query
+        """
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+        for file_path in self.TEST_FILES_PATH:
+            expect(filter.isPdaFile(path.join(path.dirname(__file__), 'fixtures', file_path))).to_be_truthy()
+        expect(filter.isPdaFile(__file__)).to_be_falsy()
+
+        class NotPdaFile(object):
+            def get_absolute_filepath(self):
+                return path.join(path.dirname(__file__), 'test_flexstation.py')
+        with self.assertNumQueries(0):
+            expect(filter.processDatafile(NotPdaFile())).to_be_none()
+
+
+    def testFlexstationBatchExtraction(self):
+        """
+        Tests extracting the metadata of all the test files in a pool of worker processes
+        """
+        file_paths = [path.join(path.dirname(__file__), 'fixtures', file_path) for file_path in self.TEST_FILES_PATH]
+        file_paths.append(path.join(path.dirname(__file__), 'fixtures', 'missing.pda'))
+
+        results = dict((result[0], result) for result in iter_extract_metadata(file_paths, workers=2))
+        expect(len(results)).to_equal(8)
+
+        # Check the results match the datafiles
+        for datafile, file_path in zip(self.datafiles, file_paths):
+            target, sha512sum, metadata, error = results[file_path]
+            expect(error).to_equal(None)
+            expect(sha512sum).to_equal(datafile.sha512sum)
+            expect(metadata['softmax_version'].startswith('5.')).to_be_truthy()
+
+        # Check a missing file is reported as an error
+        target, sha512sum, metadata, error = results[file_paths[-1]]
+        expect(metadata).to_equal(None)
+        expect(error).to_be_truthy()
+
+        # Check the files whose checksum is known aren't hashed again
+        results = list(iter_extract_metadata(file_paths[:1], workers=1,
+                                             checksums={file_paths[0]: self.datafiles[0].sha512sum}))
+        expect(results[0][1]).to_equal(self.datafiles[0].sha512sum)
+        expect(results[0][2]['softmax_version']).to_equal('5.42.1.0')
+
+
+    def testFlexstationExtractPlateData(self):
+        """
+        Tests extracting the readings of the wells from the flex sites
+        """
+        file_path = path.join(path.dirname(__file__), 'fixtures', '050511V1 Pmutants rep1.pda')
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+
+        plates = filter.extractPlateData(file_path)
+        expect(len(plates)).to_equal(1)
+
+        # 9 columns of 8 wells, read at 2 wavelengths, 65 times
+        plate = plates[0]
+        expect(plate['values'].shape).to_equal((72, 2, 65))
+        expect(plate['read_times'].shape).to_equal((72, 2, 65))
+        expect(list(plate['well_ids'][:10])).to_equal([1, 2, 3, 4, 5, 6, 7, 8, 9, 13])
+        expect(round(plate['values'][0, 0, 0], 3)).to_equal(230.509)
+        expect(round(plate['values'][0, 1, 0], 3)).to_equal(202.42)
+        expect(round(plate['read_times'][0, 0, 1], 4)).to_equal(5.2888)
+        expect(len(plate['timestamps'])).to_equal(65)
+        expect(plate['timestamps'][1]).to_equal(3.9)
+
+
+    def testFlexstationExtractPlateDataMultipleDatasets(self):
+        """
+        Tests extracting the readings of the wells of every dataset of a file, when a dataset with readings is
+        followed by other datasets
+        """
+        file_path = path.join(path.dirname(__file__), 'fixtures', '050511V1 Pmutants rep1.pda')
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+        with open(file_path, 'rb') as f:
+            data = f.read()
+
+        # Build a file holding the dataset of the test file twice
+        buffer = PdaBuffer(data)
+        filter.readHeader(buffer, {})
+        datasetStart = buffer.tell()
+        header = data[:datasetStart].replace('##BLOCKS= 1', '##BLOCKS= 2', 1)
+        expect(len(header)).to_equal(datasetStart)
+        data = header + data[datasetStart:] * 2
+
+        plates = filter.extractPlateData(data)
+        expect(len(plates)).to_equal(2)
+        for plate in plates:
+            expect(plate['values'].shape).to_equal((72, 2, 65))
+            expect(round(plate['values'][0, 0, 0], 3)).to_equal(230.509)
+
+        # Check the datasets without readings are skipped
+        file_path = path.join(path.dirname(__file__), 'fixtures', 'BGD131010 3833 and 3971.pda')
+        plates = filter.extractPlateData(file_path)
+        expect(len(plates)).to_equal(1)
+        expect(plates[0]['values'].shape).to_equal((96, 2, 39))
+
+
+    def testFlexstationSectionIndex(self):
+        """
+        Tests indexing the structures of a file, and reading a single one of them
+        """
+        file_path = path.join(path.dirname(__file__), 'fixtures', '050511V1 Pmutants rep1.pda')
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+
+        with PdaBuffer.open(file_path) as f:
+            datasets = filter.indexSections(f)
+        expect(len(datasets)).to_equal(1)
+        expect(datasets[0]['CSExperimentSection']).to_equal([2418])
+        expect(len(datasets[0]['CSWell'])).to_equal(96)
+        expect(len(datasets[0]['CSFlexSite'])).to_equal(72)
+        expect(datasets[0]['CSFlexSite'][1] - datasets[0]['CSFlexSite'][0]).to_equal(2123)
+
+        body = filter.extractSection(file_path, "CSCalcPlateBody")
+        expect(body[4]).to_equal(filter.extractMetadata(file_path)['instrument_info'])
+        expect(filter.extractSection(file_path, "CSCalcPlateBody", 1)).to_be_none()
+        expect(filter.extractSection(file_path, "CSGraphSection")).to_be_none()
+
+
+    def testFlexstationStructures(self):
+        """
+        Tests the section readers return their fields as native numbers, and format the strings of the metadata
+        """
+        file_path = path.join(path.dirname(__file__), 'fixtures', 'BGD131010 3833 and 3971.pda')
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+        metadata = filter.extractMetadata(file_path)
+
+        plateData = filter.extractSection(file_path, "CSPlateData", 1)
+        expect(plateData.readNumber).to_equal(metadata['kinetic_points'])
+        expect(len(plateData.emWavelengths)).to_equal(plateData.wavelengthsNumber)
+        expect(plateData.emValues).to_equal(metadata['read_wavelength'])
+        expect(plateData.trans).to_equal(metadata['trans'])
+        expect(hasattr(plateData, '__dict__')).to_be_falsy()
+
+        body = filter.extractSection(file_path, "CSCalcPlateBody", 1)
+        expect(body.instrumentInfos).to_equal(metadata['instrument_info'])
+        expect(tuple(body)[4]).to_equal(body.instrumentInfos)
+        expect(filter.extractSection(file_path, "CSExperimentSection", 1).name).to_equal(metadata['experiment_name'])
+
+
+    def testFlexstationWantedParameters(self):
+        """
+        Tests only the sections holding the wanted parameters are decoded
+        """
+        file_path = path.join(path.dirname(__file__), 'fixtures', 'BGD131010 3833 and 3971.pda')
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+        metadata = filter.extractMetadata(file_path)
+
+        def failingReader(f, *args):
+            raise AssertionError('The section should not be decoded')
+        filter.readFlexSites = filter.readWells = filter.readAnalysisSection = filter.readCalcPlateBody = failingReader
+        expect(filter.extractMetadata(file_path, parameters=set(['strips', 'kinetic_points', 'softmax_version']))) \
+            .to_equal({'strips': metadata['strips'], 'kinetic_points': metadata['kinetic_points'],
+                       'softmax_version': metadata['softmax_version']})
+        expect(filter.extractMetadata(file_path, parameters=set())).to_equal({})
+
+
+    def testFlexstationPersistedSectionIndex(self):
+        """
+        Tests the section index of a file is persisted, and reused to parse a file with the same checksum
+        """
+        file_path = path.join(path.dirname(__file__), 'fixtures', '050511V1 Pmutants rep1.pda')
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+        filter.indexPath = mkdtemp()
+        try:
+            sha512sum = self.datafiles[0].sha512sum
+            metadata = filter.extractMetadata(file_path, sha512sum)
+            index_path = filter.getSectionIndexPath(sha512sum)
+            expect(path.exists(index_path)).to_be_truthy()
+
+            with PdaBuffer.open(file_path) as f:
+                expect(filter.loadSectionIndex(sha512sum)).to_equal(filter.indexSections(f))
+
+            # Parse the file again, without indexing it
+            def failingIndexSections(f, start=0):
+                raise AssertionError('The file should not be indexed again')
+            filter.indexSections = failingIndexSections
+            expect(filter.extractMetadata(file_path, sha512sum)).to_equal(metadata)
+
+            # A corrupted index is ignored
+            with open(index_path, 'wb') as f:
+                f.write('PDAI')
+            expect(filter.loadSectionIndex(sha512sum)).to_be_none()
+        finally:
+            rmtree(filter.indexPath)
+
+
+    def testFlexstationMetrics(self):
+        """
+        Tests the time and bytes spent on each section of a file are recorded, and exported for Prometheus
+        """
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+        filter.metrics = FlexstationMetrics()
+        metrics_dir = mkdtemp()
+        filter.metricsTextfile = path.join(metrics_dir, 'flexstation.prom')
+        try:
+            filter.__call__(None, instance=self.datafiles[0])
+
+            text = open(filter.metricsTextfile).read()
+            expect(text).to_contain('flexstation_files_total{status="ok"} 1')
+            expect(text).to_contain('flexstation_section_bytes_total{section="CSWell"} 3100')
+            expect(text).to_contain('flexstation_section_reads_total{section="database"}')
+            expect(text).to_contain('flexstation_file_seconds_count 1')
+            expect(filter.metrics.sectionReads['CSFlexSite']).to_equal(1)
+            expect(filter.metrics.sectionFailures).to_equal({})
+            expect(filter.fileMetrics).to_be_none()
+        finally:
+            rmtree(metrics_dir)
+
+        # Check the threads sharing a filter each record into the metrics of their own file
+        errors = []
+        def processFile(section):
+            filter.fileMetrics = {}
+            for i in range(200):
+                filter.recordSection(section, 0.001, 10)
+            if filter.fileMetrics.keys() != [section] or filter.fileMetrics[section]['reads'] != 200:
+                errors.append(filter.fileMetrics)
+            filter.fileMetrics = None
+        threads = [threading.Thread(target=processFile, args=('section{0}'.format(i),)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        expect(errors).to_equal([])
+        expect(filter.metrics.sectionReads['section0']).to_equal(200)
+
+
+    def testFlexstationProfiling(self):
+        """
+        Tests the files taking longer than the threshold are profiled, and only the last profiles are kept
+        """
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test",
+                                   profileThreshold=0)
+        filter.profilePath = mkdtemp()
+        filter.profileKeep = 1
+        filter.metrics = FlexstationMetrics()
+        try:
+            filter.__call__(None, instance=self.datafiles[0])
+            profile_path = path.join(filter.profilePath, self.datafiles[0].sha512sum)
+            expect(path.exists(profile_path + '.prof')).to_be_truthy()
+            expect(open(profile_path + '.txt').read()).to_contain('readDataset')
+            # the profiled extraction isn't counted
+            expect(filter.metrics.sectionReads['CSFlexSite']).to_equal(1)
+            expect(filter.sectionMetrics is filter.metrics).to_be_truthy()
+
+            filter.__call__(None, instance=self.datafiles[3])
+            expect(path.exists(profile_path + '.prof')).to_be_falsy()
+            expect(path.exists(path.join(filter.profilePath, self.datafiles[3].sha512sum + '.prof'))).to_be_truthy()
+
+            # Check a profile leaves the tracing of the allocations started by another thread running
+            if tracemalloc != None:
+                tracemalloc.start()
+                try:
+                    file_path = path.join(path.dirname(__file__), 'fixtures', self.TEST_FILES_PATH[1])
+                    expect(filter.profileFile(file_path, self.datafiles[1].sha512sum, keep=2)).to_be_truthy()
+                    expect(tracemalloc.is_tracing()).to_be_truthy()
+                finally:
+                    tracemalloc.stop()
+        finally:
+            rmtree(filter.profilePath)
+
+        # Check the other threads keep recording into the counters of the process while a thread profiles a file
+        filter.sectionMetrics = FlexstationMetrics()
+        thread = threading.Thread(target=filter.recordSection, args=('other', 0.001, 10))
+        thread.start()
+        thread.join()
+        expect(filter.metrics.sectionReads['other']).to_equal(1)
+        expect('other' in filter.sectionMetrics.sectionReads).to_be_falsy()
+        filter.sectionMetrics = None
+
+
+    def testFlexstationReadFromContent(self):
+        """
+        Tests the files can be parsed from their content or a stream, and the content given to the filter is parsed
+        instead of the file
+        """
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+        file_path = path.join(path.dirname(__file__), 'fixtures', 'BGD131010 3833 and 3971.pda')
+        with open(file_path, 'rb') as f:
+            content = f.read()
+        metadata = filter.extractMetadata(file_path)
+        expect(filter.extractMetadata(content)).to_equal(metadata)
+        expect(filter.extractMetadata(StringIO(content))).to_equal(metadata)
+        expect(filter.extractMetadata(bytearray(content))).to_equal(metadata)
+        expect(filter.peekHeader(content)).to_equal(filter.peekHeader(file_path))
+
+        # The content of another file is saved, since the file of the datafile isn't read again
+        filter.__call__(None, instance=self.datafiles[0], data=content)
+        psm = ParameterSetManager(Dataset_File.objects.get(id=self.datafiles[0].id).getParameterSets()[0])
+        expect(psm.get_param('softmax_version', True)).to_equal(metadata['softmax_version'])
+        expect(filter.getSource(self.datafiles[1], self.datafiles[1].get_absolute_filepath())).to_equal(
+            self.datafiles[1].get_absolute_filepath())
+
+        # Check the mapping of an uploaded file is released once the datafile is processed
+        sources = []
+        getSource = filter.getSource
+        filter.getSource = lambda *args: sources.append(getSource(*args)) or sources[-1]
+        with open(file_path, 'rb') as f:
+            filter.processDatafile(self.datafiles[6], f)
+        expect(sources[0].mapped).to_be_truthy()
+        self.assertRaises(ValueError, sources[0].data.__getitem__, 0)
+        filter.getSource = getSource
+
+        # Check only the first bytes of the remote files which aren't PDA files are fetched
+        class RemoteFile(object):
+            def __init__(self, content):
+                self.stream, self.fetched, self.closed = StringIO(content), 0, False
+            def read(self, size=-1):
+                data = self.stream.read(size)
+                self.fetched += len(data)
+                return data
+            def close(self):
+                self.closed = True
+        class RemoteDatafile(object):
+            id, filename = 0, 'remote.pda'
+            def __init__(self, content):
+                self.file = RemoteFile(content)
+            def get_absolute_filepath(self):
+                return None
+            def get_preferred_replica(self):
+                return self
+            def get_file(self):
+                return self.file
+
+        remote = RemoteDatafile('Not a PDA file. ' * 1000)
+        expect(filter.getSource(remote, None)).to_be_none()
+        expect(remote.file.fetched).to_equal(filter.SNIFF_SIZE)
+        expect(remote.file.closed).to_be_truthy()
+
+        remote = RemoteDatafile(content)
+        expect(filter.extractMetadata(filter.getSource(remote, None))).to_equal(metadata)
+        expect(remote.file.fetched).to_equal(len(content))
+        expect(remote.file.closed).to_be_truthy()
+        # there is no folder to write a sidecar into
+        expect(filter.saveSidecar(remote, metadata, [])).to_be_none()
+
+
+    def testFlexstationPlateLayout(self):
+        """
+        Tests extracting the layout of the wells of a plate
+        """
+        file_path = path.join(path.dirname(__file__), 'fixtures', 'BGD131010 3759 and 3720.pda')
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+
+        # The first experiment of this file has no plate
+        expect(filter.extractPlateLayout(file_path)).to_be_none()
+
+        wells = filter.extractPlateLayout(file_path, 1)
+        expect(len(wells)).to_equal(96)
+        expect(wells[0].tolist()).to_equal(('A1', 1, 1, 'Plate01'))
+        expect(wells[13].tolist()).to_equal(('B2', 2, 2, 'Plate01'))
+        expect(wells[-1].tolist()).to_equal(('H12', 8, 12, 'Plate01'))
+        expect(int(wells['column'].max())).to_equal(12)
+
+
+    def testFlexstationSidecar(self):
+        """
+        Tests the readings of the wells are exported to a NumPy file registered next to the datafile
+        """
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test", sidecar=True)
+        filter.__call__(None, instance=self.datafiles[0])
+        datafile = Dataset_File.objects.get(id=self.datafiles[0].id)
+        expect(datafile.getParameterSets().count()).to_equal(1)
+
+        sidecar = Dataset_File.objects.get(dataset=self.dataset, filename='050511V1 Pmutants rep1.pda.npz')
+        try:
+            metadata, plates = load_plate_data(sidecar.get_absolute_filepath())
+            expect(metadata['experiment_name']).to_equal('Experiment#1')
+            expect(metadata['kinetic_points']).to_equal(65)
+            expect(len(plates)).to_equal(1)
+            expect(plates[0]['values'].shape).to_equal((72, 2, 65))
+
+            # Check the export isn't done twice
+            filter.saveSidecar(datafile, metadata, plates)
+            expect(Dataset_File.objects.filter(dataset=self.dataset,
+                                               filename='050511V1 Pmutants rep1.pda.npz').count()).to_equal(1)
+        finally:
+            remove(sidecar.get_absolute_filepath())
+
+
+    def testFlexstationSaveMetadataBatch(self):
+        """
+        Tests saving the metadata of several datafiles at once
+        """
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+        schema = filter.getSchema()
+        filter.getOrCreateParameterNames(schema, filter.paramnames)
+
+        file_paths = [path.join(path.dirname(__file__), 'fixtures', file_path) for file_path in self.TEST_FILES_PATH]
+        items = [(datafile, filter.extractMetadata(file_path))
+                 for datafile, file_path in zip(self.datafiles, file_paths)]
+
+        # Save the first datafile on its own, it must be left untouched by the batch and not counted
+        ps = filter.saveFlexstationMetadata(items[0][0], schema, items[0][1])
+        expect(filter.saveFlexstationMetadataBatch(schema, items)).to_equal(6)
+        expect(filter.saveFlexstationMetadataBatch(schema, items)).to_equal(0)
+
+        parameterSets = []
+        for datafile in self.datafiles:
+            datafile = Dataset_File.objects.get(id=datafile.id)
+            expect(datafile.getParameterSets().count()).to_equal(1)
+            parameterSets.append(datafile.getParameterSets()[0])
+        expect(parameterSets[0].id).to_equal(ps.id)
+
+        psm = ParameterSetManager(parameterSets[5])
+        expect(psm.get_param('experiment_name', True)).to_equal('Exp01')
+        expect(psm.get_param('kinetic_points', True)).to_equal(39.0)
+
+
+    def testFlexstationIngestBatch(self):
+        """
+        Tests the ingestion command saves a batch of files to the datafiles with the same checksum, and only counts the
+        datafiles it updated
+        """
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+        schema = filter.getSchema()
+        filter.getOrCreateParameterNames(schema, filter.paramnames)
+
+        file_paths = [path.join(path.dirname(__file__), 'fixtures', file_path) for file_path in self.TEST_FILES_PATH]
+        pending = [(datafile.sha512sum, filter.extractMetadata(file_path))
+                   for datafile, file_path in zip(self.datafiles[:3], file_paths)]
+        filter.saveFlexstationMetadata(self.datafiles[0], schema, pending[0][1])
+
+        command = IngestCommand()
+        expect(command.saveBatch(filter, schema, pending)).to_equal(2)
+        expect(Dataset_File.objects.get(id=self.datafiles[2].id).getParameterSets().count()).to_equal(1)
+
+        # Check running it again doesn't count the datafiles as updated
+        expect(command.saveBatch(filter, schema, pending)).to_equal(0)
+
+
+    def testFlexstationSaveMissingParameters(self):
+        """
+        Tests adding to existing parameter sets only the parameters they are missing
+        """
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+        schema = filter.getSchema()
+        filter.getOrCreateParameterNames(schema, filter.paramnames)
+
+        file_path = path.join(path.dirname(__file__), 'fixtures', self.TEST_FILES_PATH[0])
+        metadata = filter.extractMetadata(file_path)
+        ps = filter.saveFlexstationMetadata(self.datafiles[0], schema, metadata)
+        count = DatafileParameter.objects.filter(parameterset=ps).count()
+
+        # Parameters missing from the parameter set, as if they were added to the filter after it was saved
+        DatafileParameter.objects.filter(parameterset=ps,
+                                         name__name__in=['instrument_info', 'kinetic_points']).delete()
+
+        expect(filter.saveMissingParametersBatch(schema, [(ps, metadata)], ['instrument_info'])).to_equal(1)
+        expect(filter.saveMissingParametersBatch(schema, [(ps, metadata)])).to_equal(1)
+        expect(filter.saveMissingParametersBatch(schema, [(ps, metadata)])).to_equal(0)
+        expect(DatafileParameter.objects.filter(parameterset=ps).count()).to_equal(count)
+
+        psm = ParameterSetManager(ps)
+        expect(psm.get_param('instrument_info', True)).to_equal(metadata['instrument_info'].decode('cp1252'))
+        expect(psm.get_param('kinetic_points', True)).to_equal(65.0)
+
+
+    def testFlexstationReextractIncomplete(self):
+        """
+        Tests finding the parameter sets missing some of the parameters, to extract them again
+        """
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+        schema = filter.getSchema()
+        filter.getOrCreateParameterNames(schema, filter.paramnames)
+        parameterNames = filter.getParameterNames(schema)
+
+        # Check the parameters of the schema the parser doesn't extract aren't wanted by default
+        wanted = filter.getExtractedParameters()
+        expect(wanted).to_contain('softmax_version')
+        expect(wanted).to_contain('instrument_info')
+        expect('pmt_settings' in wanted).to_be_falsy()
+        expect('wavelength_combination' in wanted).to_be_falsy() # extracted, but not a parameter of the schema
+
+        filter.processDatafile(self.datafiles[0])
+        filter.processDatafile(self.datafiles[1])
+        parameterSets = [Dataset_File.objects.get(id=datafile.id).getParameterSets()[0]
+                         for datafile in self.datafiles[:2]]
+        DatafileParameter.objects.filter(parameterset=parameterSets[1], name=parameterNames['trans']).delete()
+
+        command = ReextractCommand()
+        wantedIds = [parameterNames[name].id for name in ('instrument_info', 'trans')]
+        expect(command.findIncomplete(schema, wantedIds)).to_equal([(parameterSets[1].id, self.datafiles[1].id)])
+        expect(command.findIncomplete(schema, wantedIds, parameterSets[1].id)).to_equal([])
+
+        # Check a parameter missing from every parameter set
+        wantedIds.append(parameterNames['pmt_settings'].id)
+        expect(len(command.findIncomplete(schema, wantedIds))).to_equal(2)
+        expect(command.findIncomplete(schema, wantedIds, skipped=set([parameterSets[0].id]))).to_equal(
+            [(parameterSets[1].id, self.datafiles[1].id)])
+
+
+    def testFlexstationReextractParsedOnce(self):
+        """
+        Tests the files parsed again with nothing to add for their missing parameters aren't parsed by the next runs
+        """
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+        schema = filter.getSchema()
+        filter.processDatafile(self.datafiles[0])
+        filter.processDatafile(self.datafiles[4]) # no analysis section
+        ps = Dataset_File.objects.get(id=self.datafiles[0].id).getParameterSets()[0]
+        DatafileParameter.objects.filter(parameterset=ps, name__name='trans').delete()
+
+        folder = mkdtemp()
+        try:
+            options = {'parameters': 'analysis_notes,trans', 'workers': 1, 'chunk_size': 1,
+                       'checkpoint': path.join(folder, 'checkpoint.json'), 'name': "Flexstation Test Schema",
+                       'schema': "http://rmit.edu.au/flexstation_test", 'dry_run': False}
+            command = ReextractCommand()
+            command.stdout, command.stderr = StringIO(), StringIO()
+            command.handle(**options)
+            expect(command.stdout.getvalue()).to_contain('2 datafiles are missing some of the parameters')
+            expect(command.stdout.getvalue()).to_contain('2 files parsed, 0 failed, 1 parameters added')
+            expect(DatafileParameter.objects.filter(parameterset=ps, name__name='trans').count()).to_equal(1)
+
+            # Check the next run starts from the beginning, without parsing the file without analysis notes again
+            command.stdout = StringIO()
+            command.handle(**options)
+            expect(command.stdout.getvalue()).to_contain('0 datafiles are missing some of the parameters')
+
+            # unless other parameters are wanted, or the parser changed
+            command.stdout = StringIO()
+            command.handle(**dict(options, parameters='analysis_notes,trans,instrument_info', dry_run=True))
+            expect(command.stdout.getvalue()).to_contain('1 datafiles are missing some of the parameters')
+            ps = Dataset_File.objects.get(id=self.datafiles[4].id).getParameterSets()[0]
+            for version, missing in ((filter.PARSE_CACHE_VERSION, 0), (filter.PARSE_CACHE_VERSION + 1, 1)):
+                command.saveCheckpoint(options['checkpoint'], 0, {'analysis_notes,trans': set([ps.id])}, version)
+                command.stdout = StringIO()
+                command.handle(**dict(options, dry_run=True))
+                expect(command.stdout.getvalue()).to_contain(
+                    '{0} datafiles are missing some of the parameters'.format(missing))
+        finally:
+            rmtree(folder)
+
+
+    def testFlexstationReextractPerDataset(self):
+        """
+        Tests the parameter sets saved per dataset are completed with the metadata of their own dataset only
+        """
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test", perDataset=True)
+        filter.processDatafile(self.datafiles[5])
+        parameterSets = list(Dataset_File.objects.get(id=self.datafiles[5].id).getParameterSets().order_by('id'))
+        expect(len(parameterSets)).to_equal(2)
+        DatafileParameter.objects.filter(parameterset__in=parameterSets,
+                                         name__name__in=['experiment_name', 'analysis_notes']).delete()
+
+        options = {'parameters': 'experiment_name,analysis_notes,instrument_info', 'workers': 1, 'chunk_size': 500,
+                   'checkpoint': None, 'name': "Flexstation Test Schema",
+                   'schema': "http://rmit.edu.au/flexstation_test", 'dry_run': False}
+        command = ReextractCommand()
+        command.stdout, command.stderr = StringIO(), StringIO()
+        command.handle(**options)
+        expect(ParameterSetManager(parameterSets[0]).get_param('experiment_name', True)).to_equal('BasicEndpoint')
+        expect(ParameterSetManager(parameterSets[1]).get_param('experiment_name', True)).to_equal('Exp01')
+        expect(ParameterSetManager(parameterSets[0]).get_param('analysis_notes', True)
+               .startswith('Revision_101')).to_be_truthy()
+
+        # Check the parameters of the other dataset aren't added
+        expect(DatafileParameter.objects.filter(parameterset=parameterSets[0],
+                                                name__name='instrument_info').count()).to_equal(0)
+        expect(DatafileParameter.objects.filter(parameterset=parameterSets[1],
+                                                name__name='analysis_notes').count()).to_equal(0)
+
+        # Check a datafile whose parameter sets don't match its datasets is skipped and reported
+        DatafileParameterSet(schema=parameterSets[0].schema, dataset_file=self.datafiles[5]).save()
+        command.stderr = StringIO()
+        command.handle(**options)
+        expect(command.stderr.getvalue()).to_contain('2 datasets for 3 parameter sets, skipped')
+
+
+    def testFlexstationServeBatching(self):
+        """
+        Tests the ingestion service saves the files parsed in batches, and keeps running when a batch fails
+        """
+        class BatchFilter(object):
+            def __init__(self):
+                self.batches = []
+                self.error = None
+
+            def saveFlexstationMetadataBatch(self, schema, items):
+                if self.error != None:
+                    raise self.error
+                self.batches.append([datafile.id for datafile, metadata in items])
+                return len(items)
+
+        command = ServeCommand()
+        command.stdout, command.stderr = StringIO(), StringIO()
+        command.options = {'batch_size': 2, 'batch_timeout': 60.0}
+        command.filter, command.schema = BatchFilter(), None
+        command.requests, command.results = Queue(), Queue()
+        command.pending, command.deadline = [], None
+        command.parsed, command.failed, command.saved, command.unsaved = 0, 0, 0, 0
+
+        metadata = {'softmax_version': '5.42.1.0'}
+        for datafile in self.datafiles[:3]:
+            command.results.put((str(datafile.id), [datafile], (None, None, metadata, None)))
+        command.results.put(('/nonexistent.pda', None, ('/nonexistent.pda', None, None, 'No such file')))
+        command.save(wait=False)
+        expect(command.filter.batches).to_equal([[self.datafiles[0].id, self.datafiles[1].id],
+                                                 [self.datafiles[2].id]])
+        expect(command.parsed).to_equal(3)
+        expect(command.failed).to_equal(1)
+        expect(command.saved).to_equal(3)
+
+        # Check a batch which fails to be saved is reported, and the next ones are still saved
+        command.filter.error = DatabaseError('database is locked')
+        command.results.put((str(self.datafiles[0].id), [self.datafiles[0]], (None, None, metadata, None)))
+        command.save(wait=False)
+        expect(command.unsaved).to_equal(1)
+        expect(command.pending).to_equal([])
+        expect(command.stderr.getvalue()).to_contain('database is locked')
+
+        command.filter.error = None
+        command.results.put((str(self.datafiles[1].id), [self.datafiles[1]], (None, None, metadata, None)))
+        command.save(wait=False)
+        expect(command.saved).to_equal(4)
+
+
+    def testFlexstationServeDispatchErrors(self):
+        """
+        Tests the ingestion service reports the requests it can't hand over to the workers, and keeps dispatching
+        """
+        class ImmediatePool(object):
+            def apply_async(self, function, args, callback):
+                target = args[0][0]
+                if target == '/unreadable.pda':
+                    raise IOError('Permission denied')
+                callback((target, None, {}, None))
+
+        command = ServeCommand()
+        command.stdout, command.stderr = StringIO(), StringIO()
+        command.options = {'name': 'x', 'schema': 'y', 'parse_timeout': 60.0}
+        command.pool = ImmediatePool()
+        command.parsing = threading.BoundedSemaphore(1)
+        command.inflight, command.inflightLock = {}, threading.Lock()
+        command.tokens, command.timedOut = itertools.count(), 0
+        command.requests, command.results = Queue(), Queue()
+        command.stopping = False
+
+        for item in ('999999', '/unreadable.pda', str(self.datafiles[0].id), '/other.pda', None):
+            command.requests.put(item)
+        command.dispatch()
+
+        results = []
+        while not command.results.empty():
+            item, datafiles, (target, sha512sum, metadata, error) = command.results.get()
+            results.append((item, error))
+        expect(results[0]).to_equal(('999999', 'No datafile 999999'))
+        expect(results[1]).to_equal(('/unreadable.pda', 'Permission denied'))
+        expect(results[2]).to_equal((str(self.datafiles[0].id), None))
+        expect(results[3]).to_equal(('/other.pda', None))
+        # Check the semaphore was released for every request, failed or not
+        expect(command.parsing.acquire(False)).to_be_truthy()
+        command.parsing.release()
+
+        # Check the requests left once the service is stopping are listed, and release the semaphore
+        command.stopping = True
+        for item in ('/late.pda', None):
+            command.requests.put(item)
+        command.dispatch()
+        expect(command.results.empty()).to_be_truthy()
+        expect(command.stderr.getvalue()).to_contain('/late.pda: not processed')
+        expect(command.parsing.acquire(False)).to_be_truthy()
+
+
+    def testFlexstationServeParseTimeout(self):
+        """
+        Tests the ingestion service releases the slots of the files whose worker never returns, and ignores the
+        results received after they timed out
+        """
+        class LostPool(object):
+            def __init__(self):
+                self.callbacks = []
+
+            def apply_async(self, function, args, callback):
+                self.callbacks.append((args[0][0], callback))
+
+        command = ServeCommand()
+        command.stdout, command.stderr = StringIO(), StringIO()
+        command.options = {'name': 'x', 'schema': 'y', 'parse_timeout': 0.0}
+        command.pool = LostPool()
+        command.parsing = threading.BoundedSemaphore(1)
+        command.inflight, command.inflightLock = {}, threading.Lock()
+        command.tokens, command.timedOut = itertools.count(), 0
+        command.requests, command.results = Queue(), Queue()
+        command.stopping = False
+
+        # The second file waits for the slot of the first one, which times out
+        for item in ('/first.pda', '/second.pda', None):
+            command.requests.put(item)
+        command.dispatch()
+        expect(len(command.pool.callbacks)).to_equal(2)
+        expect(command.timedOut).to_equal(1)
+        item, datafiles, (target, sha512sum, metadata, error) = command.results.get_nowait()
+        expect(item).to_equal('/first.pda')
+        expect(error).to_contain('not parsed after')
+
+        # Check a result received after its file timed out is ignored, and the slot isn't released twice
+        target, callback = command.pool.callbacks[0]
+        callback((target, None, {}, None))
+        expect(command.results.empty()).to_be_truthy()
+        command.waitParsing()
+        expect(command.timedOut).to_equal(2)
+        expect(command.inflight).to_equal({})
+        expect(command.parsing.acquire(False)).to_be_truthy()
+
+
+    def testFlexstationParameterNamesCache(self):
+        """
+        Tests the schema and parameter names are only looked up once, until one of them changes
+        """
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+        schema = filter.getSchema()
+        pn = filter.getOrCreateParameterNames(schema, filter.paramnames)
+        expect(len(pn)).to_equal(len(filter.paramnames))
+        expect(pn[0].name).to_equal('softmax_version')
+        expect(pn[0].id).to_be_truthy()
+
+        with self.assertNumQueries(0):
+            filter.getSchema()
+            filter.getOrCreateParameterNames(schema, filter.paramnames)
+            filter.getParameters(schema, {'softmax_version': '5.42.1.0', 'unknown': 'value'})
+
+        # Check a new parameter name empties the cache
+        ParameterName(schema=schema, name='extra', full_name='Extra', data_type=ParameterName.STRING).save()
+        with self.assertNumQueries(1):
+            parameters = filter.getParameters(schema, {'extra': 'value'})
+        expect(parameters[0].name).to_equal('extra')
+
+
+    def testFlexstationParameterNamesCacheRollback(self):
+        """
+        Tests the schema and parameter names created by a transaction which is rolled back don't stay in the cache
+        """
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_rollback")
+        try:
+            with atomic():
+                schema = filter.getSchema()
+                filter.getOrCreateParameterNames(schema, filter.paramnames)
+                raise ValueError('rolled back')
+        except ValueError:
+            pass
+
+        schema = filter.getSchema()
+        expect(Schema.objects.filter(id=schema.id).exists()).to_be_truthy()
+        pn = filter.getOrCreateParameterNames(schema, filter.paramnames)
+        expect(ParameterName.objects.filter(id=pn[0].id).exists()).to_be_truthy()
+
+        # Check a database error in the transactions of the filter empties the cache
+        try:
+            with filter.transaction():
+                raise DatabaseError('rolled back')
+        except DatabaseError:
+            pass
+        expect(filter.schemaCache).to_be_none()
+        expect(filter.parameterNamesCache).to_be_none()
+
+
+    def testFlexstationParseCache(self):
+        """
+        Tests a file with the same checksum as a file already parsed isn't parsed again
+        """
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+        filter.parseCache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+
+        filter.processDatafile(self.datafiles[0])
+        expect(filter.cacheMisses).to_equal(1)
+        expect(filter.cacheHits).to_equal(0)
+
+        # Parse the same file again, the metadata must come from the cache
+        Dataset_File.objects.get(id=self.datafiles[0].id).getParameterSets().delete()
+        def failingExtractMetadata(target, sha512sum=None):
+            raise AssertionError('The file should not be parsed again')
+        filter.extractMetadata = failingExtractMetadata
+        filter.processDatafile(self.datafiles[0])
+        expect(filter.cacheMisses).to_equal(1)
+        expect(filter.cacheHits).to_equal(1)
+
+        datafile = Dataset_File.objects.get(id=self.datafiles[0].id)
+        psm = ParameterSetManager(datafile.getParameterSets()[0])
+        expect(psm.get_param('experiment_name', True)).to_equal('Experiment#1')
+
+
     def testFlexstationReadStringUntilDelimiter(self):
         """
         Tests the method readStringUntilDelimiter in different contexts
@@ -302,6 +1243,43 @@ class FlexstationFilterTestCase(TestCase):
             expect(str).to_equal("TRPV1 Phosphate mutants\rCells seeded 48hrs prior 40K cel/well \rInduced with tetracycline for 3 hrs washed once with hepes (50microL/well) then loaded with fura2 for 1 hr (50 microL/well). then washed twice with 60microl or HEPES buffer per well finaly loaded with 60microl of hepes.\rCells:\rcolumn 1: Nt, 2: WtV1, 3: C1, 4: C2, 5: C3, 6: C4, 7: C5,  8: N1, 9: N6\rinjection 1: rows A-D buffer only, E-H 100microM SLIGRL\rinjection 2: Row A,E DMSO 1%, B,F 1microM CAPS, C,G 10microM CAPS, D,H 100microM caps")
 
 
+    def testFlexstationSkipToLastStringDelimiter(self):
+        """
+        Tests the method skipToLastStringDelimiter in different contexts
+        """
+        file_path = path.join(path.dirname(__file__), 'fixtures', '050511V1 Pmutants rep1.pda')
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
+
+        with open(file_path, 'rb') as f:
+            # Test with the header's end delimiter (the experiment section starts right after it)
+            f.seek(13)
+            expect(filter.skipToLastStringDelimiter(f, filter.HEADER_END_DELIMITER)).to_equal(True)
+            expect(f.tell()).to_equal(2418)
+
+            # Test with a delimiter which isn't in the remaining of the file (should not move)
+            f.seek(160972)
+            expect(filter.skipToLastStringDelimiter(f, filter.HEADER_END_DELIMITER)).to_equal(False)
+            expect(f.tell()).to_equal(160972)
+
+        with PdaBuffer.open(file_path) as buffer:
+            buffer.seek(13)
+            expect(filter.skipToLastStringDelimiter(buffer, filter.HEADER_END_DELIMITER)).to_equal(True)
+            expect(buffer.tell()).to_equal(2418)
+
+        # Test with overlapping delimiters, which are consumed in pairs when reading forward
+        buffer = PdaBuffer("xx" + "\x48\x00\x00\x00" * 3 + "yy")
+        expect(filter.skipToLastStringDelimiter(buffer, filter.HEADER_END_DELIMITER)).to_equal(True)
+        expect(buffer.tell()).to_equal(10)
+
+        # Test a string delimiter spanning two blocks of the file
+        filter.BLOCK_SIZE = 4
+        with open(file_path, 'rb') as f:
+            f.seek(13)
+            str = filter.readStringUntilStringDelimiter(f, "\x42\x4C\x4F\x43\x4B\x53")
+            expect(str).to_equal("##")
+            expect(f.tell()).to_equal(21)
+
+
     def testSkipIfNumber(self):
         """
         Tests the method skipIfNumber in different contexts
@@ -349,7 +1327,54 @@ class FlexstationFilterTestCase(TestCase):
             beforeSkip = f.tell()
             filter.skipIfNumber(f, [0, 'string', 2])
             expect(f.tell()).to_equal(beforeSkip + 4)
-            
 
 
+    def testFlexstationPdaBuffer(self):
+        """
+        Tests the PdaBuffer cursor gives the same results as reading the file itself
+        """
+        file_path = path.join(path.dirname(__file__), 'fixtures', '050511V1 Pmutants rep1.pda')
+        filter = FlexstationFilter("Flexstation Test Schema", "http://rmit.edu.au/flexstation_test")
 
+        with PdaBuffer.open(file_path) as buffer:
+            expect(buffer.size).to_equal(161329)
+
+            # Test the string helpers on the buffer
+            buffer.seek(2)
+            str = filter.readStringUntilDelimiter(buffer)
+            expect(str).to_equal(" 5.42.1.0")
+            expect(buffer.tell()).to_equal(12)
+
+            buffer.seek(160972)
+            str = filter.readStringUntilDelimiter(buffer, "\x99")
+            expect(str).to_equal(None)
+
+            buffer.seek(2418)
+            str = filter.readStringWithLengthPrefix(buffer, 1)
+            expect(str).to_equal("CSExperimentSection")
+
+            # Test reading numbers
+            buffer.seek(2485) # next number is 2
+            expect(buffer.readUInt(4)).to_equal(2)
+            expect(buffer.tell()).to_equal(2489)
+
+            buffer.seek(2485)
+            filter.skipIfNumber(buffer, [2])
+            expect(buffer.tell()).to_equal(2489)
+
+            # Test reading records
+            buffer.seek(8068) # header of the first flex site: 2 chunks of 65 reads, at 2 wavelengths
+            expect(buffer.readRecord(FLEX_SITE_HEADER)).to_equal((2, 65, 1, 1048))
+            expect(buffer.tell()).to_equal(8084)
+            buffer.seek(8068 + 2123) # header of the next flex site
+            expect(buffer.readRecords(FLEX_SITE_HEADER, 1)).to_equal([(2, 65, 2, 1048)])
+            self.assertRaises(struct.error, buffer.readRecords, FLEX_SITE_HEADER, 100000)
+
+            # Test reading past the end of the buffer
+            buffer.seek(0, 2)
+            expect(buffer.read(4)).to_equal('')
+
+        # Test the buffer also works over an in-memory string
+        with open(file_path, 'rb') as f:
+            content = f.read()
+        expect(filter.readStringWithLengthPrefix(PdaBuffer(content[2418:]), 1)).to_equal("CSExperimentSection")